@@ -8,4 +8,4 @@
 module load CUDA/12.3.0
 module load Python/3.11.3-GCCcore-12.3.0
 source rise_env/bin/activate
-e.g ./run.sh --system-type $1 --bert-name $2
+python -u scripts/run_sweep.py --system-type $1 --model-name $2
@@ -70,6 +70,12 @@ if [ -z "$system_type" ] || [ -z "$model_name" ]; then
 fi
 
 
+# Use the Parquet files of prepare_dataset.py (--output-format parquet) if there are any
+data_format="json"
+if [ -f "${data_dir}/system_${system_type}/train.parquet" ]; then
+    data_format="parquet"
+fi
+
 for (( i = 0; i < run_count; i++ )); do
   seed=$(( RANDOM % 100001 ))
   echo "Run number $((i+1)) of $run_count"
@@ -77,9 +83,9 @@ for (( i = 0; i < run_count; i++ )); do
   python -u scripts/run_ner.py \
         --model_name_or_path "${model_name}" \
         --task_name "ner" \
-        --train_file "${data_dir}/system_${system_type}/train.json" \
-        --validation_file "${data_dir}/system_${system_type}/validation.json" \
-        --test_file "${data_dir}/system_${system_type}/test.json" \
+        --train_file "${data_dir}/system_${system_type}/train.${data_format}" \
+        --validation_file "${data_dir}/system_${system_type}/validation.${data_format}" \
+        --test_file "${data_dir}/system_${system_type}/test.${data_format}" \
         --output_dir "saved_models/system_${system_type}/${model_name}_${seed}" \
         --text_column_name "tokens" \
         --label_column_name "ner_tags" \
@@ -90,7 +96,7 @@ for (( i = 0; i < run_count; i++ )); do
         --seed ${seed} \
         --do_eval \
         --do_predict \
-        --overwrite_cache \
+        --tokenized_cache_dir "${data_dir}/tokenized_cache" \
         --overwrite_output_dir \
         --return_entity_level_metrics \
         --save_total_limit 2 \
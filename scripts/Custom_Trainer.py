@@ -1,37 +1,222 @@
+import time
+
+import datasets
+import numpy as np
+import pyarrow.compute as pc
 import torch
 from torch.nn import CrossEntropyLoss
-from transformers import Trainer
+from torch.utils.data import DataLoader, Sampler
+from transformers import Trainer, TrainerCallback
+
+from distillation import DISTILLATION_INDEX_COLUMN, distillation_loss
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Batch sampler that groups sentences of similar length into batches of at most `max_tokens` padded tokens
+    (batch size x longest sentence), instead of a fixed number of sentences.
+
+    The batches are built once from the sentences sorted by length, so that little of every batch is padding, and
+    only their order is shuffled at every epoch (with `seed` + epoch, see `set_epoch`).
+    """
+
+    def __init__(self, lengths, max_tokens, shuffle=True, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+        order = np.argsort(self.lengths, kind="stable")
+        self.batches = []
+        start = 0
+        for end in range(1, len(order) + 1):
+            # order is sorted by length, so the next sentence is the longest of the candidate batch. A sentence
+            # longer than the budget still gets a batch of its own.
+            if end == len(order) or (end - start + 1) * self.lengths[order[end]] > self.max_tokens:
+                self.batches.append(order[start:end])
+                start = end
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        if self.shuffle:
+            batch_order = np.random.default_rng(self.seed + self.epoch).permutation(len(self.batches))
+        else:
+            batch_order = range(len(self.batches))
+        for i in batch_order:
+            yield self.batches[i].tolist()
+
+
+class PaddingStatsCallback(TrainerCallback):
+    """
+    Logs the share of padding in the training batches, and the number of real (non-padding) tokens processed per
+    second, at the end of every epoch. Also moves the token budget sampler of the trainer to the next epoch.
+    """
+
+    def __init__(self, trainer):
+        self.trainer = trainer
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self.trainer.reset_padding_stats()
+        if self.trainer.train_batch_sampler is not None:
+            self.trainer.train_batch_sampler.set_epoch(int(state.epoch))
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        self.trainer.log_padding_stats()
+
+
+class TokenBudgetBatchingMixin:
+    """
+    Trainer mixin for length-grouped, token budget batching of the training set.
+
+    When `max_tokens_per_batch` is given, the training batches are built by `TokenBudgetBatchSampler` and
+    `per_device_train_batch_size` is ignored. In both cases the padding ratio of the training batches is logged at
+    the end of every epoch, so the two batching modes can be compared.
+    """
+
+    def __init__(self, *args, max_tokens_per_batch=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.train_batch_sampler = None
+        self.reset_padding_stats()
+        self.add_callback(PaddingStatsCallback(self))
+
+    def get_train_dataloader(self):
+        if self.max_tokens_per_batch is None:
+            return super().get_train_dataloader()
+        if self.train_dataset is None:
+            raise ValueError("Trainer: training requires a train_dataset.")
+        if not isinstance(self.train_dataset, datasets.Dataset):
+            raise ValueError("Token budget batching requires the train dataset to be a datasets.Dataset.")
+
+        lengths = pc.list_value_length(self.train_dataset.with_format("arrow")[:]["input_ids"]).to_numpy()
+        self.train_batch_sampler = TokenBudgetBatchSampler(
+            lengths, self.max_tokens_per_batch, shuffle=True, seed=self.args.seed
+        )
+        train_dataset = self._remove_unused_columns(self.train_dataset, description="training")
+        dataloader = DataLoader(
+            train_dataset,
+            batch_sampler=self.train_batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+        return self.accelerator.prepare(dataloader)
+
+    def training_step(self, model, inputs, *args, **kwargs):
+        attention_mask = inputs.get("attention_mask")
+        if attention_mask is not None:
+            # Kept on the device, so counting does not synchronize with it at every step.
+            self._real_tokens = self._real_tokens + attention_mask.sum()
+            self._padded_tokens += attention_mask.numel()
+        return super().training_step(model, inputs, *args, **kwargs)
+
+    def reset_padding_stats(self):
+        self._real_tokens = 0
+        self._padded_tokens = 0
+        self._epoch_start = time.time()
+
+    def log_padding_stats(self):
+        if self._padded_tokens == 0:
+            return
+        counts = torch.tensor([float(self._real_tokens), float(self._padded_tokens)], device=self.args.device)
+        if self.args.world_size > 1:
+            counts = self.accelerator.reduce(counts, reduction="sum")
+        real_tokens, padded_tokens = counts.tolist()
+        self.log({
+            "train_padding_ratio": round(1 - real_tokens / padded_tokens, 4),
+            "train_real_tokens_per_second": round(real_tokens / (time.time() - self._epoch_start), 1),
+        })
+
+
+class TrainerTokenBudget(TokenBudgetBatchingMixin, Trainer):
+    pass
+
+
+class WeightedTokenLoss(torch.nn.Module):
+    """
+    Weighted cross-entropy over the positions of a token classification batch that have a label (labels equal to
+    `ignore_index`, i.e. special tokens, padding and the non-first sub-words, are left out). Only the logits of those
+    positions are gathered, and the loss is computed in float32 so that it is stable under mixed precision.
+    """
+
+    def __init__(self, class_weights=None, ignore_index=-100):
+        super().__init__()
+        self.ignore_index = ignore_index
+        self.loss_fct = CrossEntropyLoss(
+            weight=None if class_weights is None else torch.as_tensor(class_weights, dtype=torch.float32)
+        )
+
+    def forward(self, logits, labels):
+        valid = labels != self.ignore_index
+        return self.loss_fct(logits[valid].float(), labels[valid])
 
 
 # The custom Trainer class that inherits to override the loss function
 
-class TrainerWeightedLoss(Trainer):
-    def compute_loss(self, model, inputs, return_outputs=False):
+class TrainerWeightedLoss(TokenBudgetBatchingMixin, Trainer):
+    def __init__(self, *args, class_weights=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Built once, on the device of the model, instead of at every step.
+        self.loss_fct = WeightedTokenLoss(class_weights).to(self.args.device)
+
+    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
         """
         How the loss is computed by Trainer.
         Overridden to implement weighted cross-entropy which may perform better on imbalanced datasets.
+        The labels are not passed to the model, so that it does not compute its own (unweighted) loss.
         """
-
-        outputs = model(**inputs)
+        labels = inputs.get("labels")
+        outputs = model(**{key: value for key, value in inputs.items() if key != "labels"})
         # Save past state if it exists
         if self.args.past_index >= 0:
             self._past = outputs[self.args.past_index]
 
-        labels = inputs["labels"]
-        attention_mask = inputs["attention_mask"]
-        logits = outputs["logits"]
+        loss = None
         if labels is not None:
-            # Define the loss function with optional class weights
-            loss_fct = CrossEntropyLoss(weight=self.args.class_weights)
-            # Only keep active parts of the loss
-            if attention_mask is not None:
-                active_loss = attention_mask.view(-1) == 1
-                active_logits = logits.view(-1, self.args.num_labels)
-                active_labels = torch.where(
-                    active_loss, labels.view(-1), torch.tensor(loss_fct.ignore_index).type_as(labels)
-                )
-                loss = loss_fct(active_logits, active_labels)
-            else:
-                loss = loss_fct(logits.view(-1, self.args.num_labels), labels.view(-1))
+            loss = self.loss_fct(outputs["logits"], labels)
+
+        return (loss, outputs) if return_outputs else loss
+
+
+class TrainerDistillation(TokenBudgetBatchingMixin, Trainer):
+    """
+    Trainer of a student against the soft labels of an ensemble of teachers (see distillation.py).
+
+    The rows of the training set carry their index in the soft labels (DISTILLATION_INDEX_COLUMN), which is kept by
+    the column filtering of the Trainer and popped from the inputs before the forward pass. The batches without it
+    (evaluation) are scored with the loss on the gold labels only, weighted by `class_weights` if given.
+    """
+
+    def __init__(self, *args, soft_labels=None, temperature=2.0, alpha=0.5, class_weights=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.soft_labels = soft_labels
+        self.temperature = temperature
+        self.alpha = alpha
+        self.loss_fct = WeightedTokenLoss(class_weights).to(self.args.device)
+
+    def _set_signature_columns_if_needed(self):
+        super()._set_signature_columns_if_needed()
+        if DISTILLATION_INDEX_COLUMN not in self._signature_columns:
+            self._signature_columns.append(DISTILLATION_INDEX_COLUMN)
+
+    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
+        labels = inputs.get("labels")
+        rows = inputs.get(DISTILLATION_INDEX_COLUMN)
+        outputs = model(**{key: value for key, value in inputs.items() if key not in ("labels", DISTILLATION_INDEX_COLUMN)})
+
+        loss = None
+        if labels is not None and rows is not None:
+            teacher_logits = torch.from_numpy(self.soft_labels.rows(rows.cpu().numpy())).to(outputs["logits"].device)
+            loss = distillation_loss(
+                outputs["logits"], teacher_logits, labels, self.loss_fct, self.temperature, self.alpha
+            )
+        elif labels is not None:
+            loss = self.loss_fct(outputs["logits"], labels)
 
         return (loss, outputs) if return_outputs else loss
@@ -0,0 +1,79 @@
+"""
+Average the weights of several fine-tuned checkpoints of the same model (e.g. the seed runs of run.sh) into one.
+
+The checkpoints must have the same architecture (the same parameter names and shapes), the same label map and the
+same tokenizer. The floating point parameters are averaged, one checkpoint at a time so that only two copies of the
+weights are in memory; the other tensors (e.g. position ids) must be equal and are copied. The output directory
+holds the averaged model, the config and the tokenizer, so inference.py, serve.py and quantize.py load it as any
+other checkpoint. The averaged model costs as much as one model to serve; the logit ensemble of the same checkpoints
+(`inference.py --ensemble_dirs`) costs one forward pass per member.
+
+Sample usage (the grep keeps the <model>_<seed> runs, not their _int8 or _onnx copies):
+    python scripts/average_checkpoints.py $(ls -d saved_models/system_a/bert-base-cased_* | grep -E '_[0-9]+$') \
+        --output_dir saved_models/system_a/bert-base-cased-averaged_0
+"""
+
+import argparse
+import logging
+import sys
+
+import torch
+from transformers import AutoModelForTokenClassification
+
+from inference import check_same_tokenizer, load_tokenizer
+
+logger = logging.getLogger(__name__)
+
+
+def average_checkpoints(model_dirs):
+    """
+    The model whose floating point parameters are the mean of those of the checkpoints in `model_dirs`.
+    """
+    check_same_tokenizer(model_dirs)
+    model = AutoModelForTokenClassification.from_pretrained(model_dirs[0])
+    averaged = {name: tensor.detach().clone().float() if tensor.is_floating_point() else tensor
+                for name, tensor in model.state_dict().items()}
+
+    for model_dir in model_dirs[1:]:
+        member = AutoModelForTokenClassification.from_pretrained(model_dir)
+        if member.config.id2label != model.config.id2label:
+            raise ValueError(f"{model_dir} does not have the labels of {model_dirs[0]}")
+        state_dict = member.state_dict()
+        if state_dict.keys() != averaged.keys():
+            raise ValueError(f"{model_dir} does not have the parameters of {model_dirs[0]}")
+        for name, tensor in state_dict.items():
+            if tensor.shape != averaged[name].shape:
+                raise ValueError(f"{name} has the shape {tuple(tensor.shape)} in {model_dir}, "
+                                 f"{tuple(averaged[name].shape)} in {model_dirs[0]}")
+            if tensor.is_floating_point():
+                averaged[name] += tensor.float()
+            elif not torch.equal(tensor, averaged[name]):
+                raise ValueError(f"{name} differs between {model_dirs[0]} and {model_dir}")
+        del member
+
+    dtypes = {name: tensor.dtype for name, tensor in model.state_dict().items()}
+    model.load_state_dict({
+        name: (tensor / len(model_dirs)).to(dtypes[name]) if tensor.is_floating_point() else tensor
+        for name, tensor in averaged.items()
+    })
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Average the weights of several checkpoints of the same model.")
+    parser.add_argument("model_dirs", type=str, nargs="+",
+                        help="Directories of the saved models (e.g. saved_models/system_a/<model>_<seed>)")
+    parser.add_argument("--output_dir", type=str, required=True, help="Where to save the averaged model")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=logging.INFO,
+    )
+
+    model = average_checkpoints(args.model_dirs)
+    model.save_pretrained(args.output_dir)
+    load_tokenizer(args.model_dirs[0]).save_pretrained(args.output_dir)
+    logger.info(f"Saved the average of {len(args.model_dirs)} checkpoints to {args.output_dir}")
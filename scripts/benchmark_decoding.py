@@ -0,0 +1,86 @@
+"""
+Measure the effect of the constrained BIO decoding of decoding.py on a prepared test split: the entity-level F1 of the
+arg-max tags and of the constrained tags, the share of sentences whose arg-max tags are not valid IOB2, and the
+decoding cost per sentence (the word log-probabilities are computed once, only the decoding and the extraction of the
+entity spans are timed) next to the cost of the forward pass.
+
+Sample usage:
+    python scripts/benchmark_decoding.py saved_models/system_a/bert-base-cased_42 data/system_a/test.json \
+        --num_threads 4 --output_file decoding_report.json
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmark_inference import load_test_split, score_tags
+from decoding import BIODecoder
+from inference import load_tagger
+
+
+def time_per_sentence(function, num_sentences, repeats):
+    """
+    The best time of `repeats` calls of `function`, in microseconds per sentence.
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best / max(num_sentences, 1) * 1e6
+
+
+def benchmark(tagger, sentences, gold, repeats=5):
+    start = time.perf_counter()
+    log_probs, offsets = tagger.predict_word_log_probs(sentences)
+    forward_time = (time.perf_counter() - start) / len(sentences) * 1e6
+
+    decoder = BIODecoder(tagger.label_list)
+    argmax_ids = log_probs.argmax(axis=1)
+    constrained_ids = decoder.decode(log_probs, offsets)
+    invalid = decoder.invalid_transitions(argmax_ids, offsets)
+    invalid_sentences = np.add.reduceat(invalid, offsets[:-1][np.diff(offsets) > 0]) > 0
+
+    reports = []
+    for name, label_ids, decode in [
+        ("argmax", argmax_ids, lambda: decoder.entities(log_probs.argmax(axis=1), log_probs, offsets)),
+        ("constrained", constrained_ids, lambda: decoder.entities(decoder.decode(log_probs, offsets), log_probs, offsets)),
+    ]:
+        scores = score_tags(np.split(tagger.id_to_label[label_ids], offsets[1:-1]), gold)
+        reports.append({
+            "decoding": name,
+            "overall_precision": scores["overall_precision"],
+            "overall_recall": scores["overall_recall"],
+            "overall_f1": scores["overall_f1"],
+            **{f"{entity_type}_f1": result["f1"] for entity_type, result in scores.items() if isinstance(result, dict)},
+            "invalid_sentences": float(invalid_sentences.mean()) if name == "argmax" else 0.0,
+            "changed_tags": float(np.mean(label_ids != argmax_ids)),
+            "decoding_us_per_sentence": time_per_sentence(decode, len(sentences), repeats),
+            "forward_us_per_sentence": forward_time,
+        })
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the accuracy and the cost of the constrained BIO decoding.")
+    parser.add_argument("model_dir", type=str, help="Directory of the saved model (e.g. saved_models/system_a/<model>_<seed>)")
+    parser.add_argument("test_file", type=str, help="A prepared test.json or test.parquet file")
+    parser.add_argument("--max_sentences", type=int, default=None, help="Only use the first sentences of the file")
+    parser.add_argument("--repeats", type=int, default=5, help="Number of timed decodings (the best one is kept)")
+    parser.add_argument("--num_threads", type=int, default=None, help="Number of CPU threads used by the model")
+    parser.add_argument("--backend", type=str, default=None, choices=["torch", "onnx"],
+                        help="Run the model with torch or with ONNX Runtime (see inference.py)")
+    parser.add_argument("--output_file", type=str, default=None, help="Save the report to this json file")
+    args = parser.parse_args()
+
+    sentences, gold = load_test_split(args.test_file, args.max_sentences)
+
+    tagger = load_tagger(args.model_dir, backend=args.backend, num_threads=args.num_threads)
+    reports = benchmark(tagger, sentences, gold, args.repeats)
+    print(pd.DataFrame(reports).set_index("decoding").T.to_markdown())
+    if args.output_file:
+        with open(args.output_file, "w") as file:
+            json.dump(reports, file, indent=2)
@@ -0,0 +1,61 @@
+"""
+Compare the ways of serving several checkpoints of a model (e.g. its seed runs) on a prepared test split: every
+checkpoint alone, their weight average (see average_checkpoints.py) and their logit ensemble (inference.py
+--ensemble_dirs), on model size, single sentence latency, batched throughput and entity-level F1. The speedup of
+every row is relative to the ensemble.
+
+Sample usage (the grep keeps the <model>_<seed> runs, not their _int8 or _onnx copies):
+    python scripts/benchmark_ensemble.py data/system_a/test.json \
+        $(ls -d saved_models/system_a/bert-base-cased_* | grep -E '_[0-9]+$') --num_threads 4 --output_file ensemble_report.json
+"""
+
+import argparse
+import json
+import os
+
+import pandas as pd
+
+from average_checkpoints import average_checkpoints
+from benchmark_inference import benchmark, load_test_split
+from inference import EnsembleNERTagger, NERTagger, load_tokenizer, set_num_threads
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare single checkpoints, their weight average and their ensemble.")
+    parser.add_argument("test_file", type=str, help="A prepared test.json or test.parquet file")
+    parser.add_argument("model_dirs", type=str, nargs="+",
+                        help="Directories of the saved models (e.g. saved_models/system_a/<model>_<seed>)")
+    parser.add_argument("--averaged_dir", type=str, default=None,
+                        help="The average of the checkpoints saved by average_checkpoints.py (default: average them "
+                             "in memory)")
+    parser.add_argument("--max_sentences", type=int, default=None, help="Only use the first sentences of the file")
+    parser.add_argument("--latency_samples", type=int, default=200,
+                        help="Number of single sentence calls for the latency percentiles")
+    parser.add_argument("--num_threads", type=int, default=None, help="Number of CPU threads used by torch")
+    parser.add_argument("--output_file", type=str, default=None, help="Save the report to this json file")
+    args = parser.parse_args()
+
+    set_num_threads(args.num_threads)
+    sentences, gold = load_test_split(args.test_file, args.max_sentences)
+
+    reports = []
+    for model_dir in args.model_dirs:
+        report, _ = benchmark(os.path.basename(model_dir.rstrip(os.sep)), NERTagger.from_pretrained(model_dir),
+                              sentences, gold, args.latency_samples)
+        reports.append(report)
+
+    if args.averaged_dir is not None:
+        averaged_tagger = NERTagger.from_pretrained(args.averaged_dir)
+    else:
+        averaged_tagger = NERTagger(average_checkpoints(args.model_dirs), load_tokenizer(args.model_dirs[0]))
+    reports.append(benchmark("averaged", averaged_tagger, sentences, gold, args.latency_samples)[0])
+    ensemble_report, _ = benchmark(
+        "ensemble", EnsembleNERTagger.from_pretrained(args.model_dirs), sentences, gold, args.latency_samples
+    )
+    reports.append(ensemble_report)
+
+    for report in reports:
+        report["speedup"] = report["sentences_per_second"] / ensemble_report["sentences_per_second"]
+    print(pd.DataFrame(reports).set_index("backend").T.to_markdown())
+    if args.output_file:
+        with open(args.output_file, "w") as file:
+            json.dump(reports, file, indent=2)
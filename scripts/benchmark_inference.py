@@ -0,0 +1,174 @@
+"""
+Compare the fp32 model and its dynamically quantized int8 copy (see quantize.py) on CPU: model size, single sentence
+latency, batched throughput and entity-level F1 (the seqeval scores of the span scorer) on a prepared test split.
+With --student_dir, a student distilled from the model (see distillation.py) is compared as well. The speedup and
+the F1 difference of every model are relative to the fp32 model. Every model is benchmarked in a process of its own,
+which reports the memory it takes: the growth of the peak resident memory of the process from loading the model to the
+end of its benchmark.
+
+Sample usage:
+    python scripts/benchmark_inference.py saved_models/system_a/bert-base-cased_42 data/system_a/test.json \
+        --num_threads 4 --output_file inference_report.json
+The int8 model is quantized in memory, unless an exported copy is given with --quantized_dir.
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import torch
+
+from eval_data import parse_gold_file
+from inference import NERTagger, load_tokenizer, read_sentences, set_num_threads
+from quantize import quantize_dynamic_int8
+from span_scorer import SpanScorer
+
+
+def serialized_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def peak_rss():
+    """
+    The peak resident memory of the current process, in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def measure_latency(tagger, sentences, num_samples, seed=42):
+    """
+    Latencies in seconds of tagging single sentences (batch size 1), drawn at random from `sentences`.
+    """
+    rng = np.random.default_rng(seed)
+    latencies = []
+    for index in rng.choice(len(sentences), size=min(num_samples, len(sentences)), replace=False):
+        start = time.perf_counter()
+        tagger.tag([sentences[index]])
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+def score_tags(predicted_tags, gold):
+    """
+    Entity-level scores of the predicted tag lists against the gold TagArrays.
+    """
+    label_list = sorted(set(gold.labels).union(tag for tags in predicted_tags for tag in tags))
+    label_to_id = {l: i for i, l in enumerate(label_list)}
+    predictions = np.array([label_to_id[tag] for tags in predicted_tags for tag in tags], dtype=np.int64)
+    return SpanScorer(label_list).compute(predictions, gold.encode(label_to_id), gold.offsets)
+
+
+def benchmark(name, tagger, sentences, gold, latency_samples, reference_tags=None):
+    # Warm-up: the first calls allocate the buffers of the kernels
+    tagger.tag(sentences[:64])
+    latencies = measure_latency(tagger, sentences, latency_samples)
+
+    start = time.perf_counter()
+    predicted_tags = tagger.tag(sentences)
+    elapsed = time.perf_counter() - start
+
+    scores = score_tags(predicted_tags, gold)
+    word_count = sum(len(sentence) for sentence in sentences)
+    report = {
+        "backend": name,
+        "model_size_mb": serialized_size(tagger.model) / 2**20,
+        "latency_p50_ms": float(np.percentile(latencies, 50)) * 1000,
+        "latency_p95_ms": float(np.percentile(latencies, 95)) * 1000,
+        "sentences_per_second": len(sentences) / elapsed,
+        "words_per_second": word_count / elapsed,
+        "overall_f1": scores["overall_f1"],
+        **{f"{entity_type}_f1": result["f1"] for entity_type, result in scores.items() if isinstance(result, dict)},
+    }
+    if reference_tags is not None:
+        # Share of the tags which are the same as those of the fp32 model
+        report["tag_agreement"] = float(np.mean([
+            a == b for tags, other_tags in zip(predicted_tags, reference_tags) for a, b in zip(tags, other_tags)
+        ]))
+    return report, predicted_tags
+
+
+def load_test_split(test_file, max_sentences=None):
+    sentences = list(read_sentences(test_file))
+    gold = parse_gold_file(test_file)
+    if max_sentences is not None:
+        sentences = sentences[:max_sentences]
+        gold = gold.select(np.arange(len(gold.tags)) < gold.offsets[len(sentences)])
+        gold.offsets = gold.offsets[:len(sentences) + 1]
+    return sentences, gold
+
+
+def load_backend(name, args):
+    if name == "fp32":
+        return NERTagger.from_pretrained(args.model_dir)
+    if name == "int8":
+        if args.quantized_dir is not None:
+            return NERTagger.from_pretrained(args.quantized_dir)
+        # The fp32 model quantized in memory is part of the peak memory of the int8 model
+        return NERTagger(quantize_dynamic_int8(NERTagger.from_pretrained(args.model_dir).model),
+                         load_tokenizer(args.model_dir))
+    if name == "student":
+        return NERTagger.from_pretrained(args.student_dir)
+    raise ValueError(f"Unknown backend {name}")
+
+
+def benchmark_backend(name, args, reference_tags=None):
+    """
+    Load and benchmark one model in the current process, with the growth of the peak resident memory of the process
+    from loading the model to the end of its benchmark.
+    """
+    set_num_threads(args.num_threads)
+    sentences, gold = load_test_split(args.test_file, args.max_sentences)
+    peak_before = peak_rss()
+    tagger = load_backend(name, args)
+    report, predicted_tags = benchmark(name, tagger, sentences, gold, args.latency_samples, reference_tags)
+    report["peak_memory_mb"] = (peak_rss() - peak_before) / 2**20
+    return report, predicted_tags
+
+
+def benchmark_in_new_process(name, args, reference_tags=None):
+    # A fresh process per model, so that the peak memory of one model does not hide that of the next one
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(benchmark_backend, name, args, reference_tags).result()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the fp32 and int8 inference of a checkpoint on CPU.")
+    parser.add_argument("model_dir", type=str, help="Directory of the saved model (e.g. saved_models/system_a/<model>_<seed>)")
+    parser.add_argument("test_file", type=str, help="A prepared test.json or test.parquet file")
+    parser.add_argument("--quantized_dir", type=str, default=None,
+                        help="An int8 copy of the model exported by quantize.py (default: quantize in memory)")
+    parser.add_argument("--student_dir", type=str, default=None,
+                        help="A student distilled from the model by run_ner.py (--teacher_model_dirs) to compare too")
+    parser.add_argument("--max_sentences", type=int, default=None, help="Only use the first sentences of the file")
+    parser.add_argument("--latency_samples", type=int, default=200,
+                        help="Number of single sentence calls for the latency percentiles")
+    parser.add_argument("--num_threads", type=int, default=None, help="Number of CPU threads used by torch")
+    parser.add_argument("--output_file", type=str, default=None, help="Save the report to this json file")
+    args = parser.parse_args()
+
+    fp32_report, fp32_tags = benchmark_in_new_process("fp32", args)
+    int8_report, _ = benchmark_in_new_process("int8", args, reference_tags=fp32_tags)
+    fp32_report["tag_agreement"] = 1.0
+
+    reports = [fp32_report, int8_report]
+    if args.student_dir is not None:
+        student_report, _ = benchmark_in_new_process("student", args, reference_tags=fp32_tags)
+        reports.append(student_report)
+    for report in reports:
+        report["speedup"] = report["sentences_per_second"] / fp32_report["sentences_per_second"]
+        report["overall_f1_difference"] = report["overall_f1"] - fp32_report["overall_f1"]
+    print(pd.DataFrame(reports).set_index("backend").T.to_markdown())
+    if args.output_file:
+        with open(args.output_file, "w") as file:
+            json.dump(reports, file, indent=2)
@@ -0,0 +1,95 @@
+"""
+Micro-benchmark of the two label alignment paths of run_ner.py: the per-token loop over word_ids() against the array
+based `align_labels_with_tokens`. Both paths are run on the same tokenized batches of a prepared train.json file, alone
+and through `Dataset.map` (which converts the labels to Arrow), and their outputs are checked to be identical.
+
+Sample usage:
+    python scripts/benchmark_label_alignment.py data/system_a/train.json bert-base-cased --label_all_tokens
+"""
+
+import argparse
+import json
+import time
+
+from datasets import Dataset
+from transformers import AutoTokenizer
+
+from label_alignment import align_labels_loop, align_labels_with_tokens, build_b_to_i_label
+
+
+def time_alignment(align_fn, batches, label_to_id, b_to_i_label, label_all_tokens, repeats):
+    """
+    Time `align_fn` alone and together with the conversion of its output to Arrow by `Dataset.map`, which is what
+    run_ner.py pays for. Returns the best times over the repeats and the aligned labels as lists.
+    """
+    align_time, map_time, aligned = None, None, None
+    batch_index = Dataset.from_dict({"batch": list(range(len(batches)))})
+
+    def align_batch(examples):
+        encoding, labels = batches[examples["batch"][0]]
+        return {"labels": align_fn(encoding, labels, label_to_id, b_to_i_label, label_all_tokens)}
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for encoding, labels in batches:
+            align_fn(encoding, labels, label_to_id, b_to_i_label, label_all_tokens)
+        elapsed = time.perf_counter() - start
+        align_time = elapsed if align_time is None else min(align_time, elapsed)
+
+        start = time.perf_counter()
+        # A fixed fingerprint keeps datasets from hashing the tokenized batches captured by align_batch.
+        aligned = batch_index.map(align_batch, batched=True, batch_size=1, remove_columns=["batch"],
+                                  keep_in_memory=True, new_fingerprint=align_fn.__name__)
+        elapsed = time.perf_counter() - start
+        map_time = elapsed if map_time is None else min(map_time, elapsed)
+    return align_time, map_time, aligned["labels"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the label alignment of run_ner.py")
+    parser.add_argument("train_file", type=str, help="A prepared train.json file")
+    parser.add_argument("tokenizer_name", type=str, help="Name or path of the tokenizer")
+    parser.add_argument("--batch_size", type=int, default=1000, help="Batch size of the datasets map in run_ner.py")
+    parser.add_argument("--max_seq_length", type=int, default=None, help="Truncation length of the tokenizer")
+    parser.add_argument("--max_examples", type=int, default=None, help="Only use the first examples of the file")
+    parser.add_argument("--label_all_tokens", action="store_true", help="Label all the sub-words of a word")
+    parser.add_argument("--repeats", type=int, default=3, help="The best time over this many repeats is reported")
+    args = parser.parse_args()
+
+    tokens, tags = [], []
+    with open(args.train_file, "r") as file:
+        for line in file:
+            entry = json.loads(line)
+            tokens.append(entry["tokens"])
+            tags.append(entry["ner_tags"])
+            if args.max_examples is not None and len(tokens) >= args.max_examples:
+                break
+
+    label_list = sorted({tag for example in tags for tag in example})
+    label_to_id = {l: i for i, l in enumerate(label_list)}
+    b_to_i_label = build_b_to_i_label(label_list)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name, use_fast=True)
+    batches = []
+    for start in range(0, len(tokens), args.batch_size):
+        encoding = tokenizer(
+            tokens[start:start + args.batch_size],
+            truncation=True,
+            max_length=args.max_seq_length,
+            is_split_into_words=True,
+        )
+        batches.append((encoding, tags[start:start + args.batch_size]))
+    token_count = sum(len(ids) for encoding, _ in batches for ids in encoding["input_ids"])
+
+    loop_times = time_alignment(
+        align_labels_loop, batches, label_to_id, b_to_i_label, args.label_all_tokens, args.repeats
+    )
+    array_times = time_alignment(
+        align_labels_with_tokens, batches, label_to_id, b_to_i_label, args.label_all_tokens, args.repeats
+    )
+    assert loop_times[2] == array_times[2], "The two alignment paths produced different labels"
+
+    print(f"{len(tokens)} examples, {token_count} sub-words, label_all_tokens={args.label_all_tokens}")
+    for name, (loop_time, array_time) in [("alignment", loop_times[:1] + array_times[:1]),
+                                          ("alignment + Arrow", (loop_times[1], array_times[1]))]:
+        print(f"{name}: loop {loop_time:.3f}s, array {array_time:.3f}s, speed-up {loop_time / array_time:.2f}x")
@@ -0,0 +1,161 @@
+"""
+Load generator for the tagging service of serve.py: latency percentiles and throughput at several concurrency levels.
+
+Every level opens `concurrency` keep-alive connections which send the sentences of a prepared test split, one request
+after the other, until `--requests` requests have been answered. A request holds `--sentences_per_request` sentences
+(pre-tokenized). The service is started on a free local port for the run when a model directory is given, or an
+already running service is targeted with --host and --port.
+
+Sample usage:
+    python scripts/benchmark_serving.py data/system_a/test.json --model_dir saved_models/system_a/bert-base-cased_42 \
+        --concurrency 1 4 16 64 --requests 2000 --output_file serving_report.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from inference import read_sentences
+
+
+async def post(reader, writer, host, body):
+    """
+    Send a POST /tag request on a keep-alive connection and return the decoded response.
+    """
+    writer.write(
+        (f"POST /tag HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+         f"Content-Length: {len(body)}\r\n\r\n").encode("latin-1") + body
+    )
+    await writer.drain()
+    status_line = await reader.readline()
+    content_length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            content_length = int(value)
+    payload = await reader.readexactly(content_length)
+    if int(status_line.split()[1]) != 200:
+        raise RuntimeError(f"{status_line.decode().strip()}: {payload.decode()}")
+    return json.loads(payload)
+
+
+async def run_level(host, port, bodies, concurrency, num_requests):
+    """
+    Send `num_requests` requests over `concurrency` connections. Returns the latency of every request in seconds and
+    the wall time of the level.
+    """
+    latencies = []
+    next_request = iter(range(num_requests))
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for index in next_request:
+                start = time.perf_counter()
+                await post(reader, writer, host, bodies[index % len(bodies)])
+                latencies.append(time.perf_counter() - start)
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return np.array(latencies), time.perf_counter() - start
+
+
+def benchmark(host, port, bodies, concurrency_levels, num_requests, sentences_per_request, words_per_request):
+    reports = []
+    # Warm-up: the first batches allocate the buffers of the kernels
+    asyncio.run(run_level(host, port, bodies, max(concurrency_levels), min(num_requests, 4 * max(concurrency_levels))))
+    for concurrency in concurrency_levels:
+        latencies, elapsed = asyncio.run(run_level(host, port, bodies, concurrency, num_requests))
+        reports.append({
+            "concurrency": concurrency,
+            "requests": len(latencies),
+            "latency_p50_ms": float(np.percentile(latencies, 50)) * 1000,
+            "latency_p99_ms": float(np.percentile(latencies, 99)) * 1000,
+            "requests_per_second": len(latencies) / elapsed,
+            "sentences_per_second": len(latencies) * sentences_per_request / elapsed,
+            "words_per_second": len(latencies) * words_per_request / elapsed,
+        })
+    return reports
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(host, port, process, timeout=300):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The service exited with code {process.returncode}")
+        try:
+            with socket.create_connection((host, port), timeout=1) as sock:
+                sock.sendall(f"GET /health HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode("latin-1"))
+                if sock.recv(64).startswith(b"HTTP/1.1 200"):
+                    return
+        except OSError:
+            time.sleep(0.5)
+    raise TimeoutError(f"The service did not start within {timeout} seconds")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the latency and throughput of the tagging service.")
+    parser.add_argument("test_file", type=str, help="A prepared test.json or test.parquet file (or one sentence per line)")
+    parser.add_argument("--model_dir", type=str, default=None,
+                        help="Start serve.py with this model for the benchmark (default: use a running service)")
+    parser.add_argument("--serve_args", type=str, nargs=argparse.REMAINDER, default=[],
+                        help="Options passed on to serve.py, e.g. --serve_args --max_wait_ms 2 --workers 2 (last)")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address of the service")
+    parser.add_argument("--port", type=int, default=None, help="Port of the service (default: 8080, or a free port)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64],
+                        help="Numbers of concurrent clients")
+    parser.add_argument("--requests", type=int, default=1000, help="Number of requests per concurrency level")
+    parser.add_argument("--sentences_per_request", type=int, default=1, help="Number of sentences per request")
+    parser.add_argument("--max_sentences", type=int, default=10000, help="Only use the first sentences of the file")
+    parser.add_argument("--output_file", type=str, default=None, help="Save the report to this json file")
+    args = parser.parse_args()
+
+    sentences = [sentence for _, sentence in zip(range(args.max_sentences), read_sentences(args.test_file))]
+    chunks = [sentences[i:i + args.sentences_per_request] for i in range(0, len(sentences), args.sentences_per_request)]
+    bodies = [json.dumps({"tokens": chunk}).encode("utf-8") for chunk in chunks]
+    words_per_request = sum(len(sentence) for sentence in sentences) / len(chunks)
+
+    process = None
+    port = args.port
+    if args.model_dir is not None:
+        port = port or free_port()
+        serve_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "serve.py")
+        process = subprocess.Popen(
+            [sys.executable, serve_script, args.model_dir, "--host", args.host, "--port", str(port), *args.serve_args],
+            stdout=subprocess.DEVNULL,
+        )
+    port = port or 8080
+
+    try:
+        if process is not None:
+            wait_until_ready(args.host, port, process)
+        reports = benchmark(args.host, port, bodies, args.concurrency, args.requests, args.sentences_per_request,
+                            words_per_request)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    print(pd.DataFrame(reports).set_index("concurrency").to_markdown())
+    if args.output_file:
+        with open(args.output_file, "w") as file:
+            json.dump(reports, file, indent=2)
@@ -0,0 +1,131 @@
+"""
+Step-time benchmark of the weighted loss of TrainerWeightedLoss against its previous implementation, which built a new
+CrossEntropyLoss and a host-side ignore index tensor at every step and let the model compute its own loss before
+computing the weighted one over the flattened logits.
+
+Both versions run the forward and backward pass of the same model on the same random batches (with padding and
+ignored sub-words, like the batches of run_ner.py), and their losses are checked to match.
+
+Sample usage:
+    python scripts/benchmark_weighted_loss.py saved_models/system_a/bert-base-cased_42 --device cuda --fp16
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from torch.nn import CrossEntropyLoss
+from transformers import AutoModelForTokenClassification
+
+from Custom_Trainer import WeightedTokenLoss
+
+
+def previous_weighted_loss(model, inputs, class_weights, num_labels):
+    """
+    The loss of TrainerWeightedLoss.compute_loss before it was reworked.
+    """
+    outputs = model(**inputs)
+    labels = inputs["labels"]
+    attention_mask = inputs["attention_mask"]
+    logits = outputs["logits"]
+    loss_fct = CrossEntropyLoss(weight=class_weights)
+    active_loss = attention_mask.view(-1) == 1
+    active_logits = logits.view(-1, num_labels)
+    active_labels = torch.where(
+        active_loss, labels.view(-1), torch.tensor(loss_fct.ignore_index).type_as(labels)
+    )
+    return loss_fct(active_logits, active_labels)
+
+
+def weighted_loss(model, inputs, loss_fct):
+    outputs = model(**{key: value for key, value in inputs.items() if key != "labels"})
+    return loss_fct(outputs["logits"], inputs["labels"])
+
+
+def random_batches(num_batches, batch_size, max_length, vocab_size, num_labels, device, seed=0):
+    """
+    Random batches of padded sequences of random lengths, where padding, the first and last (special) tokens and a
+    share of the other positions (non-first sub-words) have the label -100.
+    """
+    rng = np.random.default_rng(seed)
+    batches = []
+    for _ in range(num_batches):
+        lengths = rng.integers(max_length // 4, max_length + 1, size=batch_size)
+        positions = np.arange(max_length)
+        attention_mask = (positions < lengths[:, None]).astype(np.int64)
+        input_ids = rng.integers(1, vocab_size, size=(batch_size, max_length)) * attention_mask
+        labels = rng.integers(0, num_labels, size=(batch_size, max_length))
+        ignored = (attention_mask == 0) | (positions == 0) | (positions == lengths[:, None] - 1)
+        ignored |= rng.random((batch_size, max_length)) < 0.2
+        labels[ignored] = -100
+        batches.append({
+            "input_ids": torch.from_numpy(input_ids).to(device),
+            "attention_mask": torch.from_numpy(attention_mask).to(device),
+            "labels": torch.from_numpy(labels).to(device),
+        })
+    return batches
+
+
+def time_steps(loss_fn, model, batches, autocast_dtype, warmup):
+    """
+    Time the forward and backward pass of every batch. Returns the mean step time after the warmup steps.
+    """
+    for step, inputs in enumerate(batches):
+        if step == warmup:
+            if inputs["input_ids"].is_cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        with torch.autocast(inputs["input_ids"].device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+            loss = loss_fn(model, inputs)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+    if batches[0]["input_ids"].is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / (len(batches) - warmup)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the weighted loss of TrainerWeightedLoss")
+    parser.add_argument("model_name_or_path", type=str, help="A token classification model (or a base model)")
+    parser.add_argument("--num_labels", type=int, default=None, help="Number of labels if the model has no head")
+    parser.add_argument("--batch_size", type=int, default=16, help="Number of sentences per batch")
+    parser.add_argument("--max_length", type=int, default=128, help="Padded length of the batches")
+    parser.add_argument("--steps", type=int, default=50, help="Number of timed steps")
+    parser.add_argument("--warmup", type=int, default=5, help="Number of untimed steps before the timed ones")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--fp16", action="store_true", help="Run the steps under float16 autocast")
+    parser.add_argument("--bf16", action="store_true", help="Run the steps under bfloat16 autocast")
+    args = parser.parse_args()
+
+    kwargs = {} if args.num_labels is None else {"num_labels": args.num_labels}
+    model = AutoModelForTokenClassification.from_pretrained(args.model_name_or_path, **kwargs).to(args.device)
+    model.train()
+    num_labels = model.config.num_labels
+    autocast_dtype = torch.float16 if args.fp16 else torch.bfloat16 if args.bf16 else None
+
+    class_weights = torch.rand(num_labels, generator=torch.Generator().manual_seed(0)) + 0.1
+    class_weights = (class_weights / class_weights.sum()).to(args.device)
+    loss_fct = WeightedTokenLoss(class_weights).to(args.device)
+    batches = random_batches(
+        args.warmup + args.steps, args.batch_size, args.max_length, model.config.vocab_size, num_labels, args.device
+    )
+
+    previous_time = time_steps(
+        lambda model, inputs: previous_weighted_loss(model, inputs, class_weights, num_labels),
+        model, batches, autocast_dtype, args.warmup,
+    )
+    new_time = time_steps(
+        lambda model, inputs: weighted_loss(model, inputs, loss_fct), model, batches, autocast_dtype, args.warmup
+    )
+    # The two losses are compared without dropout.
+    model.eval()
+    with torch.no_grad(), torch.autocast(args.device.split(":")[0], dtype=autocast_dtype,
+                                         enabled=autocast_dtype is not None):
+        previous_loss = previous_weighted_loss(model, batches[0], class_weights, num_labels).item()
+        new_loss = weighted_loss(model, batches[0], loss_fct).item()
+    assert np.isclose(previous_loss, new_loss, rtol=1e-3), f"Losses differ: {previous_loss} vs {new_loss}"
+
+    print(f"{args.steps} steps of {args.batch_size}x{args.max_length} on {args.device}, autocast={autocast_dtype}")
+    print(f"previous: {previous_time * 1000:.1f} ms/step, reworked: {new_time * 1000:.1f} ms/step, "
+          f"speed-up {previous_time / new_time:.2f}x")
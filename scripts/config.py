@@ -40,3 +40,12 @@ index_to_tag_mapping = {v: k for k, v in tag_to_index_mapping.items()}
 model_b_entities =  ["PER", "ORG", "LOC", "DIS", "ANIM"]
 model_b_tags = ["B-" + tag for tag in model_b_entities] + ["I-" + tag for tag in model_b_entities]
 model_b_tag_indices = [tag_to_index_mapping[tag] for tag in model_b_tags]
+
+### all the entity types of the dataset, in the order of the tag mapping
+all_entities = list(dict.fromkeys(tag[2:] for tag in tag_to_index_mapping if tag != "O"))
+
+### tag systems prepare_dataset.py knows by name: the entity types each keeps (None keeps all of them)
+tag_systems = {
+    "a": None,
+    "b": model_b_entities,
+}
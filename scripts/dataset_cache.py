@@ -0,0 +1,102 @@
+"""
+Content-addressed cache of the tokenized, label-aligned datasets of run_ner.py.
+
+The datasets library caches `map` results under a fingerprint of the mapped function, which changes with anything the
+function closes over and is invalidated by `--overwrite_cache`. The tokenized splits only depend on the tokenizer, the
+data and a few preprocessing options though, so this cache keys them on exactly that: the tokenizer (name, revision
+and a hash of its serialized definition), the hash of the data file, the label mapping and the options. All the runs of
+a sweep (whatever their seed) reuse the same entry, and a change to any of these gives a new key, so an entry never
+needs to be invalidated by hand. Entries are saved as Arrow files, which `load_from_disk` memory-maps.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from functools import lru_cache
+
+from datasets import load_from_disk
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def file_sha256(file_path, chunk_size=1 << 20):
+    """
+    Hash of the contents of a file. Every file is only hashed once per process.
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer):
+    """
+    Hash of the serialized fast tokenizer (vocabulary, normalizer, pre-tokenizer and post-processor), so that two
+    tokenizers which split text differently never share an entry even if they are loaded from the same name.
+    """
+    return hashlib.sha256(tokenizer.backend_tokenizer.to_str().encode("utf-8")).hexdigest()
+
+
+def tokenized_dataset_key(tokenizer, tokenizer_name, tokenizer_revision, data_source, label_to_id, **options):
+    """
+    The cache key of a tokenized split.
+
+    Parameters:
+    tokenizer (PreTrainedTokenizerFast): The tokenizer the split is tokenized with.
+    tokenizer_name (str): Name or path the tokenizer was loaded from.
+    tokenizer_revision (str): Revision of the tokenizer.
+    data_source (str): Identifies the raw data, e.g. the hash of the data file.
+    label_to_id (dict): Map from the labels of the dataset to the label ids of the model.
+    options: Any other option the tokenized split depends on (max_seq_length, label_all_tokens, ...).
+
+    Returns:
+    tuple: The key (a hex digest) and the description it was computed from.
+    """
+    description = {
+        "tokenizer_name": tokenizer_name,
+        "tokenizer_revision": tokenizer_revision,
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "data": data_source,
+        "label_to_id": sorted([str(label), label_id] for label, label_id in label_to_id.items()),
+        **options,
+    }
+    key = hashlib.sha256(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+    return key, description
+
+
+def load_or_build(cache_dir, key, description, build_fn, overwrite=False):
+    """
+    Load the dataset cached under `key`, or build it with `build_fn` and cache it.
+
+    The dataset is written to a temporary directory which is then renamed, so concurrent runs never see a partially
+    written entry. If two runs build the same entry at the same time, the first rename wins and both load it.
+    With `overwrite`, the entry is rebuilt and replaces the cached one.
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    if os.path.isdir(entry_dir) and not overwrite:
+        logger.info(f"Loading the tokenized dataset from the cache {entry_dir}")
+        return load_from_disk(entry_dir)
+
+    dataset = build_fn()
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = f"{entry_dir}.tmp-{os.getpid()}"
+    dataset.save_to_disk(tmp_dir)
+    with open(os.path.join(tmp_dir, "cache_key.json"), "w") as file:
+        json.dump(description, file, indent=4)
+
+    if overwrite and os.path.isdir(entry_dir):
+        # Runs that memory-map the old entry keep reading their open files after it is removed.
+        old_dir = f"{entry_dir}.old-{os.getpid()}"
+        os.rename(entry_dir, old_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+    try:
+        os.rename(tmp_dir, entry_dir)
+        logger.info(f"Saved the tokenized dataset to the cache {entry_dir}")
+    except OSError:
+        # Another run saved the same entry in the meantime.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return load_from_disk(entry_dir)
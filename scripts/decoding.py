@@ -0,0 +1,131 @@
+"""
+Constrained BIO decoding of word-level label scores, and extraction of scored entity spans.
+
+The arg-max of every word independently can give tag sequences which are not valid IOB2 (an I-Xxx tag after O, after
+B-Yyy or at the start of a sentence). The decoder finds instead the most likely valid sequence of every sentence:
+a Viterbi search over the log-probabilities of the words, where the transitions which are not allowed by the label
+list cost -inf and the others nothing. The search runs on many sentences at once, padded to the same length, with
+one (sentences, labels, labels) array operation per word position; since the allowed sequences are a subset of all
+the sequences, a valid arg-max sequence is kept as it is.
+
+The words are given as one flat (words, labels) array with the sentence offsets (the start of every sentence followed
+by the total number of words), as in span_scorer.py.
+"""
+
+import numpy as np
+
+from span_scorer import SpanScorer
+
+
+def log_softmax(logits):
+    shifted = logits - logits.max(axis=-1, keepdims=True)
+    return shifted - np.log(np.exp(shifted).sum(axis=-1, keepdims=True))
+
+
+class BIODecoder:
+    """
+    Decodes the label log-probabilities of words into valid IOB2 label ids of `label_list`.
+
+    Parameters:
+    label_list (list): The labels, in the IOB2 scheme.
+    chunk_size (int): The number of sentences decoded together (sentences of similar length are grouped).
+    """
+
+    def __init__(self, label_list, chunk_size=1024):
+        self.label_list = list(label_list)
+        self.scorer = SpanScorer(self.label_list)
+        allowed, allowed_start = self.scorer.allowed_transitions()
+        self.transition_scores = np.where(allowed, 0.0, -np.inf).astype(np.float32)
+        self.start_scores = np.where(allowed_start, 0.0, -np.inf).astype(np.float32)
+        self.chunk_size = chunk_size
+
+    def viterbi(self, scores, lengths):
+        """
+        The best valid label sequence of every sentence of a padded batch.
+
+        Parameters:
+        scores (np.ndarray): The (sentences, positions, labels) log-probabilities of the words.
+        lengths (np.ndarray): The number of words of every sentence.
+
+        Returns:
+        tuple: The (sentences, positions) label ids (0 on the padding) and the log-probability of every sequence.
+        """
+        num_sentences, max_length, num_labels = scores.shape
+        paths = np.zeros((num_sentences, max_length), dtype=np.int64)
+        if max_length == 0:
+            return paths, np.zeros(num_sentences, dtype=np.float32)
+
+        best = scores[:, 0] + self.start_scores
+        backpointers = np.zeros((num_sentences, max_length, num_labels), dtype=np.int16)
+        for position in range(1, max_length):
+            # candidates[s, i, j]: the best sequence of sentence s ending with label i, followed by label j
+            candidates = best[:, :, np.newaxis] + self.transition_scores
+            previous = candidates.argmax(axis=1)
+            step = np.take_along_axis(candidates, previous[:, np.newaxis], axis=1)[:, 0] + scores[:, position]
+            # The sentences which are already over keep their scores
+            best = np.where((position < lengths)[:, np.newaxis], step, best)
+            backpointers[:, position] = previous
+
+        rows = np.arange(num_sentences)
+        current = best.argmax(axis=1)
+        path_scores = best[rows, current]
+        for position in range(max_length - 1, -1, -1):
+            inside = position < lengths
+            paths[inside, position] = current[inside]
+            if position > 0:
+                current = np.where(inside, backpointers[rows, position, current], current)
+        return paths, path_scores
+
+    def decode(self, log_probs, offsets):
+        """
+        The best valid label ids of all the words.
+
+        Parameters:
+        log_probs (np.ndarray): The flat (words, labels) log-probabilities of the words of all the sentences.
+        offsets (np.ndarray): The sentence offsets.
+
+        Returns:
+        np.ndarray: The flat label ids of the words.
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        lengths = np.diff(offsets)
+        label_ids = np.zeros(len(log_probs), dtype=np.int64)
+        order = np.argsort(lengths, kind="stable")
+        for start in range(0, len(order), self.chunk_size):
+            chunk = order[start:start + self.chunk_size]
+            chunk_lengths = lengths[chunk]
+            mask = np.arange(chunk_lengths.max(initial=0)) < chunk_lengths[:, np.newaxis]
+            positions = (offsets[chunk][:, np.newaxis] + np.arange(mask.shape[1]))[mask]
+            scores = np.zeros(mask.shape + (len(self.label_list),), dtype=np.float32)
+            scores[mask] = log_probs[positions]
+            paths, _ = self.viterbi(scores, chunk_lengths)
+            label_ids[positions] = paths[mask]
+        return label_ids
+
+    def invalid_transitions(self, label_ids, offsets):
+        """
+        A bool array, True for the words whose label may not follow the label of the previous word (or may not start
+        the sentence).
+        """
+        label_ids = np.asarray(label_ids)
+        previous = np.empty_like(label_ids)
+        previous[1:] = label_ids[:-1]
+        invalid = np.zeros(len(label_ids), dtype=bool)
+        invalid[1:] = ~np.isfinite(self.transition_scores[previous[1:], label_ids[1:]])
+        sentence_starts = np.asarray(offsets)[:-1][np.diff(offsets) > 0]
+        invalid[sentence_starts] = ~np.isfinite(self.start_scores[label_ids[sentence_starts]])
+        return invalid
+
+    def entities(self, label_ids, log_probs, offsets):
+        """
+        The entity spans of the decoded words, with their scores: the mean probability of the labels of their words.
+
+        Returns:
+        tuple: The flat start positions, end positions (excluded), entity type indices (in `self.scorer.entity_types`)
+        and scores of the entities, in the order of their start position.
+        """
+        starts, ends, types = self.scorer.extract_entities(label_ids, offsets)
+        ends = ends + 1
+        probabilities = np.exp(log_probs[np.arange(len(label_ids)), label_ids], dtype=np.float64)
+        cumulative = np.concatenate([[0.0], np.cumsum(probabilities)])
+        return starts, ends, types, (cumulative[ends] - cumulative[starts]) / (ends - starts)
@@ -0,0 +1,229 @@
+"""
+Knowledge distillation of the seed runs of a model (the teachers) into a smaller student with run_ner.py.
+
+The soft labels are the logits of the teachers averaged over the ensemble, at the labelled positions (labels != -100)
+of the tokenized training set. They are computed once, before training, and cached as a flat (positions, labels)
+float16 array with the offsets of the rows of the training set, which the training steps memory-map: a batch reads
+the rows of its examples, in the order of their labelled positions. An entry is keyed by the tokenized training set
+(its fingerprint), the teacher checkpoints (path, size and modification time of their files) and the label list,
+so retraining a teacher gives a new entry.
+
+The student is the pre-trained model of the run with fewer transformer layers (`--student_num_layers`): evenly spaced
+layers of the pre-trained encoder are kept, the others are dropped before fine-tuning. The loss is
+`alpha * T^2 * KL(teacher || student)` at temperature T plus `(1 - alpha)` times the cross-entropy on the gold labels.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import torch
+from transformers import AutoModelForTokenClassification
+
+logger = logging.getLogger(__name__)
+
+# The column of the training set with the index of every row in the soft labels
+DISTILLATION_INDEX_COLUMN = "distillation_index"
+
+CHECKPOINT_FILES = ["config.json", "model.safetensors", "pytorch_model.bin"]
+# The indexes of the checkpoints whose weights are split into several files
+WEIGHTS_INDEX_FILES = ["model.safetensors.index.json", "pytorch_model.bin.index.json"]
+
+
+def checkpoint_fingerprint(model_dir):
+    """
+    The version (path, size and modification time of its files) of a checkpoint directory.
+    """
+    versions = []
+    for name in CHECKPOINT_FILES:
+        file_path = os.path.join(model_dir, name)
+        if os.path.exists(file_path):
+            stat = os.stat(file_path)
+            versions.append(f"{name}:{stat.st_size}:{stat.st_mtime_ns}")
+    return f"{os.path.abspath(model_dir)}:{','.join(versions)}"
+
+
+def check_teacher_dirs(teacher_dirs):
+    """
+    Check that the teachers are checkpoints saved by run_ner.py, and not e.g. the int8 or ONNX copies of one written
+    by quantize.py and export_onnx.py (which AutoModelForTokenClassification cannot load).
+    """
+    for model_dir in teacher_dirs:
+        if not os.path.exists(os.path.join(model_dir, "config.json")) or not any(
+            os.path.exists(os.path.join(model_dir, name)) for name in CHECKPOINT_FILES[1:] + WEIGHTS_INDEX_FILES
+        ):
+            raise ValueError(
+                f"The teacher {model_dir} is not a checkpoint saved by run_ner.py (the int8 and ONNX copies of "
+                "quantize.py and export_onnx.py cannot be teachers)"
+            )
+
+
+def soft_labels_key(train_fingerprint, teacher_dirs, label_list):
+    """
+    The cache key of the soft labels of a tokenized training set, and the description it is computed from.
+    """
+    description = {
+        "train_dataset": train_fingerprint,
+        "teachers": sorted(checkpoint_fingerprint(model_dir) for model_dir in teacher_dirs),
+        "label_list": list(label_list),
+    }
+    key = hashlib.sha256(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+    return key, description
+
+
+def labelled_offsets(tokenized_dataset):
+    """
+    The offsets of the labelled positions of the rows of a tokenized dataset: the start of every row followed by the
+    total number of labelled positions.
+    """
+    labels = tokenized_dataset.select_columns(["labels"]).with_format("arrow")[:].column("labels")
+    labels = labels.combine_chunks() if isinstance(labels, pa.ChunkedArray) else labels
+    row_of = pc.list_parent_indices(labels).to_numpy()
+    labelled = labels.flatten().to_numpy() != -100
+    counts = np.bincount(row_of[labelled], minlength=len(labels))
+    return np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+
+def row_positions(offsets, rows):
+    """
+    The flat labelled positions of `rows`, row after row.
+    """
+    starts, ends = offsets[rows], offsets[np.asarray(rows) + 1]
+    lengths = ends - starts
+    return np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) + np.arange(lengths.sum())
+
+
+def ensemble_logits(teacher_dirs, tokenized_dataset, data_collator, label_list, device, batch_size=64):
+    """
+    The mean logits of the teachers at the labelled positions of a tokenized dataset.
+
+    Returns:
+    tuple: The flat (positions, labels) float32 logits and the offsets of the rows.
+    """
+    offsets = labelled_offsets(tokenized_dataset)
+    logits_sum = np.zeros((offsets[-1], len(label_list)), dtype=np.float32)
+    columns = [name for name in ["input_ids", "attention_mask", "token_type_ids", "labels"]
+               if name in tokenized_dataset.column_names]
+    dataset = tokenized_dataset.select_columns(columns)
+    lengths = pc.list_value_length(dataset.with_format("arrow")[:].column("input_ids")).to_numpy()
+    # Rows of similar length are batched together
+    order = np.argsort(lengths, kind="stable")
+
+    for model_dir in teacher_dirs:
+        logger.info(f"Computing the soft labels of {model_dir}")
+        teacher = AutoModelForTokenClassification.from_pretrained(model_dir).to(device).eval()
+        # The teachers may order the labels differently
+        label_order = [int(teacher.config.label2id[label]) for label in label_list]
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            batch = data_collator([dataset[int(row)] for row in rows])
+            labels = batch.pop("labels")
+            with torch.inference_mode():
+                logits = teacher(**{key: value.to(device) for key, value in batch.items()}).logits
+            logits = logits[labels.to(device) != -100].float().cpu().numpy()
+            logits_sum[row_positions(offsets, rows)] += logits[:, label_order]
+        del teacher
+    return logits_sum / len(teacher_dirs), offsets
+
+
+class SoftLabels:
+    """
+    The cached soft labels of a training set: memory-mapped float16 logits of its labelled positions and the offsets
+    of its rows.
+    """
+
+    def __init__(self, logits, offsets):
+        self.logits = logits
+        self.offsets = offsets
+
+    @classmethod
+    def load(cls, entry_dir):
+        return cls(np.load(os.path.join(entry_dir, "logits.npy"), mmap_mode="r"),
+                   np.load(os.path.join(entry_dir, "offsets.npy")))
+
+    def save(self, entry_dir, description):
+        """
+        Save the soft labels to a temporary directory which is then renamed, as in dataset_cache.py.
+        """
+        tmp_dir = f"{entry_dir}.tmp-{os.getpid()}"
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, "logits.npy"), self.logits.astype(np.float16))
+        np.save(os.path.join(tmp_dir, "offsets.npy"), self.offsets)
+        with open(os.path.join(tmp_dir, "cache_key.json"), "w") as file:
+            json.dump(description, file, indent=4)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another run saved the same entry in the meantime.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def rows(self, rows):
+        """
+        The float32 logits of the labelled positions of `rows`, row after row (the order of `logits[labels != -100]`
+        for a batch of these rows).
+        """
+        return np.asarray(self.logits[row_positions(self.offsets, rows)], dtype=np.float32)
+
+
+def load_or_compute_soft_labels(cache_dir, teacher_dirs, tokenized_dataset, data_collator, label_list, device,
+                                batch_size=64, overwrite=False):
+    key, description = soft_labels_key(tokenized_dataset._fingerprint, teacher_dirs, label_list)
+    entry_dir = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry_dir) or overwrite:
+        logits, offsets = ensemble_logits(teacher_dirs, tokenized_dataset, data_collator, label_list, device, batch_size)
+        os.makedirs(cache_dir, exist_ok=True)
+        if overwrite and os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        SoftLabels(logits, offsets).save(entry_dir, description)
+        logger.info(f"Saved the soft labels to the cache {entry_dir}")
+    else:
+        logger.info(f"Loading the soft labels from the cache {entry_dir}")
+    return SoftLabels.load(entry_dir)
+
+
+def keep_layers(model, num_layers):
+    """
+    Keep `num_layers` evenly spaced transformer layers of a model (the first and the last one included) and drop the
+    others. The layers are the largest module list of the model whose length is the number of layers of its config.
+    """
+    layer_count = model.config.num_hidden_layers
+    if num_layers >= layer_count:
+        return model
+    layer_lists = [module for module in model.modules()
+                   if isinstance(module, torch.nn.ModuleList) and len(module) == layer_count]
+    if not layer_lists:
+        raise ValueError(f"Could not find the {layer_count} layers of the {model.config.model_type} model")
+    layers = max(layer_lists, key=lambda module: sum(parameter.numel() for parameter in module.parameters()))
+    kept = np.round(np.linspace(0, layer_count - 1, num_layers)).astype(int).tolist()
+    kept_layers = [layers[index] for index in kept]
+    for position in range(layer_count - 1, -1, -1):
+        del layers[position]
+    layers.extend(kept_layers)
+    model.config.num_hidden_layers = num_layers
+    logger.info(f"Kept the layers {kept} of the {layer_count} layers of the model")
+    return model
+
+
+def distillation_loss(student_logits, teacher_logits, labels, hard_loss, temperature=2.0, alpha=0.5):
+    """
+    The distillation loss of a batch: the KL divergence between the teacher and the student at `temperature`
+    (scaled by its square, so its gradients keep the scale of the cross-entropy) at the labelled positions, mixed
+    with the loss on the gold labels.
+
+    Parameters:
+    student_logits (torch.Tensor): The (batch, positions, labels) logits of the student.
+    teacher_logits (torch.Tensor): The (labelled positions, labels) soft labels of the batch.
+    labels (torch.Tensor): The (batch, positions) gold labels, -100 where there is no label.
+    hard_loss (torch.nn.Module): The loss on the gold labels, called with the logits and the labels.
+    """
+    student = student_logits[labels != -100].float() / temperature
+    soft_loss = torch.nn.functional.kl_div(
+        torch.log_softmax(student, dim=-1), torch.log_softmax(teacher_logits / temperature, dim=-1),
+        reduction="batchmean", log_target=True,
+    ) * temperature ** 2
+    return alpha * soft_loss + (1 - alpha) * hard_loss(student_logits, labels)
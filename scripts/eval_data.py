@@ -0,0 +1,311 @@
+"""
+Compact loading of the gold data and the predictions scored by evaluate_predictions.py.
+
+The tags of a file are encoded as a flat array of label ids together with an array of sentence offsets (the start of
+every sentence followed by the total length), and the tokens of the gold files as a flat array of token ids into a
+vocabulary. The files are parsed with pyarrow, and the encoded arrays are cached to disk as .npy files (the vocabulary
+as an Arrow file), keyed by the path, size and modification time of the source file, so later evaluations memory-map
+them instead of parsing the files again.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as pa_json
+import pyarrow.parquet as pq
+
+from parquet_data import read_label_names
+
+
+class TagArrays:
+    """
+    The tags (and optionally the tokens) of the sentences of a file.
+
+    Parameters:
+    tags (np.ndarray): The label id of every token of every sentence, an index into `labels`.
+    offsets (np.ndarray): The start of every sentence in `tags`, followed by the total length.
+    labels (list): The label names.
+    token_ids (np.ndarray): The id of every token, an index into `tokens` (gold files only).
+    tokens (pa.Array): The token vocabulary (gold files only).
+    """
+
+    def __init__(self, tags, offsets, labels, token_ids=None, tokens=None):
+        self.tags = tags
+        self.offsets = offsets
+        self.labels = list(labels)
+        self.token_ids = token_ids
+        self.tokens = tokens
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def encode(self, label_to_id):
+        """
+        The tags as ids of another label mapping.
+        """
+        lookup = np.array([label_to_id[label] for label in self.labels], dtype=np.int64)
+        return lookup[self.tags]
+
+    def select(self, keep):
+        """
+        Keep the tokens where the flat boolean mask `keep` is set; the sentences stay, possibly empty.
+        """
+        kept_before = np.concatenate([[0], np.cumsum(keep)])
+        return TagArrays(
+            self.tags[keep],
+            kept_before[self.offsets],
+            self.labels,
+            None if self.token_ids is None else self.token_ids[keep],
+            self.tokens,
+        )
+
+
+def _flat_lists(lists):
+    """
+    The flattened values and the offsets (starting at 0) of a list array.
+    """
+    lists = lists.combine_chunks() if isinstance(lists, pa.ChunkedArray) else lists
+    offsets = lists.offsets.to_numpy().astype(np.int64)
+    return lists.flatten(), offsets - offsets[0]
+
+
+def _dictionary_encode(values):
+    encoded = pc.dictionary_encode(values)
+    return encoded.indices.to_numpy(zero_copy_only=False), encoded.dictionary
+
+
+def parse_gold_file(file_path):
+    """
+    Parse a prepared json lines or Parquet file (see prepare_dataset.py) to TagArrays with tokens.
+    """
+    if file_path.endswith(".parquet"):
+        table = pq.read_table(file_path, columns=["tokens", "ner_tags"])
+        labels = read_label_names(file_path)
+        flat_tags, offsets = _flat_lists(table.column("ner_tags"))
+        tags = flat_tags.to_numpy().astype(np.int16)
+    else:
+        table = pa_json.read_json(file_path)
+        flat_tags, offsets = _flat_lists(table.column("ner_tags"))
+        tags, labels = _dictionary_encode(flat_tags)
+        tags, labels = tags.astype(np.int16), labels.to_pylist()
+    flat_tokens, _ = _flat_lists(table.column("tokens"))
+    token_ids, tokens = _dictionary_encode(flat_tokens)
+    return TagArrays(tags, offsets, labels, token_ids.astype(np.int32), tokens)
+
+
+def parse_predictions_file(file_path):
+    """
+    Parse a predictions.txt file (one line of whitespace separated tags per sentence) to TagArrays.
+    """
+    with open(file_path, "r") as file:
+        lines = file.read().split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    lists = pc.utf8_split_whitespace(pa.array(lines, type=pa.string()))
+    flat_tags, offsets = _flat_lists(lists)
+    # An empty (or space padded) line gives empty strings, which are not tags.
+    is_tag = pc.not_equal(flat_tags, "").to_numpy(zero_copy_only=False)
+    if not is_tag.all():
+        sentence_of_tag = pc.list_parent_indices(lists).to_numpy()
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(sentence_of_tag[is_tag], minlength=len(lines)))])
+        flat_tags = flat_tags.filter(pa.array(is_tag))
+    tags, labels = _dictionary_encode(flat_tags)
+    return TagArrays(tags.astype(np.int16), offsets.astype(np.int64), labels.to_pylist())
+
+
+def _cache_entry(cache_dir, file_path, kind):
+    """
+    The cache directory of the current version (path, size and modification time) of a file.
+    """
+    stat = os.stat(file_path)
+    key = hashlib.sha256(
+        f"{kind}:{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8")
+    ).hexdigest()
+    return os.path.join(cache_dir, key)
+
+
+def _publish(tmp_dir, entry_dir):
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # Another process cached the same file in the meantime.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _save_tokens(tokens, file_path):
+    with pa.OSFile(file_path, "wb") as sink:
+        with pa.ipc.new_file(sink, pa.schema([("token", pa.string())])) as writer:
+            writer.write_table(pa.table({"token": tokens}))
+
+
+def _load_tokens(file_path):
+    source = pa.memory_map(file_path, "r")
+    return pa.ipc.open_file(source).read_all().column("token").combine_chunks()
+
+
+def _save_arrays(arrays, entry_dir):
+    tmp_dir = f"{entry_dir}.tmp-{os.getpid()}-{id(arrays)}"
+    os.makedirs(tmp_dir)
+    np.save(os.path.join(tmp_dir, "tags.npy"), arrays.tags)
+    np.save(os.path.join(tmp_dir, "offsets.npy"), arrays.offsets)
+    with open(os.path.join(tmp_dir, "labels.json"), "w") as file:
+        json.dump(arrays.labels, file)
+    if arrays.token_ids is not None:
+        np.save(os.path.join(tmp_dir, "token_ids.npy"), arrays.token_ids)
+        _save_tokens(arrays.tokens, os.path.join(tmp_dir, "tokens.arrow"))
+    _publish(tmp_dir, entry_dir)
+
+
+def _load_arrays(entry_dir):
+    with open(os.path.join(entry_dir, "labels.json"), "r") as file:
+        labels = json.load(file)
+    token_ids, tokens = None, None
+    if os.path.exists(os.path.join(entry_dir, "token_ids.npy")):
+        token_ids = np.load(os.path.join(entry_dir, "token_ids.npy"), mmap_mode="r")
+        tokens = _load_tokens(os.path.join(entry_dir, "tokens.arrow"))
+    return TagArrays(
+        np.load(os.path.join(entry_dir, "tags.npy"), mmap_mode="r"),
+        np.load(os.path.join(entry_dir, "offsets.npy"), mmap_mode="r"),
+        labels,
+        token_ids,
+        tokens,
+    )
+
+
+def load_cached(file_path, parse_fn, cache_dir=None):
+    """
+    Parse `file_path` with `parse_fn`, or memory-map the arrays cached for the current version of the file.
+    """
+    if cache_dir is None:
+        return parse_fn(file_path)
+    entry_dir = _cache_entry(cache_dir, file_path, parse_fn.__name__)
+    if not os.path.isdir(entry_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        _save_arrays(parse_fn(file_path), entry_dir)
+    return _load_arrays(entry_dir)
+
+
+def load_gold(file_path, cache_dir=None):
+    return load_cached(file_path, parse_gold_file, cache_dir)
+
+
+class SeenPairIndex:
+    """
+    The (token, tag) pairs of a training file, as the sorted unique 64-bit keys `token_id * len(labels) + tag_id`,
+    where the ids index the token vocabulary and the labels of the training file.
+
+    Parameters:
+    keys (np.ndarray): The sorted unique int64 keys of the seen pairs.
+    tokens (pa.Array): The token vocabulary of the training file.
+    labels (list): The label names of the training file.
+    """
+
+    def __init__(self, keys, tokens, labels):
+        self.keys = keys
+        self.tokens = tokens
+        self.labels = list(labels)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def from_gold(cls, training_data):
+        keys = np.unique(training_data.token_ids.astype(np.int64) * len(training_data.labels) + training_data.tags)
+        return cls(keys, training_data.tokens, training_data.labels)
+
+    def contains(self, data):
+        """
+        The flat boolean mask of the tokens of the gold TagArrays `data` whose (token, tag) pair is in the index.
+        """
+        # Map the vocabulary and the labels of the data to the ids of the index (-1 if they are not in it) once,
+        # then every token with a single lookup.
+        token_ids = pc.index_in(data.tokens, value_set=self.tokens).fill_null(-1)
+        token_ids = token_ids.to_numpy(zero_copy_only=False).astype(np.int64)[data.token_ids]
+        label_to_id = {label: i for i, label in enumerate(self.labels)}
+        tag_ids = np.array([label_to_id.get(label, -1) for label in data.labels], dtype=np.int64)[data.tags]
+
+        if len(self.keys) == 0:
+            return np.zeros(len(token_ids), dtype=bool)
+        keys = token_ids * len(self.labels) + tag_ids
+        position = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return (token_ids >= 0) & (tag_ids >= 0) & (self.keys[position] == keys)
+
+    def save(self, entry_dir):
+        tmp_dir = f"{entry_dir}.tmp-{os.getpid()}-{id(self)}"
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, "keys.npy"), self.keys)
+        with open(os.path.join(tmp_dir, "labels.json"), "w") as file:
+            json.dump(self.labels, file)
+        _save_tokens(self.tokens, os.path.join(tmp_dir, "tokens.arrow"))
+        _publish(tmp_dir, entry_dir)
+
+    @classmethod
+    def load(cls, entry_dir):
+        with open(os.path.join(entry_dir, "labels.json"), "r") as file:
+            labels = json.load(file)
+        return cls(
+            np.load(os.path.join(entry_dir, "keys.npy"), mmap_mode="r"),
+            _load_tokens(os.path.join(entry_dir, "tokens.arrow")),
+            labels,
+        )
+
+
+def load_seen_pair_index(train_file_path, cache_dir=None):
+    """
+    The SeenPairIndex of a training file, built once per version of the file and memory-mapped from `cache_dir`
+    afterwards.
+    """
+    if cache_dir is None:
+        return SeenPairIndex.from_gold(parse_gold_file(train_file_path))
+    entry_dir = _cache_entry(cache_dir, train_file_path, "seen_pair_index")
+    if not os.path.isdir(entry_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        SeenPairIndex.from_gold(parse_gold_file(train_file_path)).save(entry_dir)
+    return SeenPairIndex.load(entry_dir)
+
+
+def find_gold_file(gold_data_dir, system_version, split="test"):
+    file_path = os.path.join(gold_data_dir, f"system_{system_version}", f"{split}.json")
+    if not os.path.exists(file_path):
+        # prepared with --output-format parquet
+        file_path = file_path[:-len(".json")] + ".parquet"
+    return file_path
+
+
+def find_prediction_files(dir_path, transformer_model):
+    # The fine-tuning process saves the predictions of the model in "predictions.txt" file, in a run directory named
+    # "<model>_<seed>" (e.g. "FacebookAI/xlm-roberta-base_42" for a namespaced model). The path of the run directory
+    # is matched exactly, so that e.g. "bert-base-cased" does not match the runs of "distilbert-base-cased",
+    # "bert-base-cased-student6" or the "<model>_<seed>_int8" copies of quantize.py.
+    run_dir_pattern = re.compile(rf"{re.escape(transformer_model)}_\d+")
+    prediction_files = []
+    for root, dirs, files in os.walk(dir_path):
+        run_dir = os.path.relpath(root, dir_path).replace(os.sep, "/")
+        for file in files:
+            if file.endswith('predictions.txt') and run_dir_pattern.fullmatch(run_dir):
+                prediction_files.append(os.path.join(root, file))
+    return sorted(prediction_files)
+
+
+def load_predictions(dir_path, transformer_model, cache_dir=None, num_workers=8):
+    """
+    Load the predictions of all the runs of a model, in parallel.
+
+    Returns:
+    dict: Map from the path of every predictions.txt file to its TagArrays.
+    """
+    prediction_files = find_prediction_files(dir_path, transformer_model)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        predictions = executor.map(lambda path: load_cached(path, parse_predictions_file, cache_dir), prediction_files)
+        return dict(zip(prediction_files, predictions))
@@ -0,0 +1,66 @@
+"""
+A fixed, stratified subset of the validation set for the evaluations run during training by run_ner.py.
+
+With `--eval_subset_size`, the evaluations of `--evaluation_strategy steps` (which also pick the best checkpoint with
+`--load_best_model_at_end`) score a subset of the validation sentences, and the whole validation set is only
+evaluated once, after training. The sentences are stratified by the rarest entity type they contain (the types are
+ranked by the number of validation sentences they occur in, and the sentences without entities are a stratum of their
+own). Every stratum gets a share of the subset proportional to its size, and at least one sentence, and a sentence of
+every entity type that the sampling missed is then added, so that every entity type of the validation set is scored
+by every evaluation. The subset is drawn with a fixed seed, so all the evaluations of a run, and the runs of a sweep,
+score the same sentences.
+"""
+
+import numpy as np
+
+
+def entity_type_ids(label_list):
+    """
+    The entity types of a label list (the labels without their "B-"/"I-" prefix, "O" excepted) and the type id of
+    every label (-1 for "O").
+    """
+    label_types = [None if label == "O" else label.split("-", 1)[-1] for label in label_list]
+    types = sorted({label_type for label_type in label_types if label_type is not None})
+    return types, np.array([-1 if label_type is None else types.index(label_type) for label_type in label_types])
+
+
+def stratified_subset(labels, num_words, label_list, size, seed=0):
+    """
+    The sorted indices of about `size` sentences, stratified by the rarest entity type of every sentence and covering
+    every entity type of the sentences.
+
+    Parameters:
+    labels (np.ndarray): The flat label ids of the words of all the sentences.
+    num_words (np.ndarray): The number of words of every sentence.
+    label_list (list): The label of every label id.
+    size (int): The number of sentences to draw (all of them if there are fewer).
+    seed (int): The seed of the draw.
+    """
+    num_words = np.asarray(num_words, dtype=np.int64)
+    num_sentences = len(num_words)
+    if size >= num_sentences:
+        return np.arange(num_sentences)
+
+    types, type_of_label = entity_type_ids(label_list)
+    word_types = type_of_label[np.asarray(labels, dtype=np.int64)]
+    sentence_of_word = np.repeat(np.arange(num_sentences), num_words)
+    has_type = np.zeros((num_sentences, len(types)), dtype=bool)
+    has_type[sentence_of_word[word_types >= 0], word_types[word_types >= 0]] = True
+
+    # The rank of every type from the rarest one; the stratum of a sentence is the rank of its rarest type, or
+    # len(types) for the sentences without entities
+    type_counts = has_type.sum(axis=0)
+    rarity = np.argsort(np.argsort(type_counts, kind="stable"), kind="stable")
+    strata = np.min(np.where(has_type, rarity, len(types)), axis=1, initial=len(types))
+    stratum_sizes = np.bincount(strata, minlength=len(types) + 1)
+    quotas = np.minimum(np.maximum(np.round(size * stratum_sizes / num_sentences), stratum_sizes > 0), stratum_sizes)
+
+    rng = np.random.default_rng(seed)
+    selected = np.zeros(num_sentences, dtype=bool)
+    for stratum in np.flatnonzero(quotas):
+        selected[rng.choice(np.flatnonzero(strata == stratum), int(quotas[stratum]), replace=False)] = True
+    # A type whose sentences all belong to the strata of rarer types may not have been drawn
+    for type_id in np.flatnonzero(type_counts):
+        if not has_type[selected, type_id].any():
+            selected[rng.choice(np.flatnonzero(has_type[:, type_id]))] = True
+    return np.flatnonzero(selected)
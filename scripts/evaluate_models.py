@@ -0,0 +1,144 @@
+"""
+Evaluate several models on several tag systems in parallel and save the results in a single table.
+
+Every (system, model, run) prediction file is scored by its own job on a process pool. A job memory-maps the gold data
+(and the seen pair index for --only_unseen) from the evaluation cache of evaluate_predictions.py, and returns the
+entity counts of its run; the counts of the runs of a model are then averaged exactly as evaluate_predictions.py does.
+
+Sample usage:
+    python scripts/evaluate_models.py saved_models data --models bert-base-cased roberta-base --systems a b --workers 8
+"""
+
+import argparse
+import os
+from functools import lru_cache
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from eval_data import find_gold_file, find_prediction_files, load_cached, load_gold, load_seen_pair_index, \
+    parse_predictions_file
+from evaluate_predictions import average_run_scores, check_lengths, save_table
+from span_scorer import SpanScorer
+
+
+@lru_cache(maxsize=None)
+def load_test_data(gold_data_path, only_unseen, cache_dir):
+    """
+    The gold data of a system and the mask of the tokens to score, loaded once per worker process.
+    """
+    test_data = load_gold(gold_data_path, cache_dir)
+    keep = np.ones(len(test_data.tags), dtype=bool)
+    if only_unseen:
+        seen_pair_index = load_seen_pair_index(gold_data_path.replace("test", "train"), cache_dir)
+        keep = ~seen_pair_index.contains(test_data)
+    return test_data, keep
+
+
+def score_run(job):
+    """
+    Count the entities of one prediction file.
+
+    Returns:
+    tuple: The (system, model) of the run, the labels of the gold data and the run, and the counts of `count_runs`
+    for the single run, with the entity types of these labels.
+    """
+    system_version, model, prediction_file, gold_data_path, only_unseen, cache_dir = job
+    test_data, keep = load_test_data(gold_data_path, only_unseen, cache_dir)
+    predictions = {prediction_file: load_cached(prediction_file, parse_predictions_file, cache_dir)}
+    check_lengths(test_data, predictions)
+    if only_unseen:
+        test_data, predictions = test_data.select(keep), {prediction_file: predictions[prediction_file].select(keep)}
+
+    label_list = sorted(set(test_data.labels).union(predictions[prediction_file].labels))
+    label_to_id = {l: i for i, l in enumerate(label_list)}
+    scorer = SpanScorer(label_list)
+    counts = scorer.count_runs(
+        predictions[prediction_file].encode(label_to_id)[np.newaxis], test_data.encode(label_to_id), test_data.offsets
+    )
+    return (system_version, model), label_list, counts
+
+
+def combine_run_counts(runs):
+    """
+    Stack the counts of the runs of a model on the entity types of all their labels, and average the scores.
+    """
+    scorer = SpanScorer(sorted(set().union(*(label_list for label_list, _ in runs))))
+    type_to_index = {entity_type: i for i, entity_type in enumerate(scorer.entity_types)}
+    combined = {key: np.zeros((len(runs), len(scorer.entity_types)), dtype=np.int64)
+                for key in ("true_positives", "predicted")}
+    combined["reference"] = np.zeros(len(scorer.entity_types), dtype=np.int64)
+    for run, (label_list, counts) in enumerate(runs):
+        columns = [type_to_index[entity_type] for entity_type in SpanScorer(label_list).entity_types]
+        combined["true_positives"][run, columns] = counts["true_positives"][0]
+        combined["predicted"][run, columns] = counts["predicted"][0]
+        # The same gold data for all the runs
+        combined["reference"][columns] = counts["reference"]
+    return average_run_scores(scorer, combined)
+
+
+def evaluate_models(saved_model_dir, gold_data_dir, models, systems, only_unseen=False, cache_dir=None, workers=8):
+    """
+    Score the runs of every model on every system.
+
+    Returns:
+    pd.DataFrame: The precision, recall, f1 and number of every tag, indexed by system, model and tag, with the
+    number of runs of the model.
+    """
+    jobs = []
+    for system_version in systems:
+        gold_data_path = find_gold_file(gold_data_dir, system_version)
+        # Fill the cache once, so that the workers only memory-map the gold data
+        load_test_data(gold_data_path, only_unseen, cache_dir)
+        for model in models:
+            prediction_files = find_prediction_files(os.path.join(saved_model_dir, f"system_{system_version}"), model)
+            if not prediction_files:
+                print(f"No predictions.txt is found for {model} on system {system_version}, skipping it")
+            jobs.extend((system_version, model, prediction_file, gold_data_path, only_unseen, cache_dir)
+                        for prediction_file in prediction_files)
+
+    # Runs are collected in the order of the jobs, so that they are averaged in the same order as in
+    # evaluate_predictions.py
+    runs = {}
+    with Pool(workers) as pool:
+        for key, label_list, counts in pool.imap(score_run, jobs, chunksize=max(1, len(jobs) // (workers * 4))):
+            runs.setdefault(key, []).append((label_list, counts))
+
+    rows = []
+    for (system_version, model), model_runs in runs.items():
+        scores = combine_run_counts(model_runs)
+        for tag in scores["precision"]:
+            rows.append({
+                "system": system_version, "model": model, "tag": tag, "runs": len(model_runs),
+                **{metric: scores[metric].get(tag) for metric in scores},
+            })
+    return pd.DataFrame(rows, columns=["system", "model", "tag", "runs", "precision", "recall", "f1", "number"]) \
+        .set_index(["system", "model", "tag"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='NER Tagging Evaluation of several models and systems')
+    parser.add_argument('saved_model_dir', type=str, help='Directory of saved models')
+    parser.add_argument('gold_data_dir', type=str, help='Directory of gold data')
+    parser.add_argument('--models', type=str, nargs='+', required=True, help='Transformer model names')
+    parser.add_argument('--systems', type=str, nargs='+', default=['a', 'b'], help='Systems (default: a b)')
+    parser.add_argument('--only_unseen', action='store_true',
+                        help='Only score the (token, tag) pairs which are not in the training data')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of scoring processes')
+    parser.add_argument('--output_format', type=str, default='html', choices=['csv', 'html', "markdown"],
+                        help='Output format for the results (default: html)')
+    parser.add_argument('--output_file', type=str, default=None,
+                        help='Where to save the results (default: results[-unseen].<output_format>)')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Where to cache the encoded gold data and predictions '
+                             '(default: .eval_cache in the directory of saved models)')
+    args = parser.parse_args()
+    cache_dir = args.cache_dir or os.path.join(args.saved_model_dir, ".eval_cache")
+    output_file_name = args.output_file or f"results{'-unseen' if args.only_unseen else ''}.{args.output_format}"
+
+    df = evaluate_models(args.saved_model_dir, args.gold_data_dir, args.models, args.systems, args.only_unseen,
+                         cache_dir, args.workers)
+    save_table(df, output_file_name, args.output_format)
+    print(f"The results of {len(df.index.droplevel('tag').unique())} (system, model) pairs are saved to "
+          f"{output_file_name}")
@@ -1,92 +1,226 @@
-import json
 import argparse
-from collections import defaultdict
 import os
-import evaluate
+import warnings
+import numpy as np
 import pandas as pd
 
-# Read the gold annotations from the jsonl file
-def read_gold_data(file_path):
-    gold_tags = []
-    gold_tokens = []  # To store tokens
-    with open(file_path, 'r') as file:
-        for line in file:
-            entry = json.loads(line)
-            gold_tags.append(entry['ner_tags'])
-            gold_tokens.append(entry['tokens'])  # Extract tokens
-    return gold_tags, gold_tokens
-
-
-def filter_unseen_tokens(training_tokens, training_tags,test_tokens, test_tags, test_predictions):
-    unseen_tokens_predictions = defaultdict(list)
-
-    # Flatten the training tokens list for easier membership checking
-
-    training_tokens_flat = [token for instance in training_tokens for token in instance]
-    training_tags_flat = [tag for instance in training_tags for tag in instance]
-    seen_token_tag_pairs = set(list(zip(training_tokens_flat, training_tags_flat)))
-
-    # learn a masking to mask out the (tag,token) pairs that are in the training data too
-    mask_out_predictions = []
-    for tokens, tags in zip(test_tokens, test_tags):
-        sentence_mask = []
-        # for each (token,tag) in a sentence, check if they are in the training data
-        for token, tag in zip(tokens, tags):
-            if (token, tag) not in seen_token_tag_pairs:
-                sentence_mask.append(True)
-            else:
-                sentence_mask.append(False)
-        mask_out_predictions.append(sentence_mask)
-
-    # apply the mask and leave the unseen tokens in the test data
-    masked_test_tags = [[token for token, keep in zip(tokens, mask) if keep] for tokens, mask in zip(test_tags, mask_out_predictions)]
-    masked_test_predictions = {}
+from eval_data import find_gold_file, load_gold, load_predictions, load_seen_pair_index
+from span_scorer import SpanScorer, precision_recall_f1
+
+def filter_unseen_tokens(seen_pair_index, test_data, test_predictions):
+    """
+    Keep only the test tokens whose (token, tag) pair does not occur in the training data (the SeenPairIndex of the
+    training file), in the gold tags and in the predictions of every run.
+    """
+    check_lengths(test_data, test_predictions)
+    # A single mask of the gold pairs, applied to all the runs
+    keep = ~seen_pair_index.contains(test_data)
+    masked_test_predictions = {prediction_file: predictions.select(keep)
+                               for prediction_file, predictions in test_predictions.items()}
+    return test_data.select(keep), masked_test_predictions
+
+
+def check_lengths(test_data, test_predictions):
     for prediction_file, predictions in test_predictions.items():
-        masked_test_predictions[prediction_file] = [[token for token, keep in zip(tokens, mask) if keep] for tokens, mask in zip(predictions, mask_out_predictions)]
-
-    return masked_test_tags, masked_test_predictions
-
-# The fine-tuning process saves the predictions of the model in
-# "predictions.txt" file.
-def read_predictions(dir_path, transformer_model):
-    predictions = defaultdict(list)
-    for root, dirs, files in os.walk(dir_path):
-        for file in files:
-            if file.endswith('predictions.txt') and transformer_model in root:
-                with open(os.path.join(root, file), 'r') as f:
-                    file_predictions = f.readlines()
-                    for line in file_predictions:
-                        predictions[f].append(line.strip().split())
-    return predictions
-
-
-# # Calculates scores for each tag using the 'evaluate' and seqeval library
-def calculate_scores_per_tag(true_labels, true_predictions):
-    metric = evaluate.load("seqeval")
-    final_results = defaultdict(list)
-
-    for k, v in true_predictions.items():
-        results = metric.compute(predictions=v, references=true_labels)
-        for key, value in results.items():
-            if isinstance(value, dict):
-                for n, v in value.items():
-                    final_results[f"{key}_{n}"].append(v)
-            else:
-                final_results[key].append(value)
-    mean_scores_dict = {key: sum(value) / len(value) for key, value in final_results.items()}
-
-    # Restructure the results to get more readable tables.
-    structured_scores = {}
-    for key, value in mean_scores_dict.items():
-        tag, metric = key.rsplit('_', 1)
-        if metric == "accuracy": continue
-        if metric not in structured_scores:
-            structured_scores[metric] = {}
-        structured_scores[metric][tag] = value
+        if not np.array_equal(predictions.offsets, test_data.offsets):
+            raise ValueError(f"The predictions in {prediction_file} do not have the same lengths as the gold tags")
+
+
+# Calculates scores for each tag with the span scorer, which gives the same numbers as the seqeval library.
+# All the prediction files are scored against the gold tags in a single pass over integer-encoded tags.
+def calculate_scores_per_tag(test_data, test_predictions):
+    check_lengths(test_data, test_predictions)
+    label_list = sorted(set(test_data.labels).union(*(predictions.labels for predictions in test_predictions.values())))
+    label_to_id = {l: i for i, l in enumerate(label_list)}
+    scorer = SpanScorer(label_list)
+
+    references = test_data.encode(label_to_id)
+    predictions = np.stack([predictions.encode(label_to_id) for predictions in test_predictions.values()])
+
+    counts = scorer.count_runs(predictions, references, test_data.offsets)
+    return average_run_scores(scorer, counts)
+
+
+def average_run_scores(scorer, counts):
+    """
+    Average the scores of the runs, as if the seqeval results of every run had been averaged: an entity type is
+    averaged over the runs in whose results it appears, i.e. the runs which predict it or whose gold tags contain it.
+    Returns the scores structured as {metric: {tag: score}} to get more readable tables.
+    """
+    true_positives, predicted, reference = counts["true_positives"], counts["predicted"], counts["reference"]
+    precision, recall, f1 = precision_recall_f1(true_positives, predicted, reference[np.newaxis])
+    in_results = (predicted > 0) | (reference[np.newaxis] > 0)
+
+    def mean(values):
+        return sum(values.tolist()) / len(values)
+
+    structured_scores = {"precision": {}, "recall": {}, "f1": {}, "number": {}}
+    for i, tag in enumerate(scorer.entity_types):
+        runs = in_results[:, i]
+        if not runs.any():
+            continue
+        structured_scores["precision"][tag] = mean(precision[runs, i])
+        structured_scores["recall"][tag] = mean(recall[runs, i])
+        structured_scores["f1"][tag] = mean(f1[runs, i])
+        structured_scores["number"][tag] = float(reference[i])
+
+    overall_precision, overall_recall, overall_f1 = precision_recall_f1(
+        true_positives.sum(axis=1), predicted.sum(axis=1), np.full(len(predicted), reference.sum())
+    )
+    structured_scores["precision"]["overall"] = mean(overall_precision)
+    structured_scores["recall"]["overall"] = mean(overall_recall)
+    structured_scores["f1"]["overall"] = mean(overall_f1)
 
     return structured_scores
 
 
+def count_sentences_per_tag(scorer, test_data, test_predictions):
+    """
+    The per-sentence entity counts (see SpanScorer.count_sentences) of every run, with the labels of `scorer`.
+    """
+    check_lengths(test_data, test_predictions)
+    label_to_id = {l: i for i, l in enumerate(scorer.label_list)}
+    references = test_data.encode(label_to_id)
+    predictions = np.stack([predictions.encode(label_to_id) for predictions in test_predictions.values()])
+    return scorer.count_sentences(predictions, references, test_data.offsets)
+
+
+def bootstrap_weights(num_sentences, num_samples, seed, chunk_size=100):
+    """
+    Yield the bootstrap samples of the sentences in chunks of (samples, sentences) arrays, the number of times every
+    sentence is drawn in every sample.
+    """
+    rng = np.random.default_rng(seed)
+    for start in range(0, num_samples, chunk_size):
+        size = min(chunk_size, num_samples - start)
+        yield rng.multinomial(num_sentences, np.full(num_sentences, 1 / num_sentences), size=size).astype(np.float64)
+
+
+def weighted_run_scores(sentence_counts, weights):
+    """
+    The scores averaged over the runs as in `average_run_scores`, for the sentences weighted by every row of `weights`.
+
+    Returns:
+    dict: For every metric, a (samples, types + 1) array of the scores of every entity type and the overall scores
+    (last column), NaN where an entity type is in the results of no run.
+    """
+    true_positives, predicted, reference = (sentence_counts[key] for key in ("true_positives", "predicted", "reference"))
+    num_runs, num_sentences, num_types = true_positives.shape
+
+    def resample(counts):
+        # (samples, sentences) x (sentences, runs * types) in a single matrix product
+        flat = counts.transpose(1, 0, 2).reshape(num_sentences, -1).astype(np.float64)
+        return (weights @ flat).reshape(len(weights), -1, num_types)
+
+    true_positives, predicted, reference = resample(true_positives), resample(predicted), resample(reference[np.newaxis])
+    precision, recall, f1 = precision_recall_f1(true_positives, predicted, reference)
+    in_results = (predicted > 0) | (reference > 0)
+    overall = precision_recall_f1(true_positives.sum(axis=2), predicted.sum(axis=2), reference.sum(axis=2))
+
+    scores = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for metric, values, overall_values in zip(("precision", "recall", "f1"), (precision, recall, f1), overall):
+            per_type = np.where(in_results, values, 0.0).sum(axis=1) / in_results.sum(axis=1)
+            scores[metric] = np.concatenate([per_type, overall_values.mean(axis=1, keepdims=True)], axis=1)
+    return scores
+
+
+def bootstrap_run_scores(scorer, sentence_counts, num_samples=1000, seed=42):
+    """
+    Bootstrap the averaged run scores of one or several models scored against the same gold data with `scorer`.
+    The sentences are resampled from the per-sentence counts, so every sample costs a matrix product instead of a
+    new scoring pass, and all the models are evaluated on the same samples (paired bootstrap).
+
+    Parameters:
+    sentence_counts (list): The per-sentence counts of every model, see `count_sentences_per_tag`.
+
+    Returns:
+    list: For every model, the scores of `weighted_run_scores` with one row per sample.
+    """
+    num_sentences = sentence_counts[0]["reference"].shape[0]
+    samples = [{metric: [] for metric in ("precision", "recall", "f1")} for _ in sentence_counts]
+    for weights in bootstrap_weights(num_sentences, num_samples, seed):
+        for model_samples, counts in zip(samples, sentence_counts):
+            for metric, values in weighted_run_scores(counts, weights).items():
+                model_samples[metric].append(values)
+    return [{metric: np.concatenate(values) for metric, values in model_samples.items()} for model_samples in samples]
+
+
+def _nan_quantiles(values, quantiles):
+    with warnings.catch_warnings():
+        # An entity type can be missing from every sample
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanquantile(values, quantiles, axis=0)
+
+
+def bootstrap_confidence_intervals(test_data, test_predictions, num_samples=1000, confidence=0.95, seed=42):
+    """
+    Percentile bootstrap confidence intervals of the averaged run scores of every tag.
+    Returns the bounds structured as {metric_low/metric_high: {tag: bound}}, like `average_run_scores`.
+    """
+    label_list = sorted(set(test_data.labels).union(*(predictions.labels for predictions in test_predictions.values())))
+    scorer = SpanScorer(label_list)
+    [samples] = bootstrap_run_scores(
+        scorer, [count_sentences_per_tag(scorer, test_data, test_predictions)], num_samples, seed
+    )
+    tags = scorer.entity_types + ["overall"]
+    alpha = (1 - confidence) / 2
+    intervals = {}
+    for metric, values in samples.items():
+        low, high = _nan_quantiles(values, [alpha, 1 - alpha])
+        intervals[f"{metric}_low"] = {tag: bound for tag, bound in zip(tags, low.tolist()) if not np.isnan(bound)}
+        intervals[f"{metric}_high"] = {tag: bound for tag, bound in zip(tags, high.tolist()) if not np.isnan(bound)}
+    return intervals
+
+
+def paired_bootstrap_test(test_data, test_predictions, other_predictions, num_samples=1000, confidence=0.95, seed=42):
+    """
+    Paired bootstrap comparison of the F1 scores of two models (e.g. all the runs of two transformer models) on the
+    same gold data: the difference of their averaged run F1, its confidence interval and the two-sided p-value of the
+    null hypothesis that the models are equally good, for every tag.
+    """
+    label_list = sorted(set(test_data.labels).union(
+        *(predictions.labels for predictions in [*test_predictions.values(), *other_predictions.values()])
+    ))
+    scorer = SpanScorer(label_list)
+    sentence_counts = [count_sentences_per_tag(scorer, test_data, predictions)
+                       for predictions in (test_predictions, other_predictions)]
+    samples, other_samples = bootstrap_run_scores(scorer, sentence_counts, num_samples, seed)
+
+    all_sentences = np.ones((1, len(test_data)))
+    observed = (weighted_run_scores(sentence_counts[0], all_sentences)["f1"]
+                - weighted_run_scores(sentence_counts[1], all_sentences)["f1"])[0]
+    differences = samples["f1"] - other_samples["f1"]
+    alpha = (1 - confidence) / 2
+    low, high = _nan_quantiles(differences, [alpha, 1 - alpha])
+    with np.errstate(invalid="ignore"):
+        valid = ~np.isnan(differences)
+        p_values = 2 * np.minimum((differences <= 0).sum(axis=0), (differences >= 0).sum(axis=0)) / valid.sum(axis=0)
+
+    results = {"f1_difference": {}, "f1_difference_low": {}, "f1_difference_high": {}, "p_value": {}}
+    for i, tag in enumerate(scorer.entity_types + ["overall"]):
+        if np.isnan(observed[i]):
+            continue
+        results["f1_difference"][tag] = float(observed[i])
+        results["f1_difference_low"][tag] = float(low[i])
+        results["f1_difference_high"][tag] = float(high[i])
+        results["p_value"][tag] = min(1.0, float(p_values[i]))
+    return results
+
+
+def save_table(df, output_file_name, output_format):
+    # save the DataFrame in the specified format
+    if output_format == 'csv':
+        df.to_csv(output_file_name, index=True)
+    elif output_format == 'html':
+        df.to_html(output_file_name, index=True)
+    elif output_format == 'markdown':
+        markdown_table = df.to_markdown(index=True)
+        # Write to file
+        with open(output_file_name, 'w') as file:
+            file.write(markdown_table)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='NER Tagging Evaluation')
     parser.add_argument('saved_model_dir', type=str, help='Directory of saved model')
@@ -95,37 +229,67 @@ if __name__ == "__main__":
     parser.add_argument('only_unseen', type=bool, default=True, help='Transformer model name')
     parser.add_argument('output_format', type=str, default='html', nargs='?', choices=['csv', 'html', "markdown"],
                         help='Output format for the results (default: html)')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Where to cache the encoded gold data and predictions '
+                             '(default: .eval_cache in the directory of saved models)')
+    parser.add_argument('--num_workers', type=int, default=8, help='Number of threads loading the predictions')
+    parser.add_argument('--bootstrap', type=int, default=0,
+                        help='Number of bootstrap samples of the test sentences for the confidence intervals of the '
+                             'scores (default: 0, no confidence intervals)')
+    parser.add_argument('--confidence', type=float, default=0.95, help='Confidence level of the intervals')
+    parser.add_argument('--compare_with', type=str, default=None,
+                        help='Another transformer model to compare with a paired bootstrap test (requires --bootstrap)')
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the bootstrap samples')
     args = parser.parse_args()
+    if args.compare_with and not args.bootstrap:
+        parser.error("--compare_with requires --bootstrap")
+    cache_dir = args.cache_dir or os.path.join(args.saved_model_dir, ".eval_cache")
 
     for system_version in ["a", "b"]:
         predictions_dir_path = os.path.join(args.saved_model_dir, f"system_{system_version}")
-        gold_data_path = f"{args.gold_data_dir}/system_{system_version}/test.json"
+        gold_data_path = find_gold_file(args.gold_data_dir, system_version)
 
-        test_tags, test_tokens = read_gold_data(gold_data_path)
-        predictions = read_predictions(predictions_dir_path, args.transformer_model)
+        test_data = load_gold(gold_data_path, cache_dir)
+        predictions = load_predictions(predictions_dir_path, args.transformer_model, cache_dir, args.num_workers)
         run_count = len(predictions)
         assert run_count > 0, print("No predictions.txt is found. Make sure you entered the correct path/ transformer model name")
         output_file_name = f"system-{system_version}_{args.transformer_model}_{run_count}.{args.output_format}"
 
+        other_predictions = None
+        if args.compare_with:
+            other_predictions = load_predictions(predictions_dir_path, args.compare_with, cache_dir, args.num_workers)
+            assert len(other_predictions) > 0, print(f"No predictions.txt is found for {args.compare_with}")
+            # The paired test is only meaningful between two distinct sets of runs
+            shared_runs = sorted(predictions.keys() & other_predictions.keys())
+            if shared_runs:
+                raise ValueError(f"The runs of {args.transformer_model} and {args.compare_with} overlap: {shared_runs}")
+
         if args.only_unseen:
             training_gold_data_path = gold_data_path.replace("test", "train")
-            training_tags, training_tokens = read_gold_data(training_gold_data_path)
-            test_tags, predictions = filter_unseen_tokens(training_tokens,training_tags,test_tokens, test_tags, predictions)
+            seen_pair_index = load_seen_pair_index(training_gold_data_path, cache_dir)
+            if other_predictions is not None:
+                _, other_predictions = filter_unseen_tokens(seen_pair_index, test_data, other_predictions)
+            test_data, predictions = filter_unseen_tokens(seen_pair_index, test_data, predictions)
             output_file_name = output_file_name.replace(f".{args.output_format}", f"-unseen.{args.output_format}")
 
-        scores_dict = calculate_scores_per_tag(test_tags, predictions)
+        scores_dict = calculate_scores_per_tag(test_data, predictions)
+        if args.bootstrap:
+            scores_dict.update(bootstrap_confidence_intervals(
+                test_data, predictions, args.bootstrap, args.confidence, args.seed
+            ))
 
-        df = pd.DataFrame.from_dict(scores_dict, orient='index').T
+        if args.bootstrap and other_predictions is not None:
+            comparison = paired_bootstrap_test(
+                test_data, predictions, other_predictions, args.bootstrap, args.confidence, args.seed
+            )
+            comparison_df = pd.DataFrame.from_dict(comparison, orient='index').T
+            comparison_file_name = output_file_name.replace(f"_{run_count}", f"_{run_count}_vs_{args.compare_with}")
+            save_table(comparison_df, comparison_file_name, args.output_format)
+            print(f"The comparison with {args.compare_with} for system {system_version} is saved to "
+                  f"{comparison_file_name}")
 
-        # save the DataFrame in the specified format
-        if args.output_format == 'csv':
-            df.to_csv(output_file_name, index=True)
-        elif args.output_format == 'html':
-            df.to_html(output_file_name, index=True)
-        elif args.output_format == 'markdown':
+        df = pd.DataFrame.from_dict(scores_dict, orient='index').T
+        if args.output_format == 'markdown':
             df = df.T
-            markdown_table = df.to_markdown(index=True)
-            # Write to file
-            with open(output_file_name, 'w') as file:
-                file.write(markdown_table)
-        print(f"The results for system {system_version} are saved to {output_file_name}")
\ No newline at end of file
+        save_table(df, output_file_name, args.output_format)
+        print(f"The results for system {system_version} are saved to {output_file_name}")
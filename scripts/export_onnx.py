@@ -0,0 +1,132 @@
+"""
+Export a token-classification checkpoint fine-tuned by run_ner.py to ONNX, and check that ONNX Runtime gives the same
+logits as PyTorch on a prepared test split.
+
+The model is exported with dynamic batch and sequence axes, so the length-bucketed batches of inference.py can be of
+any size. The output directory holds the ONNX graph, the config and the tokenizer; inference.py runs it with ONNX
+Runtime (`--backend onnx`, the default for such a directory) and writes the same predictions.txt format as the
+torch backend, which evaluate_predictions.py scores unchanged. Requires the onnx and onnxruntime packages.
+
+Sample usage:
+    python scripts/export_onnx.py saved_models/system_a/bert-base-cased_42 data/system_a/test.json
+"""
+
+import argparse
+import inspect
+import logging
+import os
+import sys
+
+import numpy as np
+import torch
+from transformers import AutoModelForTokenClassification
+
+from inference import ONNX_MODEL_NAME, NERTagger, ONNXNERTagger, load_tokenizer, read_sentences
+
+logger = logging.getLogger(__name__)
+
+
+class LogitsOnly(torch.nn.Module):
+    """
+    The model with named tensor inputs and the logits as its only output, the signature of the exported graph. The
+    inputs are given in the order of `input_names` and only those are passed to the model, since some models (e.g.
+    DistilBERT) take no token_type_ids.
+    """
+
+    def __init__(self, model, input_names):
+        super().__init__()
+        self.model = model
+        self.input_names = list(input_names)
+
+    def forward(self, *inputs):
+        return self.model(**dict(zip(self.input_names, inputs))).logits
+
+
+def export_onnx(model_dir, output_dir, opset_version=17):
+    """
+    Export the checkpoint in `model_dir` to `output_dir`/model.onnx, with its config and tokenizer.
+    """
+    model = AutoModelForTokenClassification.from_pretrained(model_dir).float().eval()
+    tokenizer = load_tokenizer(model_dir)
+    dummy = tokenizer([["Hello", "world"], ["Hello"]], is_split_into_words=True, padding=True, return_tensors="pt")
+    # The inputs of the model, as given by its tokenizer
+    input_names = [name for name in tokenizer.model_input_names if name in dummy]
+    if "token_type_ids" in input_names and getattr(model.config, "type_vocab_size", 0) == 0:
+        input_names.remove("token_type_ids")
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names + ["logits"]}
+
+    os.makedirs(output_dir, exist_ok=True)
+    # The TorchScript based exporter handles the dynamic axes of all the supported torch versions; newer versions
+    # default to the dynamo exporter, which needs onnxscript.
+    exporter_options = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(
+            LogitsOnly(model, input_names),
+            tuple(dummy[name] for name in input_names),
+            os.path.join(output_dir, ONNX_MODEL_NAME),
+            input_names=input_names,
+            output_names=["logits"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            **exporter_options,
+        )
+    model.config.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+
+
+def check_parity(model_dir, onnx_dir, sentences, atol=1e-4):
+    """
+    Compare the logits of PyTorch and ONNX Runtime on the real (non-padding) positions of the sentences.
+
+    Returns:
+    dict: The maximum absolute difference of the logits and the share of positions with the same arg-max label.
+    """
+    torch_tagger = NERTagger.from_pretrained(model_dir)
+    onnx_tagger = ONNXNERTagger.from_pretrained(onnx_dir)
+    max_difference, same_labels, positions = 0.0, 0, 0
+    for _, inputs, _ in torch_tagger.encode_batches(sentences):
+        mask = inputs["attention_mask"].astype(bool)
+        torch_logits = torch_tagger.predict_logits(inputs)[mask]
+        onnx_logits = onnx_tagger.predict_logits(inputs)[mask]
+        max_difference = max(max_difference, float(np.abs(torch_logits - onnx_logits).max(initial=0.0)))
+        same_labels += int((torch_logits.argmax(axis=-1) == onnx_logits.argmax(axis=-1)).sum())
+        positions += int(mask.sum())
+    return {
+        "max_abs_difference": max_difference,
+        "label_agreement": same_labels / max(positions, 1),
+        "within_tolerance": max_difference <= atol,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a checkpoint to ONNX and check its logits against PyTorch.")
+    parser.add_argument("model_dir", type=str, help="Directory of the saved model (e.g. saved_models/system_a/<model>_<seed>)")
+    parser.add_argument("test_file", type=str, nargs="?", default=None,
+                        help="A prepared test.json or test.parquet file to check the logits on")
+    parser.add_argument("--output_dir", type=str, default=None, help="Where to save the ONNX model (default: <model_dir>_onnx)")
+    parser.add_argument("--opset_version", type=int, default=17, help="ONNX opset version")
+    parser.add_argument("--max_sentences", type=int, default=1000, help="Number of test sentences of the parity check")
+    parser.add_argument("--atol", type=float, default=1e-4, help="Largest accepted difference of the logits")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=logging.INFO,
+    )
+
+    output_dir = args.output_dir or f"{args.model_dir.rstrip(os.sep)}_onnx"
+    export_onnx(args.model_dir, output_dir, args.opset_version)
+    logger.info(f"Exported the model to {os.path.join(output_dir, ONNX_MODEL_NAME)}")
+
+    if args.test_file is not None:
+        sentences = [sentence for _, sentence in zip(range(args.max_sentences), read_sentences(args.test_file))]
+        parity = check_parity(args.model_dir, output_dir, sentences, args.atol)
+        logger.info(
+            f"Parity on {len(sentences)} sentences: max abs logit difference {parity['max_abs_difference']:.2e}, "
+            f"label agreement {parity['label_agreement']:.4%}"
+        )
+        if not parity["within_tolerance"]:
+            logger.error(f"The logits differ by more than {args.atol}")
+            sys.exit(1)
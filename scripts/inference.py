@@ -0,0 +1,449 @@
+"""
+Batched inference for token-classification checkpoints fine-tuned by run_ner.py.
+
+The checkpoint is loaded once and sentences are tagged in length-bucketed batches, so a large input file can be
+tagged without the Trainer/datasets start-up cost and without the label-aligned preprocessing of the training script.
+The output has the same format as the predictions.txt file written by run_ner.py (one line of space separated tags per
+sentence), so it can be scored by evaluate_predictions.py as it is.
+
+Sample usage:
+    python scripts/inference.py saved_models/system_a/bert-base-cased_42 data/system_a/test.json --num_threads 8
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+from itertools import islice
+
+import numpy as np
+import pyarrow.parquet as pq
+import torch
+from transformers import AutoConfig, AutoModelForTokenClassification, AutoTokenizer
+
+from decoding import BIODecoder, log_softmax
+from quantize import is_quantized_checkpoint, load_quantized_model
+from span_scorer import offsets_from_lengths
+
+logger = logging.getLogger(__name__)
+
+ONNX_MODEL_NAME = "model.onnx"
+
+
+def set_num_threads(num_threads):
+    """
+    Set the number of threads torch uses on CPU. Inter-op threads can only be set once per process, before any
+    parallel work has started, so a failure there is ignored.
+    """
+    if num_threads is None:
+        return
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(num_threads)
+    except RuntimeError:
+        logger.warning("The number of inter-op threads is already fixed for this process; only intra-op threads are set.")
+
+
+def load_tokenizer(model_dir):
+    # Same special case as in run_ner.py: byte-level BPE tokenizers need a prefix space for pre-split words.
+    config = AutoConfig.from_pretrained(model_dir)
+    if config.model_type in {"bloom", "gpt2", "roberta"}:
+        return AutoTokenizer.from_pretrained(model_dir, use_fast=True, add_prefix_space=True)
+    return AutoTokenizer.from_pretrained(model_dir, use_fast=True)
+
+
+def check_same_tokenizer(model_dirs):
+    """
+    Check that checkpoints tokenize text the same way, so that their inputs can be shared.
+    """
+    definitions = set()
+    for model_dir in model_dirs:
+        definition = json.loads(load_tokenizer(model_dir).backend_tokenizer.to_str())
+        # The truncation and padding of the last call are saved with the tokenizer but do not change its tokens
+        definition.pop("truncation", None)
+        definition.pop("padding", None)
+        definitions.add(json.dumps(definition, sort_keys=True))
+    if len(definitions) > 1:
+        raise ValueError(f"The checkpoints {model_dirs} do not have the same tokenizer")
+
+
+class NERTagger:
+    """
+    Tags pre-tokenized sentences with a fine-tuned token-classification model.
+
+    Sentences are tokenized in one call to the fast tokenizer, sorted by their sub-word length and grouped into
+    batches whose padded size (batch size x longest sequence) stays under `max_batch_tokens`. Every word is labelled
+    with the prediction for its first sub-word, as in run_ner.py. Words which receive no sub-word (e.g. the tail of a
+    sentence cut by `max_seq_length`) are tagged "O" so that every output line has as many tags as input tokens.
+    With `constrained_decoding`, the tags of a sentence are instead its most likely valid IOB2 sequence.
+    """
+
+    def __init__(self, model, tokenizer, max_seq_length=None, max_batch_tokens=8192, max_batch_size=128,
+                 device="cpu", constrained_decoding=False):
+        self.model = model.to(device).eval()
+        self.device = torch.device(device)
+        self._setup(model.config, tokenizer, max_seq_length, max_batch_tokens, max_batch_size, constrained_decoding)
+
+    def _setup(self, config, tokenizer, max_seq_length, max_batch_tokens, max_batch_size, constrained_decoding):
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length or min(
+            tokenizer.model_max_length, getattr(config, "max_position_embeddings", tokenizer.model_max_length)
+        )
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+
+        id2label = config.id2label
+        self.label_list = [id2label[i] for i in range(len(id2label))]
+        self.id_to_label = np.array(self.label_list, dtype=object)
+        self.outside_id = self.label_list.index("O") if "O" in self.label_list else 0
+        # With constrained decoding, the tags of a sentence are the best valid IOB2 sequence (see decoding.py)
+        self.decoder = BIODecoder(self.label_list) if constrained_decoding else None
+
+    @classmethod
+    def from_pretrained(cls, model_dir, num_threads=None, **kwargs):
+        """
+        Load a checkpoint of run_ner.py, or an int8 checkpoint exported by quantize.py (CPU only).
+        """
+        set_num_threads(num_threads)
+        tokenizer = load_tokenizer(model_dir)
+        if is_quantized_checkpoint(model_dir):
+            if kwargs.get("device", "cpu") != "cpu":
+                raise ValueError(f"{model_dir} is an int8 checkpoint, which only runs on CPU")
+            model = load_quantized_model(model_dir)
+        else:
+            model = AutoModelForTokenClassification.from_pretrained(model_dir)
+        return cls(model, tokenizer, **kwargs)
+
+    def tag(self, sentences):
+        """
+        Tag a list of sentences, each given as a list of tokens. Returns a list of tag lists in input order.
+        """
+        label_ids = self.predict_ids(sentences)
+        return [self.id_to_label[ids].tolist() for ids in label_ids]
+
+    def tag_texts(self, texts):
+        """
+        Tag raw sentences. The text is split on whitespace, which is how the multinerd tokens were produced.
+        """
+        return self.tag([text.split() for text in texts])
+
+    def tag_stream(self, sentences, chunk_size=10000):
+        """
+        Tag an iterable of sentences chunk by chunk and yield the tag lists in input order. Batches are bucketed
+        within a chunk, so memory stays bounded by `chunk_size` however long the input is.
+        """
+        sentences = iter(sentences)
+        while True:
+            chunk = list(islice(sentences, chunk_size))
+            if not chunk:
+                break
+            yield from self.tag(chunk)
+
+    def predict_ids(self, sentences):
+        """
+        Predict label ids for every word of every sentence. Returns a list of int arrays in input order.
+        """
+        if self.decoder is not None:
+            log_probs, offsets = self.predict_word_log_probs(sentences)
+            return np.split(self.decoder.decode(log_probs, offsets), offsets[1:-1]) if sentences else []
+
+        results = [None] * len(sentences)
+        for batch_indices, inputs, batch_words in self.encode_batches(sentences):
+            predictions = self._predict_batch(inputs)
+
+            word_counts = [len(sentences[index]) for index in batch_indices]
+            for index, ids in zip(batch_indices, self._first_subword_labels(predictions, batch_words, word_counts)):
+                results[index] = ids
+        return results
+
+    def predict_word_log_probs(self, sentences):
+        """
+        The log-probabilities of the labels of every word (those of its first sub-word), as one flat (words, labels)
+        array in input order, and the sentence offsets. The words which receive no sub-word are certainly "O".
+        """
+        offsets = offsets_from_lengths([len(sentence) for sentence in sentences])
+        log_probs = np.full((offsets[-1], len(self.label_list)), -np.inf, dtype=np.float32)
+        log_probs[:, self.outside_id] = 0.0
+        for batch_indices, inputs, batch_words in self.encode_batches(sentences):
+            previous = np.full((batch_words.shape[0], 1), -1, dtype=batch_words.dtype)
+            first_subword = (batch_words >= 0) & (batch_words != np.concatenate([previous, batch_words[:, :-1]], axis=1))
+            rows, _ = np.nonzero(first_subword)
+            log_probs[offsets[batch_indices][rows] + batch_words[first_subword]] = log_softmax(
+                self.predict_logits(inputs)[first_subword]
+            )
+        return log_probs, offsets
+
+    def predict_entities(self, sentences):
+        """
+        Predict the entities of every sentence. Returns, in input order, the label ids of the words of every sentence
+        and its entities as (start, end excluded, type, score) tuples, the score being the mean probability of the
+        labels of the words of the entity.
+        """
+        decoder = self.decoder or BIODecoder(self.label_list)
+        log_probs, offsets = self.predict_word_log_probs(sentences)
+        if self.decoder is not None:
+            label_ids = decoder.decode(log_probs, offsets)
+        else:
+            label_ids = log_probs.argmax(axis=1)
+        starts, ends, types, scores = decoder.entities(label_ids, log_probs, offsets)
+
+        entities = [[] for _ in sentences]
+        sentence_starts = offsets.tolist()
+        for sentence, start, end, entity_type, score in zip(
+            (np.searchsorted(offsets, starts, side="right") - 1).tolist(), starts.tolist(), ends.tolist(),
+            types.tolist(), scores.tolist(),
+        ):
+            offset = sentence_starts[sentence]
+            entities[sentence].append((start - offset, end - offset, decoder.scorer.entity_types[entity_type], score))
+        label_ids = np.split(label_ids, offsets[1:-1]) if sentences else []
+        return label_ids, entities
+
+    def encode_batches(self, sentences):
+        """
+        Tokenize the sentences and yield the length-bucketed batches: the indices of their sentences, the padded
+        model inputs as numpy arrays and the word id of every position (-1 for special tokens and padding).
+        """
+        if not sentences:
+            return
+        encodings = self.tokenizer(
+            sentences,
+            truncation=True,
+            max_length=self.max_seq_length,
+            is_split_into_words=True,
+        )
+        input_ids = encodings["input_ids"]
+        token_type_ids = encodings.get("token_type_ids")
+        word_ids = [[-1 if w is None else w for w in encodings.word_ids(i)] for i in range(len(sentences))]
+        lengths = np.array([len(ids) for ids in input_ids])
+
+        for batch_indices in self._make_batches(lengths):
+            batch_len = lengths[batch_indices].max()
+            batch_ids = np.full((len(batch_indices), batch_len), self.tokenizer.pad_token_id, dtype=np.int64)
+            batch_words = np.full((len(batch_indices), batch_len), -1, dtype=np.int64)
+            batch_types = np.zeros((len(batch_indices), batch_len), dtype=np.int64)
+            attention_mask = np.zeros((len(batch_indices), batch_len), dtype=np.int64)
+            for row, index in enumerate(batch_indices):
+                length = lengths[index]
+                batch_ids[row, :length] = input_ids[index]
+                batch_words[row, :length] = word_ids[index]
+                attention_mask[row, :length] = 1
+                if token_type_ids is not None:
+                    batch_types[row, :length] = token_type_ids[index]
+
+            inputs = {"input_ids": batch_ids, "attention_mask": attention_mask}
+            if token_type_ids is not None:
+                inputs["token_type_ids"] = batch_types
+            yield batch_indices, inputs, batch_words
+
+    def predict_logits(self, inputs):
+        """
+        The logits of one padded batch, as a float32 numpy array.
+        """
+        inputs = {key: torch.from_numpy(value).to(self.device) for key, value in inputs.items()}
+        with torch.inference_mode():
+            return self.model(**inputs).logits.float().cpu().numpy()
+
+    def _predict_batch(self, inputs):
+        """
+        Run the model over one padded batch and return the arg-max label id of every position as a numpy array.
+        """
+        inputs = {key: torch.from_numpy(value).to(self.device) for key, value in inputs.items()}
+        with torch.inference_mode():
+            logits = self.model(**inputs).logits
+            return logits.argmax(dim=-1).cpu().numpy()
+
+    def _make_batches(self, lengths):
+        """
+        Group sentence indices into batches of similar length. A batch is closed as soon as adding the next sentence
+        would exceed `max_batch_tokens` padded positions or `max_batch_size` sentences.
+        """
+        order = np.argsort(lengths, kind="stable")
+        batches = []
+        start = 0
+        for end in range(1, len(order) + 1):
+            if end == len(order):
+                batches.append(order[start:end])
+                break
+            # order is sorted by length, so the next sentence is the longest of the candidate batch.
+            size = end - start + 1
+            if size > self.max_batch_size or size * lengths[order[end]] > self.max_batch_tokens:
+                batches.append(order[start:end])
+                start = end
+        return batches
+
+    def _first_subword_labels(self, predictions, word_ids, word_counts):
+        """
+        Map sub-word predictions back to words: each word takes the label predicted for its first sub-word.
+        """
+        previous = np.full((word_ids.shape[0], 1), -1, dtype=word_ids.dtype)
+        first_subword = (word_ids >= 0) & (word_ids != np.concatenate([previous, word_ids[:, :-1]], axis=1))
+
+        word_offsets = np.concatenate([[0], np.cumsum(word_counts)])
+        rows, _ = np.nonzero(first_subword)
+        labels = np.full(word_offsets[-1], self.outside_id, dtype=np.int64)
+        labels[word_offsets[rows] + word_ids[first_subword]] = predictions[first_subword]
+        return np.split(labels, word_offsets[1:-1])
+
+
+class ONNXNERTagger(NERTagger):
+    """
+    The NERTagger of a model exported by export_onnx.py, run with ONNX Runtime on CPU. The tokenization, batching
+    and word alignment are those of NERTagger; only the forward pass is done by the ONNX Runtime session.
+    """
+
+    def __init__(self, session, config, tokenizer, max_seq_length=None, max_batch_tokens=8192, max_batch_size=128,
+                 constrained_decoding=False):
+        self.session = session
+        self.input_names = {model_input.name for model_input in session.get_inputs()}
+        self._setup(config, tokenizer, max_seq_length, max_batch_tokens, max_batch_size, constrained_decoding)
+
+    @classmethod
+    def from_pretrained(cls, model_dir, num_threads=None, device="cpu", **kwargs):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The ONNX backend requires onnxruntime: `pip install onnxruntime`")
+        if device != "cpu":
+            raise ValueError("The ONNX backend only runs on CPU")
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, ONNX_MODEL_NAME), options, providers=["CPUExecutionProvider"]
+        )
+        return cls(session, AutoConfig.from_pretrained(model_dir), load_tokenizer(model_dir), **kwargs)
+
+    def predict_logits(self, inputs):
+        # Models without token type embeddings (e.g. RoBERTa) are exported without the token_type_ids input
+        return self.session.run(["logits"], {key: value for key, value in inputs.items() if key in self.input_names})[0]
+
+    def _predict_batch(self, inputs):
+        return self.predict_logits(inputs).argmax(axis=-1)
+
+
+class EnsembleNERTagger(NERTagger):
+    """
+    Tags with the mean logits of several checkpoints of the same model (e.g. its seed runs). The sentences are
+    tokenized and batched once, and every batch is run through all the members, so the ensemble costs one forward
+    pass per member and no extra tokenization. The members must share their tokenizer and their label map.
+    """
+
+    def __init__(self, models, tokenizer, max_seq_length=None, max_batch_tokens=8192, max_batch_size=128,
+                 device="cpu", constrained_decoding=False):
+        for model in models[1:]:
+            if model.config.id2label != models[0].config.id2label:
+                raise ValueError("The members of the ensemble do not have the same labels")
+        # A module list, so that the members are moved, evaluated and sized together
+        self.model = torch.nn.ModuleList(models).to(device).eval()
+        self.device = torch.device(device)
+        self._setup(models[0].config, tokenizer, max_seq_length, max_batch_tokens, max_batch_size,
+                    constrained_decoding)
+
+    @classmethod
+    def from_pretrained(cls, model_dirs, num_threads=None, **kwargs):
+        set_num_threads(num_threads)
+        check_same_tokenizer(model_dirs)
+        models = [AutoModelForTokenClassification.from_pretrained(model_dir) for model_dir in model_dirs]
+        return cls(models, load_tokenizer(model_dirs[0]), **kwargs)
+
+    def predict_logits(self, inputs):
+        inputs = {key: torch.from_numpy(value).to(self.device) for key, value in inputs.items()}
+        with torch.inference_mode():
+            logits = sum(model(**inputs).logits.float() for model in self.model) / len(self.model)
+            return logits.cpu().numpy()
+
+    def _predict_batch(self, inputs):
+        return self.predict_logits(inputs).argmax(axis=-1)
+
+
+def load_tagger(model_dir, backend=None, ensemble_dirs=None, **kwargs):
+    """
+    Load the tagger of a checkpoint with the "torch" or the "onnx" backend. By default, the ONNX backend is used for
+    the directories written by export_onnx.py and the torch one (fp32 or int8) for the others. With `ensemble_dirs`,
+    the tagger is the logit ensemble of the checkpoint and those (torch backend only).
+    """
+    if ensemble_dirs:
+        if backend == "onnx":
+            raise ValueError("The logit ensemble is only supported with the torch backend")
+        return EnsembleNERTagger.from_pretrained([model_dir] + list(ensemble_dirs), **kwargs)
+    if backend is None:
+        backend = "onnx" if os.path.exists(os.path.join(model_dir, ONNX_MODEL_NAME)) else "torch"
+    if backend == "onnx":
+        return ONNXNERTagger.from_pretrained(model_dir, **kwargs)
+    return NERTagger.from_pretrained(model_dir, **kwargs)
+
+
+def read_sentences(file_path):
+    """
+    Lazily read sentences from a json lines or Parquet file with a "tokens" field (the formats written by
+    prepare_dataset.py) or from a plain text file with one whitespace separated sentence per line.
+    """
+    if file_path.endswith(".parquet"):
+        for batch in pq.ParquetFile(file_path).iter_batches(columns=["tokens"]):
+            yield from batch.column("tokens").to_pylist()
+        return
+    with open(file_path, "r", encoding="utf-8") as file:
+        if file_path.endswith(".json"):
+            for line in file:
+                yield json.loads(line)["tokens"]
+        else:
+            for line in file:
+                yield line.split()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tag sentences with a fine-tuned token-classification checkpoint.")
+    parser.add_argument("model_dir", type=str,
+                        help="Directory of the saved model (e.g. saved_models/system_a/<model>_<seed>), or of its "
+                             "int8 copy exported by quantize.py")
+    parser.add_argument("input_file", type=str,
+                        help="A json lines or Parquet file with a 'tokens' field or a plain text file")
+    parser.add_argument("--output_file", type=str, default="predictions.txt", help="Where to write the predicted tags")
+    parser.add_argument("--max_seq_length", type=int, default=None, help="Maximum number of sub-words per sentence")
+    parser.add_argument("--max_batch_tokens", type=int, default=8192, help="Maximum padded positions per batch")
+    parser.add_argument("--max_batch_size", type=int, default=128, help="Maximum number of sentences per batch")
+    parser.add_argument("--chunk_size", type=int, default=10000, help="Number of sentences bucketed together")
+    parser.add_argument("--num_threads", type=int, default=None, help="Number of CPU threads used by torch")
+    parser.add_argument("--device", type=str, default="cpu", help="Device to run the model on")
+    parser.add_argument("--backend", type=str, default=None, choices=["torch", "onnx"],
+                        help="Run the model with torch or with ONNX Runtime (default: onnx for the directories "
+                             "written by export_onnx.py, torch otherwise)")
+    parser.add_argument("--constrained_decoding", action="store_true",
+                        help="Write the most likely valid IOB2 tag sequence of every sentence instead of the arg-max "
+                             "tag of every word (see decoding.py)")
+    parser.add_argument("--ensemble_dirs", type=str, nargs="+", default=None,
+                        help="Other checkpoints of the same model (e.g. its other seed runs): tag with the mean logits "
+                             "of all the checkpoints, on inputs tokenized once")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=logging.INFO,
+    )
+
+    tagger = load_tagger(
+        args.model_dir,
+        backend=args.backend,
+        ensemble_dirs=args.ensemble_dirs,
+        num_threads=args.num_threads,
+        max_seq_length=args.max_seq_length,
+        max_batch_tokens=args.max_batch_tokens,
+        max_batch_size=args.max_batch_size,
+        device=args.device,
+        constrained_decoding=args.constrained_decoding,
+    )
+    output_dir = os.path.dirname(args.output_file)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    sentence_count = 0
+    with open(args.output_file, "w") as writer:
+        for tags in tagger.tag_stream(read_sentences(args.input_file), chunk_size=args.chunk_size):
+            writer.write(" ".join(tags) + "\n")
+            sentence_count += 1
+    logger.info(f"Tagged {sentence_count} sentences, predictions are saved to {args.output_file}")
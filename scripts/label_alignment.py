@@ -0,0 +1,114 @@
+"""
+Alignment of word-level NER labels with the sub-word tokens produced by a fast tokenizer.
+"""
+
+from itertools import chain
+
+import numpy as np
+
+
+def build_b_to_i_label(label_list):
+    """
+    Map that sends the id of every B-Xxx label to the id of its I-Xxx counterpart (other labels map to themselves).
+    """
+    b_to_i_label = []
+    for idx, label in enumerate(label_list):
+        if label.startswith("B-") and label.replace("B-", "I-") in label_list:
+            b_to_i_label.append(label_list.index(label.replace("B-", "I-")))
+        else:
+            b_to_i_label.append(idx)
+    return b_to_i_label
+
+
+def encode_labels(labels, label_to_id):
+    """
+    Convert a flat sequence of labels to an array of ids.
+    """
+    return np.fromiter(map(label_to_id.__getitem__, labels), dtype=np.int64, count=len(labels))
+
+
+def align_labels_loop(tokenized_inputs, labels, label_to_id, b_to_i_label, label_all_tokens=False):
+    """
+    Compute the token-level label ids of a tokenized batch by walking the word ids of every sequence. Same arguments
+    and output as `align_labels_with_tokens`.
+    """
+    aligned = []
+    for i, label in enumerate(labels):
+        word_ids = tokenized_inputs.word_ids(batch_index=i)
+        previous_word_idx = None
+        label_ids = []
+        for word_idx in word_ids:
+            # Special tokens have a word id that is None. We set the label to -100 so they are automatically
+            # ignored in the loss function.
+            if word_idx is None:
+                label_ids.append(-100)
+            # We set the label for the first token of each word.
+            elif word_idx != previous_word_idx:
+                label_ids.append(label_to_id[label[word_idx]])
+            # For the other tokens in a word, we set the label to either the current label or -100, depending on
+            # the label_all_tokens flag.
+            else:
+                if label_all_tokens:
+                    label_ids.append(b_to_i_label[label_to_id[label[word_idx]]])
+                else:
+                    label_ids.append(-100)
+            previous_word_idx = word_idx
+
+        aligned.append(label_ids)
+    return aligned
+
+
+def align_labels_with_tokens(tokenized_inputs, labels, label_to_id, b_to_i_label, label_all_tokens=False):
+    """
+    Compute the token-level label ids of a tokenized batch, with array operations over the whole batch.
+
+    The first sub-word of every word takes the id of the word's label. The other sub-words take either -100 (so that
+    they are ignored in the loss function) or, when `label_all_tokens` is set, the I-Xxx counterpart of the label.
+    Special tokens and padding, whose word id is None, always take -100.
+
+    Parameters:
+    tokenized_inputs (BatchEncoding): The output of a fast tokenizer called with `is_split_into_words=True`.
+    labels (list): The word-level labels of every example of the batch.
+    label_to_id (dict): Map from the labels of the dataset to the label ids of the model.
+    b_to_i_label (list): Map from the id of every label to the id used for the non-first sub-words.
+    label_all_tokens (bool): Whether to label the non-first sub-words too.
+
+    Returns:
+    list: The label ids of every example, one list per tokenized sequence.
+    """
+    batch_size = len(labels)
+    if batch_size == 0:
+        return []
+    # Fast tokenizers keep one Encoding per sequence; its word ids are the ones returned by `word_ids()`.
+    word_ids = [encoding.word_ids for encoding in tokenized_inputs.encodings]
+    row_lengths = np.array([len(row) for row in word_ids], dtype=np.int64)
+    row_offsets = np.concatenate([[0], np.cumsum(row_lengths)])
+
+    # Special tokens and padding have a word id that is None, it becomes -1 here.
+    flat_word_ids = np.fromiter(
+        (-1 if word_idx is None else word_idx for word_idx in chain.from_iterable(word_ids)),
+        dtype=np.int64,
+        count=row_offsets[-1],
+    )
+
+    label_offsets = np.concatenate([[0], np.cumsum([len(label) for label in labels])]).astype(np.int64)
+    flat_label_ids = encode_labels(list(chain.from_iterable(labels)), label_to_id)
+
+    # The previous word id of the first token of every sequence is None, as in the loop over word_ids.
+    previous_word_ids = np.empty_like(flat_word_ids)
+    previous_word_ids[1:] = flat_word_ids[:-1]
+    previous_word_ids[row_offsets[:-1][row_lengths > 0]] = -1
+
+    is_word = flat_word_ids >= 0
+    first_subword = is_word & (flat_word_ids != previous_word_ids)
+    label_index = np.repeat(label_offsets[:-1], row_lengths) + flat_word_ids
+
+    aligned = np.full(len(flat_word_ids), -100, dtype=np.int64)
+    aligned[first_subword] = flat_label_ids[label_index[first_subword]]
+    if label_all_tokens:
+        other_subwords = is_word & ~first_subword
+        aligned[other_subwords] = np.asarray(b_to_i_label, dtype=np.int64)[flat_label_ids[label_index[other_subwords]]]
+
+    aligned = aligned.tolist()
+    row_offsets = row_offsets.tolist()
+    return [aligned[start:end] for start, end in zip(row_offsets[:-1], row_offsets[1:])]
@@ -0,0 +1,67 @@
+"""
+Label statistics of the training set: the label list, the number of tokens of every label and the balanced class
+weights of the weighted loss.
+
+The labels are counted over Arrow batches of the dataset (flattened and counted with `value_counts`), so memory stays
+constant however large the training set is, instead of holding every label of the dataset in a Python list.
+"""
+
+import hashlib
+import json
+import os
+from collections import Counter
+
+import numpy as np
+import pyarrow.compute as pc
+
+
+def count_labels(dataset, label_column_name, batch_size=10000):
+    """
+    Count the labels of a `datasets.Dataset` whose `label_column_name` column holds a list of labels per example.
+    """
+    counts = Counter()
+    for batch in dataset.select_columns([label_column_name]).with_format("arrow").iter(batch_size=batch_size):
+        value_counts = pc.value_counts(pc.list_flatten(batch[label_column_name]))
+        counts.update(dict(zip(value_counts.field("values").to_pylist(), value_counts.field("counts").to_pylist())))
+    return counts
+
+
+def balanced_class_weights(label_list, counts):
+    """
+    The "balanced" class weights of scikit-learn: n_samples / (n_classes * count of the class). A label that does not
+    occur in the counts gets a weight of 0.
+    """
+    label_counts = np.array([counts.get(label, 0) for label in label_list], dtype=np.float64)
+    weights = np.zeros(len(label_list))
+    np.divide(label_counts.sum(), len(label_list) * label_counts, out=weights, where=label_counts > 0)
+    return weights
+
+
+def load_or_compute_label_stats(dataset, label_column_name, cache_dir=None, data_source=None):
+    """
+    The sorted label list and the label counts of `dataset`.
+
+    When `cache_dir` and `data_source` (e.g. the hash of the train file) are given, the statistics are saved to a
+    json file in `cache_dir` keyed by the data source, and loaded from it by the following runs.
+
+    Returns:
+    tuple: The sorted label list and a dict from every label to its count.
+    """
+    stats_file = None
+    if cache_dir is not None and data_source is not None:
+        key = hashlib.sha256(json.dumps([data_source, label_column_name]).encode("utf-8")).hexdigest()
+        stats_file = os.path.join(cache_dir, f"label_stats_{key}.json")
+        if os.path.exists(stats_file):
+            with open(stats_file, "r") as file:
+                # Saved as pairs, so that integer (ClassLabel) labels keep their type.
+                counts = dict(json.load(file)["counts"])
+            return sorted(counts), counts
+
+    counts = dict(count_labels(dataset, label_column_name))
+    if stats_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f"{stats_file}.tmp-{os.getpid()}"
+        with open(tmp_file, "w") as file:
+            json.dump({"counts": sorted(counts.items())}, file)
+        os.replace(tmp_file, stats_file)
+    return sorted(counts), counts
@@ -0,0 +1,51 @@
+"""
+Parquet format of the prepared datasets.
+
+A split is saved as a Parquet file with a "tokens" column (list<string>) and a "ner_tags" column of label ids
+(list<int8>). The label names, sorted, are stored in the metadata of the file, so the ids can be decoded without the
+tag mapping of config.py. Parquet files are written and read in bulk, with no per-example json encoding or parsing.
+"""
+
+import json
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+LABEL_NAMES_KEY = b"label_names"
+
+
+def encode_tag_names(tags, label_names):
+    """
+    Encode a list array of tag names to a list array of int8 label ids, the positions of the tags in `label_names`.
+    """
+    tags = tags.combine_chunks() if isinstance(tags, pa.ChunkedArray) else tags
+    label_ids = pc.index_in(tags.flatten(), value_set=pa.array(label_names))
+    if label_ids.null_count:
+        raise ValueError(f"Found tags that are not in the label names {label_names}")
+    # The offsets of a sliced list array do not start at 0.
+    offsets = pc.subtract(tags.offsets, tags.offsets[0])
+    return pa.ListArray.from_arrays(offsets, label_ids.cast(pa.int8()))
+
+
+def with_label_names(table, label_names):
+    return table.replace_schema_metadata({**(table.schema.metadata or {}), LABEL_NAMES_KEY: json.dumps(label_names)})
+
+
+def write_parquet(table, file_path, label_names):
+    """
+    Write a table with "tokens" and "ner_tags" (tag names) columns in the prepared Parquet format.
+    """
+    table = pa.table({
+        "tokens": table.column("tokens"),
+        "ner_tags": encode_tag_names(table.column("ner_tags"), label_names),
+    })
+    pq.write_table(with_label_names(table, label_names), file_path)
+
+
+def read_label_names(file_path):
+    metadata = pq.read_schema(file_path).metadata or {}
+    if LABEL_NAMES_KEY not in metadata:
+        raise ValueError(f"{file_path} has no label names in its metadata, it was not written by prepare_dataset.py")
+    return json.loads(metadata[LABEL_NAMES_KEY])
+
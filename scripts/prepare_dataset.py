@@ -1,9 +1,18 @@
 import json
+import math
+import shutil
+import tempfile
+from multiprocessing import Pool
 
 from datasets import load_dataset
 import argparse
 import os
-from config import model_b_tags, index_to_tag_mapping
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from config import all_entities, index_to_tag_mapping, model_b_entities, tag_systems, tag_to_index_mapping
+from parquet_data import write_parquet
 from tqdm import tqdm
 
 
@@ -21,29 +30,58 @@ def check_output_dir(output_dir):
         print(f"Directory already exists: {output_dir}")
 
 
-def rename_and_filter_tags(batch, is_model_b):
-    actual_tags = []
-    for example in batch["ner_tags"]:
-        if is_model_b:
-            actual_tags.append( [index_to_tag_mapping[tag] if index_to_tag_mapping[tag] in model_b_tags else "O" for tag in example])
-        else:
-            actual_tags.append( [index_to_tag_mapping[tag] for tag in example])
-    batch["ner_tags"] = actual_tags
-    return batch
+def build_tag_lookup(entities=None):
+    """
+    Lookup table from the tag ids of the dataset to the ids of the output tags. The tags of the entity types that are
+    not in `entities` are mapped to "O" (all the tags are kept if `entities` is None).
+    """
+    tag_lookup = np.arange(len(index_to_tag_mapping), dtype=np.int32)
+    if entities is not None:
+        kept_tag_indices = [tag_to_index_mapping[prefix + entity] for entity in entities for prefix in ("B-", "I-")]
+        tag_lookup[~np.isin(tag_lookup, kept_tag_indices)] = tag_to_index_mapping["O"]
+    return tag_lookup
+
+
+def system_label_names(entities=None):
+    """
+    The sorted names of the output tags of a tag system.
+    """
+    return sorted({index_to_tag_mapping[tag_index] for tag_index in build_tag_lookup(entities).tolist()})
+
+
+def rename_and_filter_tags(batch, tag_lookup):
+    """
+    Replace the tag ids of an Arrow batch by the names of their output tags. The ids of all the examples of the batch
+    are remapped at once through `tag_lookup`, and decoded to tag names by a dictionary array.
+    """
+    tags = batch.column("ner_tags").combine_chunks()
+    tag_ids = tag_lookup[tags.flatten().to_numpy()]
+    tag_names = pa.DictionaryArray.from_arrays(
+        tag_ids, pa.array([index_to_tag_mapping[i] for i in range(len(index_to_tag_mapping))])
+    ).dictionary_decode()
+    # The offsets of a sliced list array do not start at 0.
+    offsets = pc.subtract(tags.offsets, tags.offsets[0])
+    return batch.set_column(
+        batch.schema.get_field_index("ner_tags"), "ner_tags", pa.ListArray.from_arrays(offsets, tag_names)
+    )
 
 
 def filter_dataset(dataset, lang, is_model_b):
-    # filter the dataset by language
-    filtered_dataset = {split: data.filter(lambda example: example['lang'] == lang) for split, data in dataset.items()}
+    # filter the dataset by language, with a mask over the whole lang column
+    filtered_dataset = {}
+    for split, data in dataset.items():
+        lang_mask = pc.equal(data.with_format("arrow")["lang"], lang)
+        filtered_dataset[split] = data.select(np.flatnonzero(lang_mask.to_numpy(zero_copy_only=False)))
 
     # Further filter the dataset by the specified list of tags
     # This assumes that the dataset has a structure where tags are in a list
-    filtered_dataset = {split: data.map(lambda batch: rename_and_filter_tags(batch, is_model_b),
-                                        batched=True,
-                                        batch_size=1000,
-                                        num_proc=4,
-                                        load_from_cache_file=False  # Disable caching
-                                        ) for split, data in filtered_dataset.items()}
+    tag_lookup = build_tag_lookup(model_b_entities if is_model_b else None)
+    filtered_dataset = {split: data.with_format("arrow").map(lambda batch: rename_and_filter_tags(batch, tag_lookup),
+                                                             batched=True,
+                                                             batch_size=10000,
+                                                             load_from_cache_file=False  # Disable caching
+                                                             ).with_format(None)
+                        for split, data in filtered_dataset.items()}
 
     # Output the filtered dataset
     return filtered_dataset
@@ -58,16 +96,155 @@ def save_dataset_as_json(dataset, output_dir):
     check_output_dir(output_dir)
     for split, data in dataset.items():
         with open(f"{output_dir}/{split}.json", "w", encoding="utf-8") as file:
-            for example in tqdm(data, desc=f"Saving {split} set"):
-                json_line = {
-                    "tokens": example['tokens'],
-                    "ner_tags": example['ner_tags']
-                }
-                file.write(json.dumps(json_line) + '\n')
+            # Read in Arrow batches, which is much faster than indexing the examples one by one
+            batches = data.select_columns(["tokens", "ner_tags"]).with_format("arrow").iter(batch_size=10000)
+            for batch in tqdm(batches, total=math.ceil(len(data) / 10000), desc=f"Saving {split} set"):
+                for tokens, ner_tags in zip(batch.column("tokens").to_pylist(), batch.column("ner_tags").to_pylist()):
+                    json_line = {
+                        "tokens": tokens,
+                        "ner_tags": ner_tags
+                    }
+                    file.write(json.dumps(json_line) + '\n')
 
             print(f"{split} file is saved to {output_dir}/{split}.json with {len(data)} examples.")
 
 
+def save_dataset_as_parquet(dataset, output_dir, label_names):
+    """
+    Save the filtered dataset as Parquet files, with the tags encoded as the ids of `label_names` (see parquet_data.py).
+    Each split is written in bulk from its Arrow table.
+    """
+    check_output_dir(output_dir)
+    for split, data in dataset.items():
+        write_parquet(data.select_columns(["tokens", "ner_tags"]).with_format("arrow")[:],
+                      f"{output_dir}/{split}.parquet",
+                      label_names)
+        print(f"{split} file is saved to {output_dir}/{split}.parquet with {len(data)} examples.")
+
+
+def parse_tag_system(value):
+    """
+    A tag system given on the command line: either the name of a system of `tag_systems` in config.py ("a", "b"), or
+    "<name>=<ENTITY>,<ENTITY>,..." for a custom subset of the entity types (e.g. "people=PER,ANIM").
+
+    Returns:
+    tuple: The name of the system and the entity types it keeps (None for all of them).
+    """
+    name, _, entities = value.partition("=")
+    if not entities:
+        if name.lower() not in tag_systems:
+            raise argparse.ArgumentTypeError(
+                f"Unknown tag system {name}, choose from {', '.join(tag_systems)} or give one as <name>=<ENTITY>,..."
+            )
+        return name.lower(), tag_systems[name.lower()]
+    entities = entities.split(",")
+    unknown_entities = [entity for entity in entities if entity not in all_entities]
+    if unknown_entities:
+        raise argparse.ArgumentTypeError(
+            f"Unknown entity types {', '.join(unknown_entities)}, choose from {', '.join(all_entities)}"
+        )
+    return name, entities
+
+
+def prepare_shard(data, start, end, targets, part_files, output_format="json"):
+    """
+    Prepare the examples [start, end) of a split for every target, in a single pass over them.
+
+    Parameters:
+    data (Dataset): The split of the source dataset.
+    start (int), end (int): The examples of the shard.
+    targets (dict): Map from every language to the list of (target index, tag lookup) of its targets.
+    part_files (list): The file every target writes its part of the shard to.
+    output_format (str): "json", or "parquet" to write Parquet files with tag names (encoded when they are joined).
+
+    Returns:
+    list: The number of examples written for every target.
+    """
+    counts = [0] * len(part_files)
+    if output_format == "json":
+        files = [open(part_file, "w", encoding="utf-8") for part_file in part_files]
+    else:
+        tables = [[] for _ in part_files]
+    for record_batch in data.with_format("arrow")[start:end].to_batches(max_chunksize=10000):
+        batch = pa.Table.from_batches([record_batch])
+        for lang, lang_targets in targets.items():
+            lang_batch = batch.filter(pc.equal(batch.column("lang"), lang))
+            if lang_batch.num_rows == 0:
+                continue
+            if output_format == "json":
+                tokens = lang_batch.column("tokens").to_pylist()
+            for target_index, tag_lookup in lang_targets:
+                ner_tags = rename_and_filter_tags(lang_batch.select(["tokens", "ner_tags"]), tag_lookup)
+                if output_format == "json":
+                    for example_tokens, example_tags in zip(tokens, ner_tags.column("ner_tags").to_pylist()):
+                        files[target_index].write(
+                            json.dumps({"tokens": example_tokens, "ner_tags": example_tags}) + '\n'
+                        )
+                else:
+                    tables[target_index].append(ner_tags)
+                counts[target_index] += lang_batch.num_rows
+
+    if output_format == "json":
+        for file in files:
+            file.close()
+    else:
+        schema = pa.schema([("tokens", pa.list_(pa.string())), ("ner_tags", pa.list_(pa.string()))])
+        for target_tables, part_file in zip(tables, part_files):
+            pq.write_table(pa.concat_tables(target_tables) if target_tables else schema.empty_table(), part_file)
+    return counts
+
+
+def prepare_targets(dataset, languages, systems, output_dir, per_language_dirs=True, num_workers=4,
+                    output_format="json"):
+    """
+    Prepare every combination of the languages and tag systems, reading every split of the source dataset once.
+
+    Every split is cut into shards which the worker processes prepare for all the targets at once; the parts are then
+    concatenated in order, so every output file is the same as the one of a separate run for its language and system.
+    The outputs are saved to <output_dir>/<language>/system_<name> (or <output_dir>/system_<name> without
+    `per_language_dirs`).
+    """
+    target_dirs = []
+    target_label_names = []
+    targets = {}
+    for lang in languages:
+        for name, entities in systems:
+            targets.setdefault(lang, []).append((len(target_dirs), build_tag_lookup(entities)))
+            target_label_names.append(system_label_names(entities))
+            lang_dir = os.path.join(output_dir, lang) if per_language_dirs else output_dir
+            target_dirs.append(os.path.join(lang_dir, f"system_{name}"))
+    for target_dir in target_dirs:
+        check_output_dir(target_dir)
+
+    with Pool(num_workers) as pool:
+        for split, data in dataset.items():
+            part_dir = tempfile.mkdtemp(dir=output_dir)
+            # More shards than workers, so that the workers stay busy until the end of the split
+            shard_bounds = np.linspace(0, len(data), num_workers * 4 + 1).astype(int)
+            shard_args = [
+                (data, start, end, targets,
+                 [os.path.join(part_dir, f"{shard}_{target}.{output_format}") for target in range(len(target_dirs))],
+                 output_format)
+                for shard, (start, end) in enumerate(zip(shard_bounds[:-1], shard_bounds[1:]))
+            ]
+            shard_counts = pool.starmap(prepare_shard, shard_args)
+
+            for target, target_dir in enumerate(target_dirs):
+                output_file = os.path.join(target_dir, f"{split}.{output_format}")
+                part_files = [args[4][target] for args in shard_args]
+                if output_format == "json":
+                    with open(output_file, "wb") as file:
+                        for part_file in part_files:
+                            with open(part_file, "rb") as part:
+                                shutil.copyfileobj(part, file)
+                else:
+                    table = pa.concat_tables(pq.read_table(part_file) for part_file in part_files)
+                    write_parquet(table, output_file, target_label_names[target])
+                count = sum(counts[target] for counts in shard_counts)
+                print(f"{split} file is saved to {output_file} with {count} examples.")
+            shutil.rmtree(part_dir)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Load and filter a dataset from Hugging Face.')
 
@@ -76,18 +253,40 @@ if __name__ == "__main__":
     parser.add_argument('--language', type=str, default="en", help='Language to filter the dataset by')
     parser.add_argument('--output_dir', type=str, default='data', help='Directory to save the output file')
     parser.add_argument('--tag-set', choices=['A', 'B', 'a', 'b'], default='A', help='Tag to filter the dataset by')
+    parser.add_argument('--languages', nargs='+', default=None,
+                        help='Prepare several languages in one pass, each saved to <output_dir>/<language>')
+    parser.add_argument('--tag-systems', nargs='+', type=parse_tag_system, default=None,
+                        help='Prepare several tag systems in one pass: a, b or <name>=<ENTITY>,<ENTITY>,... '
+                             'for a custom subset of the entity types')
+    parser.add_argument('--num-workers', type=int, default=4, help='Number of worker processes for several targets')
+    parser.add_argument('--output-format', choices=['json', 'parquet'], default='json',
+                        help='Save the splits as json lines or as Parquet files with integer-encoded tags')
 
     # Parse the arguments
     args = parser.parse_args()
 
     dataset = load_dataset(args.dataset_name)
     assert "ner_tags" in dataset.column_names["train"], print("The provided dataset is not a NER dataset")
-    if args.tag_set == "B":
-        is_model_b = True
-        output_dir = os.path.join(args.output_dir, "system_b")
+    if args.languages is not None or args.tag_systems is not None:
+        # Multi-target mode: all the languages and tag systems are prepared in one pass over the dataset
+        prepare_targets(dataset,
+                        args.languages or [args.language],
+                        args.tag_systems or [parse_tag_system(args.tag_set)],
+                        args.output_dir,
+                        per_language_dirs=args.languages is not None,
+                        num_workers=args.num_workers,
+                        output_format=args.output_format)
     else:
-        is_model_b = False
-        output_dir = os.path.join(args.output_dir, "system_a")
+        if args.tag_set.upper() == "B":
+            is_model_b = True
+            output_dir = os.path.join(args.output_dir, "system_b")
+        else:
+            is_model_b = False
+            output_dir = os.path.join(args.output_dir, "system_a")
 
-    filtered_dataset = filter_dataset(dataset, args.language, is_model_b)
-    save_dataset_as_json(filtered_dataset, output_dir)
+        filtered_dataset = filter_dataset(dataset, args.language, is_model_b)
+        if args.output_format == "parquet":
+            save_dataset_as_parquet(filtered_dataset, output_dir,
+                                    system_label_names(model_b_entities if is_model_b else None))
+        else:
+            save_dataset_as_json(filtered_dataset, output_dir)
@@ -24,12 +24,12 @@ import os
 import sys
 import warnings
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import List, Optional
 
 import datasets
 import evaluate
 import numpy as np
-from datasets import ClassLabel, load_dataset
+from datasets import ClassLabel, Sequence, load_dataset
 
 import transformers
 from transformers import (
@@ -44,12 +44,20 @@ from transformers import (
     TrainingArguments,
     set_seed,
 )
-from transformers.trainer_utils import get_last_checkpoint
+from transformers.trainer_utils import denumpify_detensorize, get_last_checkpoint
 from transformers.utils import check_min_version, send_example_telemetry
 from transformers.utils.versions import require_version
 
-### to be used in the weighted loss
-from sklearn.utils import class_weight
+from dataset_cache import file_sha256, load_or_build, tokenized_dataset_key
+from label_alignment import align_labels_loop, align_labels_with_tokens, build_b_to_i_label
+from label_stats import balanced_class_weights, load_or_compute_label_stats
+from parquet_data import read_label_names
+from decoding import BIODecoder, log_softmax
+from distillation import DISTILLATION_INDEX_COLUMN, check_teacher_dirs, keep_layers, load_or_compute_soft_labels
+from eval_subset import stratified_subset
+from span_scorer import SpanScorer, add_counts, offsets_from_lengths
+from windowing import WINDOW_COLUMNS, WindowMerger, WindowStream, window_columns, word_labels
+
 import torch
 
 # Will error if the minimal version of Transformers is not installed. Remove at your own risks.
@@ -112,6 +120,27 @@ class ModelArguments:
         default=False,
         metadata={"help": "Will enable to load a pretrained model whose head dimensions are different."},
     )
+    teacher_model_dirs: Optional[List[str]] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Fine-tuned checkpoints (e.g. the seed runs of a model) whose averaged logits are distilled into the "
+                "trained model. They must use the tokenizer of the trained model and the same labels."
+            )
+        },
+    )
+    student_num_layers: Optional[int] = field(
+        default=None,
+        metadata={"help": "Only keep this many evenly spaced transformer layers of the pre-trained model."},
+    )
+    distillation_temperature: float = field(
+        default=2.0,
+        metadata={"help": "The temperature of the teacher and student distributions in the distillation loss."},
+    )
+    distillation_alpha: float = field(
+        default=0.5,
+        metadata={"help": "The weight of the distillation loss; the loss on the gold labels has weight 1 - alpha."},
+    )
 
 
 @dataclass
@@ -147,6 +176,15 @@ class DataTrainingArguments:
     overwrite_cache: bool = field(
         default=False, metadata={"help": "Overwrite the cached training and evaluation sets"}
     )
+    tokenized_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Where to cache the tokenized datasets. The cache is keyed by the tokenizer, the data files, the label "
+                "mapping and the preprocessing options, so it can be shared by all the runs (and seeds) of a sweep."
+            )
+        },
+    )
     use_weighted_loss: Optional[bool] = field(
         default=False, metadata={"help": "Enable weighted loss for training"}
     )
@@ -192,6 +230,17 @@ class DataTrainingArguments:
             )
         },
     )
+    eval_subset_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": (
+                "If set, the evaluations during training (e.g. with --evaluation_strategy steps, which also select the "
+                "best checkpoint with --load_best_model_at_end) score a fixed subset of about this many validation "
+                "examples, stratified so that every entity type is covered, and the whole validation set is only "
+                "evaluated after training. The time saved is reported with the eval metrics."
+            )
+        },
+    )
     max_predict_samples: Optional[int] = field(
         default=None,
         metadata={
@@ -210,10 +259,62 @@ class DataTrainingArguments:
             )
         },
     )
+    vectorized_label_alignment: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether to align the labels with the tokens using array operations over the whole batch instead of "
+                "a loop over the word ids of every example. Both produce the same labels; use "
+                "scripts/benchmark_label_alignment.py to compare them on your data and tokenizer."
+            )
+        },
+    )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": (
+                "If set, the training batches group sentences of similar length and hold at most this many padded "
+                "tokens, instead of a fixed number of sentences (--per_device_train_batch_size is then ignored)."
+            )
+        },
+    )
+    sliding_window: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether to split the examples longer than max_seq_length into overlapping windows instead of "
+                "truncating them. Every word is evaluated and predicted, with the prediction of the window in which it "
+                "is the most central."
+            )
+        },
+    )
+    window_stride: int = field(
+        default=128,
+        metadata={"help": "The number of tokens shared by consecutive windows with --sliding_window."},
+    )
+    constrained_decoding: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether to predict the most likely valid IOB2 tag sequence of every sentence (a Viterbi search over "
+                "the label probabilities of its words) instead of the arg-max tag of every word, for the evaluation "
+                "and the predictions."
+            )
+        },
+    )
     return_entity_level_metrics: bool = field(
         default=False,
         metadata={"help": "Whether to return all the entity levels during evaluation or just the overall ones."},
     )
+    stream_predictions: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether to write predictions.txt batch by batch during prediction instead of collecting the logits "
+                "of the whole test set first. Keeps the memory bounded by the batch size on large test files."
+            )
+        },
+    )
 
     def __post_init__(self):
         if self.dataset_name is None and self.train_file is None and self.validation_file is None:
@@ -221,13 +322,82 @@ class DataTrainingArguments:
         else:
             if self.train_file is not None:
                 extension = self.train_file.split(".")[-1]
-                assert extension in ["csv", "json"], "`train_file` should be a csv or a json file."
+                assert extension in ["csv", "json", "parquet"], "`train_file` should be a csv, a json or a parquet file."
             if self.validation_file is not None:
                 extension = self.validation_file.split(".")[-1]
-                assert extension in ["csv", "json"], "`validation_file` should be a csv or a json file."
+                assert extension in ["csv", "json", "parquet"], (
+                    "`validation_file` should be a csv, a json or a parquet file."
+                )
         self.task_name = self.task_name.lower()
 
 
+def predict_streaming(trainer, predict_dataset, label_list, output_predictions_file, span_scorer, windows=None,
+                      outside_id=0, decoder=None):
+    """
+    Predict the test set batch by batch and append the predicted tags of every batch to `output_predictions_file`.
+
+    Unlike `trainer.predict`, neither the logits nor the predictions are accumulated: the arg-max is taken on the
+    device, and the entities of every batch are counted by `span_scorer` and added to those of the previous batches,
+    so the memory is bounded by the batch size. Returns the summed counts (see `SpanScorer.count`).
+
+    With the `(WindowMerger, word label ids)` of a windowed test set, the predictions of the windows are merged back
+    to the words of an example as soon as its last window is predicted (the windows of an example are consecutive
+    rows of the test set), and the example is then written and counted.
+
+    With a BIODecoder, the tags of every sentence are decoded from the log-probabilities of its first sub-words
+    instead; with windows, the log-probabilities are kept until the last window of their example is predicted.
+    """
+    id_to_label = np.array(label_list, dtype=object)
+    dataloader = trainer.get_test_dataloader(predict_dataset)
+    model = trainer.model
+    model.eval()
+
+    if windows is not None:
+        merger, word_label_ids = windows
+        if decoder is None:
+            stream = WindowStream(merger, outside_id)
+        else:
+            stream = WindowStream(
+                merger, np.where(np.arange(len(label_list)) == outside_id, 0.0, -np.inf).astype(np.float32)
+            )
+        word_start = 0
+
+    counts = None
+    with open(output_predictions_file, "w") as writer, torch.inference_mode():
+        for batch in dataloader:
+            labels = batch.pop("labels").to(trainer.args.device)
+            batch = {key: value.to(trainer.args.device) for key, value in batch.items()}
+            with trainer.autocast_smart_context_manager():
+                logits = model(**batch).logits
+
+            # Remove ignored index (special tokens and sub-words other than the first one)
+            mask = labels != -100
+            lengths = mask.sum(dim=1).cpu().numpy()
+            labels = labels[mask].cpu().numpy()
+            if decoder is None:
+                predictions = logits.argmax(dim=-1)[mask].cpu().numpy().astype(np.int16)
+            else:
+                predictions = torch.log_softmax(logits[mask].float(), dim=-1).cpu().numpy()
+
+            if windows is not None:
+                # The words of the examples whose last window is in the batch
+                predictions, lengths = stream.add(predictions, len(mask))
+                if len(lengths) == 0:
+                    continue
+                labels = word_label_ids[word_start:word_start + len(predictions)]
+                word_start += len(predictions)
+            if decoder is not None:
+                predictions = decoder.decode(predictions, offsets_from_lengths(lengths)).astype(np.int16)
+
+            for prediction in np.split(id_to_label[predictions], np.cumsum(lengths)[:-1]):
+                writer.write(" ".join(prediction) + "\n")
+            counts = add_counts(counts, span_scorer.count(predictions, labels, offsets_from_lengths(lengths)))
+
+    if windows is not None and not stream.is_complete():
+        raise ValueError("Some examples of the test set have not been predicted")
+    return counts
+
+
 def main():
     # See all possible arguments in src/transformers/training_args.py
     # or by passing the --help flag to this script.
@@ -250,6 +420,11 @@ def main():
             raise ValueError("`token` and `use_auth_token` are both specified. Please set only the argument `token`.")
         model_args.token = model_args.use_auth_token
 
+    if data_args.stream_predictions and training_args.world_size > 1:
+        raise ValueError("--stream_predictions is only supported for single process prediction")
+    if model_args.teacher_model_dirs:
+        check_teacher_dirs(model_args.teacher_model_dirs)
+
     # Sending telemetry. Tracking the example usage helps us better allocate resources to maintain them. The
     # information sent is the one passed as arguments along with your Python/PyTorch versions.
     send_example_telemetry("run_ner", model_args, data_args)
@@ -278,6 +453,15 @@ def main():
     )
     logger.info(f"Training/evaluation parameters {training_args}")
 
+    if data_args.use_weighted_loss:
+        # Modify the output directory path by adding a "_weighted" suffix
+        # This ensures that the model files for weighted loss are stored separately. It is done before looking for
+        # the last checkpoint, so that a weighted run resumes from its own checkpoints. A directory which already has
+        # the suffix (e.g. given by run_sweep.py) is kept as it is.
+        output_dir_parts = training_args.output_dir.split(os.path.sep)
+        if not output_dir_parts[0].endswith("_weighted"):
+            training_args.output_dir = os.path.join(output_dir_parts[0] + "_weighted", *output_dir_parts[1:])
+
     # Detecting last checkpoint.
     last_checkpoint = None
     if os.path.isdir(training_args.output_dir) and training_args.do_train and not training_args.overwrite_output_dir:
@@ -347,23 +531,36 @@ def main():
     else:
         label_column_name = column_names[1]
 
-    # In the event the labels are not a `Sequence[ClassLabel]`, we will need to go through the dataset to get the
-    # unique labels.
-    # Modified: Also returns the all the labels in the data for the weighted loss
-    def get_label_list(labels):
-        unique_labels = set()
-        all_labels = []
-        for label in labels:
-            unique_labels = unique_labels | set(label)
-            all_labels.extend(label)
-        label_list = list(unique_labels)
-        label_list.sort()
-        return label_list, all_labels
+    # The tags of the Parquet files written by prepare_dataset.py are label ids, whose names are stored in the metadata
+    # of the files: they are cast to ClassLabel.
+    if data_args.dataset_name is None and extension == "parquet":
+        label_names = read_label_names(data_args.train_file)
+        raw_datasets = raw_datasets.cast_column(label_column_name, Sequence(ClassLabel(names=label_names)))
+        features = raw_datasets["train" if training_args.do_train else "validation"].features
 
     # If the labels are of type ClassLabel, they are already integers and we have the map stored somewhere.
     # Otherwise, we have to get the list of labels manually.
-    label_list, all_labels = get_label_list(raw_datasets["train"][label_column_name])
-    label_to_id = {l: i for i, l in enumerate(label_list)}
+    # Modified: The labels are counted in a single pass over the Arrow batches of the train dataset, the counts are
+    # also used for the weighted loss. They are saved next to the tokenized datasets, so that the next runs skip it.
+    labels_are_int = isinstance(features[label_column_name].feature, ClassLabel)
+    # The data source is the cache key of the statistics, so the train file is only hashed when they are cached
+    data_source = None
+    if data_args.tokenized_cache_dir is not None:
+        data_source = (
+            file_sha256(data_files["train"]) if data_args.dataset_name is None else raw_datasets["train"]._fingerprint
+        )
+    label_list, label_counts = load_or_compute_label_stats(
+        raw_datasets["train"],
+        label_column_name,
+        cache_dir=data_args.tokenized_cache_dir,
+        data_source=data_source,
+    )
+    if labels_are_int:
+        label_list = features[label_column_name].feature.names
+        label_counts = {label_list[label_id]: count for label_id, count in label_counts.items()}
+        label_to_id = {i: i for i in range(len(label_list))}
+    else:
+        label_to_id = {l: i for i, l in enumerate(label_list)}
 
     num_labels = len(label_list)
 
@@ -376,11 +573,7 @@ def main():
         # This helps in addressing class imbalance by assigning different weights to each class.
         # The weights are calculated automatically based on the frequency of each class in the training data.
         # Weights are inversely proportional to the frequencies, encouraging the model to pay more attention to less common tags.
-        from collections import Counter
-
-        class_weights = class_weight.compute_class_weight(class_weight='balanced',
-                                                          classes=label_list,
-                                                          y=all_labels)
+        class_weights = balanced_class_weights(label_list, label_counts)
         # normalize the weights
         class_weights = class_weights / class_weights.sum()
         class_weights = torch.Tensor(class_weights).to(training_args.device)
@@ -390,14 +583,13 @@ def main():
         print(list(zip(label_list, class_weights)))
         print("*" * 25, "WEIGHTED loss")
 
-        # Modify the output directory path by adding a "_weighted" suffix
-        # This ensures that the model files for weighted loss are stored separately
-        output_dir_parts = training_args.output_dir.split(os.path.sep)
-        training_args.output_dir = os.path.join(output_dir_parts[0] + "_weighted", *output_dir_parts[1:])
-
     else:
-        # Use the default Trainer class from the transformers library for unweighted loss
-        from transformers import Trainer as Trainer
+        # Use the Trainer class of the transformers library (with token budget batching) for unweighted loss
+        from Custom_Trainer import TrainerTokenBudget as Trainer
+
+    if model_args.teacher_model_dirs:
+        # The student is trained against the soft labels of the teachers (and the gold labels, weighted or not)
+        from Custom_Trainer import TrainerDistillation as Trainer
 
     # Load pretrained model and tokenizer
     #
@@ -445,6 +637,8 @@ def main():
         trust_remote_code=model_args.trust_remote_code,
         ignore_mismatched_sizes=model_args.ignore_mismatched_sizes,
     )
+    if model_args.student_num_layers is not None:
+        model = keep_layers(model, model_args.student_num_layers)
 
     # Tokenizer check: this script requires a fast tokenizer.
     if not isinstance(tokenizer, PreTrainedTokenizerFast):
@@ -453,7 +647,6 @@ def main():
             " https://huggingface.co/transformers/index.html#supported-frameworks to find the model types that meet"
             " this requirement"
         )
-    labels_are_int = isinstance(features[label_column_name].feature, ClassLabel)
     # Model has labels -> use them.
     if model.config.label2id != PretrainedConfig(num_labels=num_labels).label2id:
         if sorted(model.config.label2id.keys()) == sorted(label_list):
@@ -476,19 +669,18 @@ def main():
     model.config.id2label = dict(enumerate(label_list))
 
     # Map that sends B-Xxx label to its I-Xxx counterpart
-    b_to_i_label = []
-    for idx, label in enumerate(label_list):
-        if label.startswith("B-") and label.replace("B-", "I-") in label_list:
-            b_to_i_label.append(label_list.index(label.replace("B-", "I-")))
-        else:
-            b_to_i_label.append(idx)
+    b_to_i_label = build_b_to_i_label(label_list)
 
     # Preprocessing the dataset
     # Padding strategy
     padding = "max_length" if data_args.pad_to_max_length else False
 
     # Tokenize all texts and align the labels with them.
-    def tokenize_and_align_labels(examples):
+    def tokenize_and_align_labels(examples, indices=None, label_all_tokens=data_args.label_all_tokens):
+        # With --sliding_window, the long examples are split into overlapping windows instead of being truncated
+        window_options = (
+            {"stride": data_args.window_stride, "return_overflowing_tokens": True} if data_args.sliding_window else {}
+        )
         tokenized_inputs = tokenizer(
             examples[text_column_name],
             padding=padding,
@@ -496,102 +688,226 @@ def main():
             max_length=data_args.max_seq_length,
             # We use this argument because the texts in our dataset are lists of words (with a label for each word).
             is_split_into_words=True,
+            **window_options,
+        )
+        labels = examples[label_column_name]
+        if data_args.sliding_window:
+            sample_mapping = tokenized_inputs.pop("overflow_to_sample_mapping")
+            labels = [labels[sample] for sample in sample_mapping]
+            tokenized_inputs.update(window_columns(tokenized_inputs, sample_mapping, indices))
+        # Special tokens get the label -100 so they are automatically ignored in the loss function. The first token
+        # of each word gets the label of the word, the other tokens get either the current label or -100, depending
+        # on the label_all_tokens flag.
+        align_labels = align_labels_with_tokens if data_args.vectorized_label_alignment else align_labels_loop
+        tokenized_inputs["labels"] = align_labels(
+            tokenized_inputs,
+            labels,
+            label_to_id,
+            b_to_i_label,
+            label_all_tokens=label_all_tokens,
         )
-        labels = []
-        for i, label in enumerate(examples[label_column_name]):
-            word_ids = tokenized_inputs.word_ids(batch_index=i)
-            previous_word_idx = None
-            label_ids = []
-            for word_idx in word_ids:
-                # Special tokens have a word id that is None. We set the label to -100 so they are automatically
-                # ignored in the loss function.
-                if word_idx is None:
-                    label_ids.append(-100)
-                # We set the label for the first token of each word.
-                elif word_idx != previous_word_idx:
-                    label_ids.append(label_to_id[label[word_idx]])
-                # For the other tokens in a word, we set the label to either the current label or -100, depending on
-                # the label_all_tokens flag.
-                else:
-                    if data_args.label_all_tokens:
-                        label_ids.append(b_to_i_label[label_to_id[label[word_idx]]])
-                    else:
-                        label_ids.append(-100)
-                previous_word_idx = word_idx
-
-            labels.append(label_ids)
-        tokenized_inputs["labels"] = labels
         return tokenized_inputs
 
-    if training_args.do_train:
-        if "train" not in raw_datasets:
-            raise ValueError("--do_train requires a train dataset")
-        train_dataset = raw_datasets["train"]
-        if data_args.max_train_samples is not None:
-            max_train_samples = min(len(train_dataset), data_args.max_train_samples)
-            train_dataset = train_dataset.select(range(max_train_samples))
-        with training_args.main_process_first(desc="train dataset map pre-processing"):
-            train_dataset = train_dataset.map(
+    def select_samples(split, max_samples):
+        dataset = raw_datasets[split]
+        if max_samples is not None:
+            max_samples = min(len(dataset), max_samples)
+            dataset = dataset.select(range(max_samples))
+        return dataset, max_samples
+
+    def preprocess_split(split, max_samples, desc):
+        dataset, max_samples = select_samples(split, max_samples)
+        # The windows of the evaluated splits are merged back to words with the predictions of the first sub-words
+        label_all_tokens = data_args.label_all_tokens and not (data_args.sliding_window and split != "train")
+        window_map_options = {}
+        if data_args.sliding_window:
+            # A batch of examples gives more windows than examples, so the example columns are removed
+            window_map_options = {"with_indices": True, "remove_columns": dataset.column_names}
+
+        def tokenize_dataset(**kwargs):
+            return dataset.map(
                 tokenize_and_align_labels,
                 batched=True,
                 num_proc=data_args.preprocessing_num_workers,
-                load_from_cache_file=not data_args.overwrite_cache,
-                desc="Running tokenizer on train dataset",
+                desc=f"Running tokenizer on {desc} dataset",
+                fn_kwargs={"label_all_tokens": label_all_tokens},
+                **window_map_options,
+                **kwargs,
             )
 
+        if data_args.tokenized_cache_dir is None:
+            return tokenize_dataset(load_from_cache_file=not data_args.overwrite_cache)
+
+        key, description = tokenized_dataset_key(
+            tokenizer,
+            tokenizer_name_or_path,
+            model_args.model_revision,
+            file_sha256(data_files[split]) if data_args.dataset_name is None else dataset._fingerprint,
+            label_to_id,
+            max_seq_length=data_args.max_seq_length,
+            padding=padding,
+            label_all_tokens=label_all_tokens,
+            text_column_name=text_column_name,
+            label_column_name=label_column_name,
+            max_samples=max_samples,
+            **({"window_stride": data_args.window_stride} if data_args.sliding_window else {}),
+        )
+        return load_or_build(
+            data_args.tokenized_cache_dir,
+            key,
+            description,
+            lambda: tokenize_dataset(keep_in_memory=True),
+            overwrite=data_args.overwrite_cache,
+        )
+
+    if training_args.do_train:
+        if "train" not in raw_datasets:
+            raise ValueError("--do_train requires a train dataset")
+        with training_args.main_process_first(desc="train dataset map pre-processing"):
+            train_dataset = preprocess_split("train", data_args.max_train_samples, "train")
+
     if training_args.do_eval:
         if "validation" not in raw_datasets:
             raise ValueError("--do_eval requires a validation dataset")
-        eval_dataset = raw_datasets["validation"]
-        if data_args.max_eval_samples is not None:
-            max_eval_samples = min(len(eval_dataset), data_args.max_eval_samples)
-            eval_dataset = eval_dataset.select(range(max_eval_samples))
         with training_args.main_process_first(desc="validation dataset map pre-processing"):
-            eval_dataset = eval_dataset.map(
-                tokenize_and_align_labels,
-                batched=True,
-                num_proc=data_args.preprocessing_num_workers,
-                load_from_cache_file=not data_args.overwrite_cache,
-                desc="Running tokenizer on validation dataset",
-            )
+            eval_dataset = preprocess_split("validation", data_args.max_eval_samples, "validation")
 
     if training_args.do_predict:
         if "test" not in raw_datasets:
             raise ValueError("--do_predict requires a test dataset")
-        predict_dataset = raw_datasets["test"]
-        if data_args.max_predict_samples is not None:
-            max_predict_samples = min(len(predict_dataset), data_args.max_predict_samples)
-            predict_dataset = predict_dataset.select(range(max_predict_samples))
         with training_args.main_process_first(desc="prediction dataset map pre-processing"):
-            predict_dataset = predict_dataset.map(
-                tokenize_and_align_labels,
-                batched=True,
-                num_proc=data_args.preprocessing_num_workers,
-                load_from_cache_file=not data_args.overwrite_cache,
-                desc="Running tokenizer on prediction dataset",
+            predict_dataset = preprocess_split("test", data_args.max_predict_samples, "prediction")
+
+    # With --eval_subset_size, the evaluations during training score a stratified subset of the validation examples
+    eval_subset, eval_subset_dataset, eval_subset_windows = None, None, None
+    if data_args.eval_subset_size is not None and training_args.do_train and training_args.do_eval:
+        validation_labels, validation_num_words = word_labels(
+            select_samples("validation", data_args.max_eval_samples)[0], label_column_name, label_to_id
+        )
+        eval_subset = stratified_subset(validation_labels, validation_num_words, label_list, data_args.eval_subset_size)
+        logger.info(
+            f"The evaluations during training use {len(eval_subset)} of the {len(validation_num_words)} validation "
+            "examples"
+        )
+        if data_args.sliding_window:
+            # The windows of the subset are numbered by the position of their example in the subset
+            example_index = np.asarray(eval_dataset["example_index"])
+            window_rows = np.flatnonzero(np.isin(example_index, eval_subset))
+            eval_subset_dataset = eval_dataset.select(window_rows).remove_columns("example_index")
+            eval_subset_dataset = eval_subset_dataset.add_column(
+                "example_index", np.searchsorted(eval_subset, example_index[window_rows])
             )
+            subset_words = np.isin(np.repeat(np.arange(len(validation_num_words)), validation_num_words), eval_subset)
+            eval_subset_windows = (
+                WindowMerger.from_dataset(eval_subset_dataset, validation_num_words[eval_subset]),
+                validation_labels[subset_words],
+            )
+            eval_subset_dataset = eval_subset_dataset.remove_columns(WINDOW_COLUMNS)
+        else:
+            eval_subset_dataset = eval_dataset.select(eval_subset)
+
+    # The windows of the evaluated splits are merged back to the words of their examples
+    eval_windows, predict_windows = None, None
+    if data_args.sliding_window:
+        def split_windows(split, tokenized_dataset, max_samples):
+            labels, num_words = word_labels(select_samples(split, max_samples)[0], label_column_name, label_to_id)
+            return WindowMerger.from_dataset(tokenized_dataset, num_words), labels
+
+        if training_args.do_train:
+            train_dataset = train_dataset.remove_columns(WINDOW_COLUMNS)
+        if training_args.do_eval:
+            eval_windows = split_windows("validation", eval_dataset, data_args.max_eval_samples)
+            eval_dataset = eval_dataset.remove_columns(WINDOW_COLUMNS)
+        if training_args.do_predict:
+            predict_windows = split_windows("test", predict_dataset, data_args.max_predict_samples)
+            predict_dataset = predict_dataset.remove_columns(WINDOW_COLUMNS)
 
     # Data collator
     data_collator = DataCollatorForTokenClassification(tokenizer, pad_to_multiple_of=8 if training_args.fp16 else None)
 
+    # Soft labels of the teachers, computed once per tokenized training set and cached next to it
+    distillation_options = {}
+    if model_args.teacher_model_dirs and training_args.do_train:
+        with training_args.main_process_first(desc="soft labels of the teachers"):
+            soft_labels = load_or_compute_soft_labels(
+                os.path.join(data_args.tokenized_cache_dir or training_args.output_dir, "soft_labels"),
+                model_args.teacher_model_dirs,
+                train_dataset,
+                data_collator,
+                label_list,
+                training_args.device,
+                batch_size=training_args.per_device_eval_batch_size,
+                overwrite=data_args.overwrite_cache,
+            )
+        train_dataset = train_dataset.add_column(DISTILLATION_INDEX_COLUMN, np.arange(len(train_dataset)))
+        distillation_options = {
+            "soft_labels": soft_labels,
+            "temperature": model_args.distillation_temperature,
+            "alpha": model_args.distillation_alpha,
+        }
+
     # Metrics
-    metric = evaluate.load("seqeval")
-
-    def compute_metrics(p):
-        predictions, labels = p
-        predictions = np.argmax(predictions, axis=2)
-
-        # Remove ignored index (special tokens)
-        true_predictions = [
-            [label_list[p] for (p, l) in zip(prediction, label) if l != -100]
-            for prediction, label in zip(predictions, labels)
-        ]
-        true_labels = [
-            [label_list[l] for (p, l) in zip(prediction, label) if l != -100]
-            for prediction, label in zip(predictions, labels)
-        ]
-
-        results = metric.compute(predictions=true_predictions, references=true_labels)
+    # The entity-level scores are computed on the label ids with the span scorer, which gives the same numbers as
+    # seqeval. seqeval is only used for label sets which are not in the IOB2 scheme.
+    try:
+        span_scorer = SpanScorer(label_list)
+    except ValueError:
+        span_scorer = None
+        metric = evaluate.load("seqeval")
+    id_to_label = np.array(label_list, dtype=object)
+    # The prediction of the words which are in no window (with --sliding_window)
+    outside_id = label_list.index("O") if "O" in label_list else 0
+    decoder = None
+    if data_args.constrained_decoding:
+        if span_scorer is None:
+            raise ValueError("--constrained_decoding requires labels in the IOB2 scheme")
+        decoder = BIODecoder(label_list)
+    if data_args.stream_predictions and training_args.do_predict and span_scorer is None:
+        raise ValueError("--stream_predictions requires labels in the IOB2 scheme")
+
+    def word_predictions(logits, lengths, windows=None):
+        # logits are those of the labelled positions, lengths the number of labelled positions of every row. Returns
+        # the flat predicted label ids of the words and the number of words of every sentence.
+        if windows is not None:
+            merger, _ = windows
+            if decoder is None:
+                return merger.merge(logits.argmax(axis=-1), outside_id), merger.num_words
+            outside_log_probs = np.where(np.arange(len(label_list)) == outside_id, 0.0, -np.inf).astype(np.float32)
+            word_log_probs = merger.merge(log_softmax(logits.astype(np.float32)), outside_log_probs)
+            return decoder.decode(word_log_probs, offsets_from_lengths(merger.num_words)), merger.num_words
+        if decoder is None:
+            return logits.argmax(axis=-1), lengths
+        return decoder.decode(log_softmax(logits.astype(np.float32)), offsets_from_lengths(lengths)), lengths
+
+    def score_label_ids(predictions, labels, lengths):
+        # predictions and labels are the flat label ids of the words, lengths the number of words of every sentence
+        if span_scorer is not None:
+            results = span_scorer.compute(predictions, labels, offsets_from_lengths(lengths))
+        else:
+            split_points = np.cumsum(lengths)[:-1]
+            true_predictions = [row.tolist() for row in np.split(id_to_label[predictions], split_points)]
+            true_labels = [row.tolist() for row in np.split(id_to_label[labels], split_points)]
+            results = metric.compute(predictions=true_predictions, references=true_labels)
+        return format_results(results)
+
+    def make_compute_metrics(windows=None):
+        def compute_metrics(p):
+            predictions, labels = p
+
+            # Remove ignored index (special tokens)
+            mask = labels != -100
+            predictions, lengths = word_predictions(predictions[mask], mask.sum(axis=1), windows)
+            # With windows, the words of the examples are scored rather than the windows
+            return score_label_ids(predictions, labels[mask] if windows is None else windows[1], lengths)
+
+        return compute_metrics
+
+    def compute_streamed_metrics(counts, metric_key_prefix="predict"):
+        # Same as compute_metrics, from the entity counts summed by predict_streaming
+        results = format_results(span_scorer.scores_from_counts(counts))
+        return denumpify_detensorize({f"{metric_key_prefix}_{key}": value for key, value in results.items()})
+
+    def format_results(results):
         if data_args.return_entity_level_metrics:
             # Unpack nested dictionaries
             final_results = {}
@@ -618,11 +934,14 @@ def main():
         eval_dataset=eval_dataset if training_args.do_eval else None,
         tokenizer=tokenizer,
         data_collator=data_collator,
-        compute_metrics=compute_metrics,
+        compute_metrics=make_compute_metrics(eval_windows),
+        max_tokens_per_batch=data_args.max_tokens_per_batch,
+        **({"class_weights": class_weights} if data_args.use_weighted_loss else {}),
+        **distillation_options,
     )
-    if data_args.use_weighted_loss:
-        trainer.args.class_weights = class_weights
-        trainer.args.num_labels = num_labels
+    if eval_subset_dataset is not None:
+        trainer.eval_dataset = eval_subset_dataset
+        trainer.compute_metrics = make_compute_metrics(eval_subset_windows)
 
     # Training
     if training_args.do_train:
@@ -648,10 +967,22 @@ def main():
     if training_args.do_eval:
         logger.info("*** Evaluate ***")
 
-        metrics = trainer.evaluate()
+        if eval_subset_dataset is not None:
+            # The evaluations of the subset during training, the final one scores the whole validation set
+            subset_runtimes = [entry["eval_runtime"] for entry in trainer.state.log_history if "eval_runtime" in entry]
+            trainer.compute_metrics = make_compute_metrics(eval_windows)
+        metrics = trainer.evaluate(eval_dataset)
 
         max_eval_samples = data_args.max_eval_samples if data_args.max_eval_samples is not None else len(eval_dataset)
         metrics["eval_samples"] = min(max_eval_samples, len(eval_dataset))
+        if eval_subset_dataset is not None:
+            metrics["eval_subset_samples"] = len(eval_subset)
+            metrics["eval_subset_evaluations"] = len(subset_runtimes)
+            metrics["eval_subset_runtime"] = round(sum(subset_runtimes), 4)
+            # Every evaluation during training would have taken about as long as the final one
+            metrics["eval_subset_time_saved"] = round(
+                len(subset_runtimes) * metrics["eval_runtime"] - sum(subset_runtimes), 4
+            )
 
         trainer.log_metrics("eval", metrics)
         trainer.save_metrics("eval", metrics)
@@ -660,24 +991,34 @@ def main():
     if training_args.do_predict:
         logger.info("*** Predict ***")
 
-        predictions, labels, metrics = trainer.predict(predict_dataset, metric_key_prefix="predict")
-        predictions = np.argmax(predictions, axis=2)
-
-        # Remove ignored index (special tokens)
-        true_predictions = [
-            [label_list[p] for (p, l) in zip(prediction, label) if l != -100]
-            for prediction, label in zip(predictions, labels)
-        ]
-
-        trainer.log_metrics("predict", metrics)
-        trainer.save_metrics("predict", metrics)
-
-        # Save predictions
         output_predictions_file = os.path.join(training_args.output_dir, "predictions.txt")
-        if trainer.is_world_process_zero():
-            with open(output_predictions_file, "w") as writer:
-                for prediction in true_predictions:
-                    writer.write(" ".join(prediction) + "\n")
+        if data_args.stream_predictions:
+            # Predictions are saved while predicting
+            counts = predict_streaming(
+                trainer, predict_dataset, label_list, output_predictions_file, span_scorer, predict_windows, outside_id,
+                decoder,
+            )
+            metrics = compute_streamed_metrics(counts)
+
+            trainer.log_metrics("predict", metrics)
+            trainer.save_metrics("predict", metrics)
+        else:
+            trainer.compute_metrics = make_compute_metrics(predict_windows)
+            predictions, labels, metrics = trainer.predict(predict_dataset, metric_key_prefix="predict")
+
+            # Remove ignored index (special tokens)
+            mask = labels != -100
+            predictions, lengths = word_predictions(predictions[mask], mask.sum(axis=1), predict_windows)
+            true_predictions = [row.tolist() for row in np.split(id_to_label[predictions], np.cumsum(lengths)[:-1])]
+
+            trainer.log_metrics("predict", metrics)
+            trainer.save_metrics("predict", metrics)
+
+            # Save predictions
+            if trainer.is_world_process_zero():
+                with open(output_predictions_file, "w") as writer:
+                    for prediction in true_predictions:
+                        writer.write(" ".join(prediction) + "\n")
 
     kwargs = {"finetuned_from": model_args.model_name_or_path, "tasks": "token-classification"}
     if data_args.dataset_name is not None:
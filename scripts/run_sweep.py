@@ -0,0 +1,210 @@
+"""
+Run the multi-seed fine-tuning of run.sh in parallel.
+
+Takes the same options as run.sh, but instead of running the seeds one after another, every run is given its own GPU
+(or CPU slot) as soon as one is free, so an N-seed sweep takes about as long as its slowest runs rather than the sum of
+all of them. The seeds and the status of every run are kept in a json file next to the saved models; running the same
+command again resumes the sweep: finished runs are skipped, and unfinished ones are restarted (from their last
+checkpoint when they have one).
+
+Sample usage:
+    python scripts/run_sweep.py --system-type a --model-name bert-base-cased --run-count 4
+Any other argument is passed on to run_ner.py, e.g. `--num_train_epochs 1`.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+from transformers.hf_argparser import string_to_bool
+from transformers.trainer_utils import get_last_checkpoint
+
+
+def get_output_dir(args, seed):
+    output_dir = os.path.join("saved_models", f"system_{args.system_type}", f"{args.model_name}_{seed}")
+    if args.use_weighted_loss:
+        # run_ner.py stores the models trained with the weighted loss under "<first directory>_weighted"
+        output_dir_parts = output_dir.split(os.path.sep)
+        output_dir = os.path.join(output_dir_parts[0] + "_weighted", *output_dir_parts[1:])
+    return output_dir
+
+
+def run_ner_command(args, seed, extra_args):
+    """
+    The run_ner.py command of run.sh for one seed. A run that was interrupted after saving a checkpoint is resumed
+    from it instead of being restarted from scratch.
+    """
+    data_dir = os.path.join(args.data_dir, f"system_{args.system_type}")
+    # Use the Parquet files of prepare_dataset.py (--output-format parquet) if there are any
+    data_format = "parquet" if os.path.exists(os.path.join(data_dir, "train.parquet")) else "json"
+    output_dir = get_output_dir(args, seed)
+    last_checkpoint = get_last_checkpoint(output_dir) if os.path.isdir(output_dir) else None
+
+    command = [
+        sys.executable, "-u", os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_ner.py"),
+        "--model_name_or_path", args.model_name,
+        "--task_name", "ner",
+        "--train_file", os.path.join(data_dir, f"train.{data_format}"),
+        "--validation_file", os.path.join(data_dir, f"validation.{data_format}"),
+        "--test_file", os.path.join(data_dir, f"test.{data_format}"),
+        # The directory of the run, with the "_weighted" suffix of the weighted loss, which run_ner.py keeps
+        "--output_dir", output_dir,
+        "--text_column_name", "tokens",
+        "--label_column_name", "ner_tags",
+        "--per_device_train_batch_size", "16",
+        "--per_device_eval_batch_size", "64",
+        "--do_train",
+        "--use_weighted_loss", str(args.use_weighted_loss),
+        "--seed", str(seed),
+        "--do_eval",
+        "--do_predict",
+        "--return_entity_level_metrics",
+        "--save_total_limit", "2",
+        "--greater_is_better", "True",
+        "--metric_for_best_model", "eval_overall_f1",
+        "--load_best_model_at_end",
+        "--save_strategy", "steps",
+        "--evaluation_strategy", "steps",
+        "--save_steps", "1000",
+        "--eval_steps", "1000",
+        # The tokenization does not depend on the seed, so all the runs of the sweep share the tokenized datasets.
+        "--tokenized_cache_dir", os.path.join(args.data_dir, "tokenized_cache"),
+    ]
+    if last_checkpoint is not None:
+        command += ["--resume_from_checkpoint", last_checkpoint]
+    else:
+        command.append("--overwrite_output_dir")
+    return command + extra_args
+
+
+def load_status(status_file, run_count):
+    """
+    Load the status of the sweep, or start a new one with `run_count` random seeds (drawn as in run.sh).
+    """
+    if os.path.exists(status_file):
+        with open(status_file, "r") as file:
+            status = json.load(file)
+    else:
+        status = {"runs": {}}
+    seeds = {int(seed) for seed in status["runs"]}
+    while len(seeds) < run_count:
+        seed = random.randint(0, 100000)
+        if seed not in seeds:
+            seeds.add(seed)
+            status["runs"][str(seed)] = {"status": "pending"}
+    return status
+
+
+def save_status(status, status_file):
+    tmp_file = status_file + ".tmp"
+    with open(tmp_file, "w") as file:
+        json.dump(status, file, indent=4)
+    os.replace(tmp_file, status_file)
+
+
+def get_slots(args):
+    """
+    The slots runs are scheduled on: one per GPU, or `--cpu-slots` CPU slots when there is no GPU.
+    """
+    if args.devices is not None:
+        devices = [device for device in args.devices.split(",") if device]
+    else:
+        import torch
+
+        devices = [str(i) for i in range(torch.cuda.device_count())]
+    if devices:
+        return [{"CUDA_VISIBLE_DEVICES": device} for device in devices]
+
+    # Split the CPU cores evenly between the runs.
+    threads = str(max(1, (os.cpu_count() or 1) // args.cpu_slots))
+    return [{"CUDA_VISIBLE_DEVICES": "", "OMP_NUM_THREADS": threads, "MKL_NUM_THREADS": threads}
+            for _ in range(args.cpu_slots)]
+
+
+def is_finished(args, seed):
+    return os.path.exists(os.path.join(get_output_dir(args, seed), "predictions.txt"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fine-tune a transformer model with several seeds in parallel.")
+    parser.add_argument("--system-type", required=True, help="Type of the system to be used")
+    parser.add_argument("--model-name", required=True, help="Name of the model to be fine-tuned")
+    # Parsed as run_ner.py parses it, so that both agree on the output directory of the runs
+    parser.add_argument("--use-weighted-loss", type=string_to_bool, default=False,
+                        help="Set to 'true' or '1' to use the weighted loss")
+    parser.add_argument("--data-dir", default="data", help="Directory for data")
+    parser.add_argument("--run-count", type=int, default=4, help="Number of fine-tuning runs with different seeds")
+    parser.add_argument("--devices", default=None,
+                        help="Comma separated GPU ids to run on (default: all the visible GPUs)")
+    parser.add_argument("--cpu-slots", type=int, default=1,
+                        help="Number of runs executed at the same time when there is no GPU")
+    parser.add_argument("--status-file", default=None,
+                        help="Where the seeds and the status of the runs are kept "
+                             "(default: saved_models/system_<type>/sweep_<model>[_weighted].json)")
+    args, extra_args = parser.parse_known_args()
+
+    # The weighted and the unweighted sweeps of a model have their own seeds and status
+    loss_suffix = "_weighted" if args.use_weighted_loss else ""
+    status_file = args.status_file or os.path.join(
+        "saved_models", f"system_{args.system_type}", f"sweep_{args.model_name.replace('/', '_')}{loss_suffix}.json"
+    )
+    os.makedirs(os.path.dirname(status_file) or ".", exist_ok=True)
+    log_dir = os.path.join(os.path.dirname(status_file) or ".", "logs")
+    os.makedirs(log_dir, exist_ok=True)
+
+    status = load_status(status_file, args.run_count)
+    pending = []
+    for seed, run in status["runs"].items():
+        if run["status"] == "done" and is_finished(args, int(seed)):
+            print(f"Seed {seed} is already done, skipping it.")
+            continue
+        run["status"] = "pending"
+        pending.append(int(seed))
+    save_status(status, status_file)
+
+    free_slots = get_slots(args)
+    running = {}
+    sweep_start = time.time()
+    while pending or running:
+        while pending and free_slots:
+            seed = pending.pop(0)
+            slot = free_slots.pop(0)
+            log_file = open(os.path.join(log_dir, f"{args.model_name.replace('/', '_')}_{seed}{loss_suffix}.log"), "a")
+            process = subprocess.Popen(
+                run_ner_command(args, seed, extra_args),
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+                env={**os.environ, **slot},
+            )
+            running[seed] = (process, slot, log_file, time.time())
+            status["runs"][str(seed)].update(
+                {"status": "running", "device": slot["CUDA_VISIBLE_DEVICES"] or "cpu", "log_file": log_file.name}
+            )
+            save_status(status, status_file)
+            print(f"Seed {seed} started on {status['runs'][str(seed)]['device']}, see {log_file.name}")
+
+        time.sleep(5)
+        for seed, (process, slot, log_file, start) in list(running.items()):
+            returncode = process.poll()
+            if returncode is None:
+                continue
+            log_file.close()
+            del running[seed]
+            free_slots.append(slot)
+            done = returncode == 0 and is_finished(args, seed)
+            status["runs"][str(seed)].update(
+                {"status": "done" if done else "failed", "returncode": returncode,
+                 "runtime": round(time.time() - start, 1)}
+            )
+            save_status(status, status_file)
+            print(f"Seed {seed} {'finished' if done else 'failed'} in {time.time() - start:.0f}s")
+
+    failed = [seed for seed, run in status["runs"].items() if run["status"] != "done"]
+    print(f"The sweep took {time.time() - sweep_start:.0f}s, the status of the runs is saved to {status_file}")
+    if failed:
+        print(f"Failed seeds: {', '.join(failed)}. Run the same command again to retry them.")
+        sys.exit(1)
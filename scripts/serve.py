@@ -0,0 +1,300 @@
+"""
+HTTP tagging service for checkpoints fine-tuned by run_ner.py (or exported by quantize.py / export_onnx.py).
+
+The service runs on asyncio with the standard library only. Concurrent requests are coalesced into micro-batches: a
+batch is closed when it holds `--max_batch_tokens` words or when its first request has waited `--max_wait_ms`, and is
+tagged by the length-bucketed NERTagger of inference.py on a worker thread (or process), so the event loop keeps
+accepting requests while the model runs. Every response has the BIO tags of every word and the entity spans, with
+the labels of the `id2label` of the checkpoint config.
+
+Endpoints:
+    POST /tag     {"tokens": [["John", "lives", "in", "Paris"]]}, {"texts": ["John lives in Paris"]} or
+                  {"text": "John lives in Paris"}
+                  -> {"tags": [["B-PER", "O", "O", "B-LOC"]],
+                      "entities": [[{"start": 0, "end": 1, "type": "PER", "text": "John", "score": 0.98}, ...]]}
+                  (word indices, `end` excluded, and the mean probability of the tags of the words of the entity;
+                  a single "text" gets a single "tags" list and "entities" list)
+    GET  /health  -> {"status": "ok", "labels": [...]}
+
+Sample usage:
+    python scripts/serve.py saved_models/system_a/bert-base-cased_42 --port 8080 --workers 2 --num_threads 4
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import signal
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from transformers import AutoConfig
+
+from inference import load_tagger
+
+logger = logging.getLogger(__name__)
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+# The tagger of the process (loaded once per worker process with --executor process)
+_tagger = None
+
+
+def load_worker(model_dir, tagger_options):
+    global _tagger
+    _tagger = load_tagger(model_dir, **tagger_options)
+    return _tagger.label_list
+
+
+def tag_batch(sentences):
+    """
+    Tag a micro-batch of sentences. Returns the tags and the entities (start, end excluded, type, score) of every
+    sentence.
+    """
+    label_ids, entities = _tagger.predict_entities(sentences)
+    return [(_tagger.id_to_label[ids].tolist(), sentence_entities) for ids, sentence_entities in zip(label_ids, entities)]
+
+
+class MicroBatcher:
+    """
+    Coalesces the sentences of concurrent requests into batches for `tag_fn`, run on `executor`.
+
+    A batch starts with the oldest waiting request and takes the following ones until it holds `max_batch_tokens`
+    words or `max_wait_ms` have passed since it started. `num_workers` batches are tagged at the same time. When a
+    batch fails, its requests are tagged again one by one, so that only the failing ones get the error.
+    """
+
+    def __init__(self, tag_fn, executor, num_workers=1, max_batch_tokens=4096, max_wait_ms=5.0):
+        self.tag_fn = tag_fn
+        self.executor = executor
+        self.num_workers = num_workers
+        self.max_batch_tokens = max_batch_tokens
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._run()) for _ in range(self.num_workers)]
+
+    async def submit(self, sentences):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sentences, future))
+        return await future
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        tokens = sum(len(sentence) for sentence in batch[0][0])
+        deadline = loop.time() + self.max_wait
+        while tokens < self.max_batch_tokens:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(request)
+            tokens += sum(len(sentence) for sentence in request[0])
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            sentences = [sentence for request_sentences, _ in batch for sentence in request_sentences]
+            try:
+                results = await loop.run_in_executor(self.executor, self.tag_fn, sentences)
+            except Exception as error:
+                if len(batch) == 1:
+                    logger.exception("Tagging failed")
+                    self._set_result(batch[0][1], exception=error)
+                    continue
+                # Retry the requests one by one, so that a failing request only fails itself
+                for request_sentences, future in batch:
+                    try:
+                        result = await loop.run_in_executor(self.executor, self.tag_fn, request_sentences)
+                    except Exception as request_error:
+                        logger.exception("Tagging failed")
+                        self._set_result(future, exception=request_error)
+                    else:
+                        self._set_result(future, result)
+                continue
+            start = 0
+            for request_sentences, future in batch:
+                self._set_result(future, results[start:start + len(request_sentences)])
+                start += len(request_sentences)
+
+    @staticmethod
+    def _set_result(future, result=None, exception=None):
+        # The client of a request may have disconnected, cancelling its future
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+
+def parse_request(body):
+    """
+    The sentences (lists of words) of a /tag request, and whether the request holds a single sentence.
+    """
+    request = json.loads(body)
+    if not isinstance(request, dict):
+        raise ValueError("The request must be a json object")
+    if "text" in request:
+        if not isinstance(request["text"], str):
+            raise ValueError('"text" must be a string')
+        return [request["text"].split()], True
+    if "texts" in request:
+        if not is_list_of_strings(request["texts"]):
+            raise ValueError('"texts" must be a list of strings')
+        return [text.split() for text in request["texts"]], False
+    if "tokens" in request:
+        tokens = request["tokens"]
+        if tokens and is_list_of_strings(tokens):
+            return [tokens], True
+        if not isinstance(tokens, list) or not all(is_list_of_strings(sentence) for sentence in tokens):
+            raise ValueError('"tokens" must be a list of words or a list of sentences (lists of words)')
+        return tokens, False
+    raise ValueError('The request needs a "tokens", "texts" or "text" field')
+
+
+def is_list_of_strings(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+class TaggingService:
+    def __init__(self, batcher, label_list):
+        self.batcher = batcher
+        self.label_list = label_list
+
+    async def handle(self, method, path, body):
+        if path == "/health":
+            return 200, {"status": "ok", "labels": self.label_list}
+        if path != "/tag":
+            return 404, {"error": f"Unknown path {path}"}
+        if method != "POST":
+            return 405, {"error": "Use POST /tag"}
+        try:
+            sentences, single = parse_request(body)
+        except (ValueError, TypeError, AttributeError) as error:
+            return 400, {"error": str(error)}
+
+        results = await self.batcher.submit(sentences)
+        tags = [sentence_tags for sentence_tags, _ in results]
+        entities = [
+            [{"start": start, "end": end, "type": entity_type, "text": " ".join(words[start:end]), "score": score}
+             for start, end, entity_type, score in spans]
+            for words, (_, spans) in zip(sentences, results)
+        ]
+        if single:
+            return 200, {"tags": tags[0], "entities": entities[0]}
+        return 200, {"tags": tags, "entities": entities}
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serve the HTTP/1.1 requests of a connection, which is kept alive unless the client closes it.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                try:
+                    status, payload = await self.handle(method, path.split("?")[0], body)
+                except Exception as error:
+                    status, payload = 500, {"error": str(error)}
+                data = json.dumps(payload).encode("utf-8")
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                writer.write(
+                    (f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(data)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                     ).encode("latin-1") + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(args):
+    tagger_options = {
+        "backend": args.backend,
+        "ensemble_dirs": args.ensemble_dirs,
+        "num_threads": args.num_threads,
+        "max_batch_size": args.max_batch_size,
+        "device": args.device,
+        "constrained_decoding": args.constrained_decoding,
+    }
+    if args.executor == "process":
+        # Every process loads its own copy of the model
+        executor = ProcessPoolExecutor(args.workers, initializer=load_worker, initargs=(args.model_dir, tagger_options))
+        id2label = AutoConfig.from_pretrained(args.model_dir).id2label
+        label_list = [id2label[i] for i in range(len(id2label))]
+    else:
+        # The model is shared by the threads, torch releases the GIL during the forward pass
+        executor = ThreadPoolExecutor(args.workers)
+        label_list = load_worker(args.model_dir, tagger_options)
+
+    batcher = MicroBatcher(tag_batch, executor, args.workers, args.max_batch_tokens, args.max_wait_ms)
+    batcher.start()
+    service = TaggingService(batcher, label_list)
+    server = await asyncio.start_server(service.handle_connection, args.host, args.port)
+    logger.info(f"Serving {args.model_dir} on http://{args.host}:{args.port}")
+    # Stop on SIGTERM as on Ctrl+C, so that the worker processes are shut down with the service
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        async with server:
+            await server.serve_forever()
+    except asyncio.CancelledError:
+        logger.info("Shutting down")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP tagging service with micro-batching.")
+    parser.add_argument("model_dir", type=str, help="Directory of the saved model (e.g. saved_models/system_a/<model>_<seed>)")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--max_wait_ms", type=float, default=5.0,
+                        help="How long a request waits for others to join its micro-batch")
+    parser.add_argument("--max_batch_tokens", type=int, default=4096,
+                        help="Number of words at which a micro-batch is closed")
+    parser.add_argument("--max_batch_size", type=int, default=128,
+                        help="Maximum number of sentences per model batch (a micro-batch may run as several)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of micro-batches tagged at the same time")
+    parser.add_argument("--executor", type=str, default="thread", choices=["thread", "process"],
+                        help="Tag the micro-batches on threads sharing the model or on processes with their own copy")
+    parser.add_argument("--num_threads", type=int, default=None, help="Number of CPU threads used by every worker")
+    parser.add_argument("--backend", type=str, default=None, choices=["torch", "onnx"],
+                        help="Run the model with torch or with ONNX Runtime (see inference.py)")
+    parser.add_argument("--device", type=str, default="cpu", help="Device to run the model on")
+    parser.add_argument("--ensemble_dirs", type=str, nargs="+", default=None,
+                        help="Serve the logit ensemble of the model and these checkpoints (see inference.py)")
+    parser.add_argument("--constrained_decoding", action="store_true",
+                        help="Return the most likely valid IOB2 tag sequence of every sentence (see decoding.py)")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=logging.INFO,
+    )
+    asyncio.run(serve(args))
@@ -0,0 +1,251 @@
+"""
+Entity-level precision, recall and F1 over integer-encoded IOB2 tags.
+
+The scores are the ones of seqeval in its default mode (as used by `evaluate.load("seqeval")`): an entity starts at a
+B-Xxx tag or at an I-Xxx tag that does not continue an entity of the same type, an entity only counts as correct if its
+boundaries and type match exactly, and sentences never share an entity. The tags of all sentences are kept in one flat
+array of label ids, together with an array of sentence offsets (the start of every sentence followed by the total
+length), so the entities are extracted and matched with array operations instead of a loop over the tags.
+"""
+
+import numpy as np
+
+
+def offsets_from_lengths(lengths):
+    """
+    Sentence offsets (the start of every sentence followed by the total length) from sentence lengths.
+    """
+    return np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+
+class SpanScorer:
+    """
+    Scores predicted tags against reference tags, both given as label ids of the same `label_list`.
+    """
+
+    def __init__(self, label_list):
+        self.label_list = list(label_list)
+
+        entity_types = set()
+        prefixes = []
+        for label in self.label_list:
+            # Same parsing of the labels as seqeval.
+            prefix, entity_type = label[0], label[1:].split("-", maxsplit=1)[-1] or "_"
+            if prefix not in ("B", "I", "O") or (prefix != "O" and label[1:2] not in ("", "-")):
+                raise ValueError(f"{label} is not an IOB2 tag, the span scorer only supports the B-/I-/O scheme.")
+            prefixes.append(prefix)
+            if prefix != "O":
+                entity_types.add(entity_type)
+        self.entity_types = sorted(entity_types)
+
+        type_to_index = {entity_type: i for i, entity_type in enumerate(self.entity_types)}
+        self._type_of = np.array(
+            [-1 if prefix == "O" else type_to_index[label[1:].split("-", maxsplit=1)[-1] or "_"]
+             for prefix, label in zip(prefixes, self.label_list)],
+            dtype=np.int64,
+        )
+        self._is_inside = np.array([prefix == "I" for prefix in prefixes], dtype=bool)
+
+    def extract_entities(self, tags, offsets):
+        """
+        Extract the entities of a flat array of label ids.
+
+        Returns the start positions, the (inclusive) end positions and the entity type indices of the entities, all
+        in the order of their start position.
+        """
+        _, starts, ends, types = self._extract_entities(np.asarray(tags)[np.newaxis], offsets)
+        return starts, ends, types
+
+    def allowed_transitions(self):
+        """
+        The transitions of the IOB2 scheme: an I-Xxx tag may only follow a B-Xxx or an I-Xxx tag, and never starts a
+        sentence.
+
+        Returns:
+        tuple: A (labels, labels) bool array, True where the second label may follow the first one, and a (labels,)
+        bool array, True for the labels which may start a sentence.
+        """
+        same_type = (self._type_of[:, np.newaxis] == self._type_of[np.newaxis, :]) & (self._type_of[:, np.newaxis] >= 0)
+        return ~self._is_inside[np.newaxis, :] | same_type, ~self._is_inside
+
+    def _extract_entities(self, tags, offsets):
+        """
+        Extract the entities of every row of a (runs, tokens) array of label ids. Returns the row, start position,
+        end position and entity type index of every entity, ordered by row and start position.
+        """
+        offsets = np.asarray(offsets)
+        types = self._type_of[tags]
+
+        # The type of the previous tag, with no entity before the first tag of a sentence.
+        previous_types = np.empty_like(types)
+        previous_types[:, 1:] = types[:, :-1]
+        sentence_starts = offsets[:-1][offsets[:-1] < offsets[1:]]
+        previous_types[:, sentence_starts] = -1
+
+        continues = self._is_inside[tags] & (types == previous_types) & (types >= 0)
+        starts = (types >= 0) & ~continues
+        # A tag ends an entity when the next tag does not continue it. The first tag of the next sentence never
+        # continues anything, so the ends never cross sentence boundaries.
+        next_continues = np.zeros_like(continues)
+        next_continues[:, :-1] = continues[:, 1:]
+        ends = (types >= 0) & ~next_continues
+
+        rows, start_positions = np.nonzero(starts)
+        _, end_positions = np.nonzero(ends)
+        return rows, start_positions, end_positions, types[rows, start_positions]
+
+    def count(self, predictions, references, offsets):
+        """
+        Count the true positive, predicted and reference entities of every entity type, and the correct tokens.
+
+        Returns a dict with the per type arrays "true_positives", "predicted" and "reference", and the number of
+        "correct_tokens" and "total_tokens".
+        """
+        counts = self.count_runs(np.asarray(predictions)[np.newaxis], references, offsets)
+        for key in ("true_positives", "predicted", "correct_tokens"):
+            counts[key] = counts[key][0]
+        return counts
+
+    def count_runs(self, predictions, references, offsets):
+        """
+        Same as `count` for the predictions of several runs against the same references, in a single pass.
+        `predictions` is a (runs, tokens) array and every returned count gets a leading runs dimension (except
+        "reference" and "total_tokens", which are the same for all the runs).
+        """
+        entities = self._match_entities(predictions, references, offsets)
+        num_runs, num_tokens = entities["shape"]
+        num_types = len(self.entity_types)
+        matched_rows, matched_types = entities["matched_rows"], entities["ref_types"][entities["matched_entities"]]
+        return {
+            "true_positives": np.bincount(
+                matched_rows * num_types + matched_types, minlength=num_runs * num_types
+            ).reshape(num_runs, num_types),
+            "predicted": np.bincount(
+                entities["pred_rows"] * num_types + entities["pred_types"], minlength=num_runs * num_types
+            ).reshape(num_runs, num_types),
+            "reference": np.bincount(entities["ref_types"], minlength=num_types),
+            "correct_tokens": np.count_nonzero(np.asarray(predictions) == np.asarray(references), axis=1),
+            "total_tokens": num_tokens,
+        }
+
+    def count_sentences(self, predictions, references, offsets):
+        """
+        Same as `count_runs`, but the entities are also counted per sentence: "true_positives" and "predicted" are
+        (runs, sentences, types) arrays and "reference" a (sentences, types) array. Summing them over the sentences
+        gives the counts of `count_runs`. An entity belongs to the sentence in which it starts.
+        """
+        entities = self._match_entities(predictions, references, offsets)
+        num_runs, _ = entities["shape"]
+        num_types = len(self.entity_types)
+        offsets = np.asarray(offsets)
+        num_sentences = len(offsets) - 1
+
+        def sentence_of(positions):
+            # With side="right", a position is assigned to the last of the sentences starting at it, i.e. to the
+            # non-empty one.
+            return np.searchsorted(offsets, positions, side="right") - 1
+
+        def per_sentence(rows, positions, types, num_rows=num_runs):
+            return np.bincount(
+                (rows * num_sentences + sentence_of(positions)) * num_types + types,
+                minlength=num_rows * num_sentences * num_types,
+            ).reshape(num_rows, num_sentences, num_types)
+
+        matched_entities = entities["matched_entities"]
+        return {
+            "true_positives": per_sentence(
+                entities["matched_rows"], entities["ref_starts"][matched_entities],
+                entities["ref_types"][matched_entities],
+            ),
+            "predicted": per_sentence(entities["pred_rows"], entities["pred_starts"], entities["pred_types"]),
+            "reference": per_sentence(
+                np.zeros_like(entities["ref_starts"]), entities["ref_starts"], entities["ref_types"], num_rows=1
+            )[0],
+        }
+
+    def _match_entities(self, predictions, references, offsets):
+        """
+        Extract the entities of the predictions of every run and of the references, and match them.
+        """
+        predictions = np.asarray(predictions)
+        references = np.asarray(references)
+        if predictions.ndim != 2 or predictions.shape[1] != references.shape[0]:
+            raise ValueError(
+                f"Found predictions and references of inconsistent lengths: {predictions.shape}, {references.shape}"
+            )
+        num_runs, num_tokens = predictions.shape
+        pred_rows, pred_starts, pred_ends, pred_types = self._extract_entities(predictions, offsets)
+        _, ref_starts, ref_ends, ref_types = self._extract_entities(references[np.newaxis], offsets)
+
+        # At most one entity starts at a given position, so the entities can be matched on their start position.
+        pred_end_at = np.full((num_runs, num_tokens), -1, dtype=np.int64)
+        pred_end_at[pred_rows, pred_starts] = pred_ends
+        pred_type_at = np.full((num_runs, num_tokens), -1, dtype=np.int64)
+        pred_type_at[pred_rows, pred_starts] = pred_types
+        matched = (pred_end_at[:, ref_starts] == ref_ends) & (pred_type_at[:, ref_starts] == ref_types)
+
+        matched_rows, matched_entities = np.nonzero(matched)
+        return {
+            "shape": (num_runs, num_tokens),
+            "pred_rows": pred_rows, "pred_starts": pred_starts, "pred_types": pred_types,
+            "ref_starts": ref_starts, "ref_types": ref_types,
+            "matched_rows": matched_rows, "matched_entities": matched_entities,
+        }
+
+    def compute(self, predictions, references, offsets):
+        """
+        Score the predictions. The result has the layout of the seqeval metric of the `evaluate` library: a dict of
+        precision, recall, f1 and number for every entity type that occurs in the predictions or the references,
+        and the overall (micro averaged) precision, recall, f1 and the token accuracy.
+        """
+        counts = self.count(predictions, references, offsets)
+        return self.scores_from_counts(counts)
+
+    def scores_from_counts(self, counts):
+        true_positives, predicted, reference = counts["true_positives"], counts["predicted"], counts["reference"]
+        precision, recall, f1 = precision_recall_f1(true_positives, predicted, reference)
+
+        results = {}
+        for i, entity_type in enumerate(self.entity_types):
+            if predicted[i] == 0 and reference[i] == 0:
+                continue
+            results[entity_type] = {
+                "precision": float(precision[i]),
+                "recall": float(recall[i]),
+                "f1": float(f1[i]),
+                "number": int(reference[i]),
+            }
+        overall_precision, overall_recall, overall_f1 = precision_recall_f1(
+            true_positives.sum(keepdims=True), predicted.sum(keepdims=True), reference.sum(keepdims=True)
+        )
+        results["overall_precision"] = float(overall_precision[0])
+        results["overall_recall"] = float(overall_recall[0])
+        results["overall_f1"] = float(overall_f1[0])
+        # 0 when there are no tokens, as for the scores above
+        total_tokens = int(counts["total_tokens"])
+        results["overall_accuracy"] = int(counts["correct_tokens"]) / total_tokens if total_tokens > 0 else 0.0
+        return results
+
+
+def add_counts(total, counts):
+    """
+    The sum of two results of `SpanScorer.count`, e.g. of consecutive batches of sentences (`total` may be None).
+    """
+    if total is None:
+        return dict(counts)
+    return {key: total[key] + counts[key] for key in total}
+
+
+def precision_recall_f1(true_positives, predicted, reference):
+    """
+    Precision, recall and F1 from entity counts, with 0 where they are undefined (as seqeval does by default).
+    The operations are done in the same order as in seqeval so that the floats are identical.
+    """
+    true_positives = np.asarray(true_positives, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(predicted > 0, true_positives / np.maximum(predicted, 1), 0.0)
+        recall = np.where(reference > 0, true_positives / np.maximum(reference, 1), 0.0)
+    denominator = precision + recall
+    denominator = np.where(denominator == 0.0, 1.0, denominator)
+    f1 = 2 * precision * recall / denominator
+    return precision, recall, f1
@@ -0,0 +1,170 @@
+"""
+Sliding-window tagging of sentences longer than the maximum sequence length of the model.
+
+With `--sliding_window`, run_ner.py tokenizes every example into overlapping windows of at most `max_seq_length`
+tokens (consecutive windows share `window_stride` tokens) instead of truncating it, so no word is dropped. The windows
+are ordinary rows of the tokenized dataset and are batched like any other sentence, so a long document costs a
+number of `max_seq_length` windows rather than one quadratic attention over the whole document. A word that is in
+several windows takes the prediction of the window in which it is the most central, i.e. the one with the most
+context on both of its sides.
+"""
+
+from itertools import chain
+
+import numpy as np
+import pyarrow as pa
+
+from label_alignment import encode_labels
+
+# The columns added to the tokenized rows by `window_columns`, which the model does not take as inputs
+WINDOW_COLUMNS = ["example_index", "word_ids"]
+
+
+def window_columns(tokenized_inputs, sample_mapping, indices):
+    """
+    The columns that locate the windows of a tokenized batch (called with `return_overflowing_tokens=True`) in the
+    examples: the index of the example of every window and the word id of every token (-1 for special tokens).
+    """
+    return {
+        "example_index": [indices[sample] for sample in sample_mapping],
+        "word_ids": [[-1 if word_idx is None else word_idx for word_idx in encoding.word_ids]
+                     for encoding in tokenized_inputs.encodings],
+    }
+
+
+def _flat_lists(column):
+    column = column.combine_chunks() if isinstance(column, pa.ChunkedArray) else column
+    offsets = column.offsets.to_numpy().astype(np.int64)
+    return column.flatten().to_numpy().astype(np.int64), offsets - offsets[0]
+
+
+class WindowMerger:
+    """
+    Maps the predictions of the windows of a tokenized dataset back to the words of its examples.
+
+    The predictions are taken at the labelled positions of the windows (labels != -100, the first sub-word of every
+    word when the windows are labelled without `label_all_tokens`), flattened in the order of the windows, as for
+    the metrics of run_ner.py; so the merge does not depend on the padding of the batches.
+
+    Parameters:
+    example_index (np.ndarray): The example of every window.
+    word_ids (np.ndarray): The flat word ids of the tokens of all the windows (-1 for special tokens).
+    row_offsets (np.ndarray): The start of every window in `word_ids`, followed by the total length.
+    num_words (np.ndarray): The number of words of every example.
+    """
+
+    def __init__(self, example_index, word_ids, row_offsets, num_words):
+        self.num_words = np.asarray(num_words, dtype=np.int64)
+        word_offsets = np.concatenate([[0], np.cumsum(self.num_words)])
+        row_lengths = np.diff(row_offsets)
+        rows = np.repeat(np.arange(len(row_lengths)), row_lengths)
+        positions = np.arange(len(word_ids)) - row_offsets[rows]
+
+        # The first token of every word in every window, and its distance to the closest end of the window
+        previous_word_ids = np.empty_like(word_ids)
+        previous_word_ids[1:] = word_ids[:-1]
+        previous_word_ids[row_offsets[:-1][row_lengths > 0]] = -1
+        first_subword = (word_ids >= 0) & (word_ids != previous_word_ids)
+        self.num_labelled = int(first_subword.sum())
+        rows, positions = rows[first_subword], positions[first_subword]
+        centrality = np.minimum(positions, row_lengths[rows] - 1 - positions)
+        example_index = np.asarray(example_index, dtype=np.int64)
+        words = word_offsets[example_index[rows]] + word_ids[first_subword]
+
+        # When the windows of every example are consecutive rows, the end of the windows and of the labelled
+        # positions of every example, for WindowStream
+        self.in_example_order = bool(np.all(example_index[1:] >= example_index[:-1]))
+        examples = np.arange(len(self.num_words))
+        self.word_offsets = word_offsets
+        self.window_ends = np.searchsorted(example_index, examples, side="right")
+        self.position_ends = np.searchsorted(example_index[rows], examples, side="right")
+
+        # For every word, the most central of its labelled positions (the first window on ties)
+        sources = np.arange(self.num_labelled)
+        order = np.lexsort((sources, -centrality, words))
+        words, sources = words[order], sources[order]
+        is_best = np.ones(len(words), dtype=bool)
+        is_best[1:] = words[1:] != words[:-1]
+        self.words, self.sources = words[is_best], sources[is_best]
+
+    @classmethod
+    def from_dataset(cls, tokenized_dataset, num_words):
+        table = tokenized_dataset.select_columns(WINDOW_COLUMNS).with_format("arrow")[:]
+        word_ids, row_offsets = _flat_lists(table.column("word_ids"))
+        example_index = table.column("example_index").to_numpy()
+        return cls(example_index, word_ids, row_offsets, num_words)
+
+    def merge(self, predictions, fill_value):
+        """
+        The prediction of every word of every example, as a flat array in the order of the examples.
+
+        Parameters:
+        predictions (np.ndarray): The flat predictions at the labelled positions of all the windows (label ids, or
+            e.g. a (positions, labels) array of log-probabilities).
+        fill_value: The prediction of the words which are in no window (words without any sub-word).
+        """
+        if len(predictions) != self.num_labelled:
+            raise ValueError(f"Expected {self.num_labelled} labelled predictions, got {len(predictions)}")
+        merged = np.full((int(self.num_words.sum()),) + predictions.shape[1:], fill_value, dtype=predictions.dtype)
+        merged[self.words] = predictions[self.sources]
+        return merged
+
+
+class WindowStream:
+    """
+    Merges the predictions of the windows of a WindowMerger batch by batch, in the order of the windows: the words of
+    an example are merged as soon as its last window is predicted, so only the predictions of the windows of the
+    examples which are not complete yet are kept.
+    """
+
+    def __init__(self, merger, fill_value):
+        if not merger.in_example_order:
+            raise ValueError("The windows of the examples are not consecutive rows")
+        self.merger = merger
+        self.fill_value = fill_value
+        self.pending = []
+        # The labelled position of the first pending prediction, the number of windows added and the first example
+        # which is not merged yet
+        self.first_position = 0
+        self.num_windows = 0
+        self.next_example = 0
+
+    def add(self, predictions, num_windows):
+        """
+        Add the predictions at the labelled positions of the next `num_windows` windows.
+
+        Returns:
+        tuple: The flat predictions of the words of the examples completed by these windows (as `WindowMerger.merge`)
+            and the number of words of these examples.
+        """
+        merger = self.merger
+        self.pending.append(predictions)
+        self.num_windows += num_windows
+        start_example = self.next_example
+        end_example = int(np.searchsorted(merger.window_ends, self.num_windows, side="right"))
+        if end_example == start_example:
+            return np.empty((0,) + predictions.shape[1:], dtype=predictions.dtype), merger.num_words[:0]
+
+        pending = np.concatenate(self.pending)
+        word_start, word_end = merger.word_offsets[start_example], merger.word_offsets[end_example]
+        first, last = np.searchsorted(merger.words, [word_start, word_end])
+        merged = np.full((word_end - word_start,) + pending.shape[1:], self.fill_value, dtype=pending.dtype)
+        merged[merger.words[first:last] - word_start] = pending[merger.sources[first:last] - self.first_position]
+
+        # The predictions of the complete examples are not needed anymore
+        position_end = merger.position_ends[end_example - 1]
+        self.pending = [pending[position_end - self.first_position:]]
+        self.first_position = position_end
+        self.next_example = end_example
+        return merged, merger.num_words[start_example:end_example]
+
+    def is_complete(self):
+        return self.next_example == len(self.merger.num_words)
+
+
+def word_labels(raw_dataset, label_column_name, label_to_id):
+    """
+    The flat label ids of all the words of a raw dataset, and the number of words of every example.
+    """
+    labels = raw_dataset[label_column_name]
+    return encode_labels(list(chain.from_iterable(labels)), label_to_id), np.array([len(l) for l in labels])